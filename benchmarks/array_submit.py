@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""Time to submit a job array as one transaction or one job at a time.
+
+Expands a grid of --tasks commands and inserts them in a temporary table, in
+a single transaction (how `jobsclient add --array` inserts them) and in one
+transaction per job (how a loop of `jobsclient add` did). The second one only
+inserts the first --singles jobs and extrapolates.
+
+    # From the repository root
+    PYTHONPATH=. python benchmarks/array_submit.py --tasks 10000 --singles 500
+"""
+import argparse
+import datetime
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from jobs_queue.arrays import expand_array, parse_array
+from jobs_queue.jobs import JOB_COLUMNS, State, astype_jobs
+from jobs_queue.storage import CsvStorage, SqliteStorage, Transaction
+
+
+def new_tasks(ids: range, commands: list) -> pd.DataFrame:
+    now = datetime.datetime.now()
+    rows = len(ids)
+    df = pd.DataFrame(
+        dict(
+            pid=[None] * rows,
+            id=ids,
+            user=["user"] * rows,
+            command=commands,
+            priority=[2] * rows,
+            gpu_mem=[1000.0] * rows,
+            state=[State.PAUSED.value] * rows,
+            ctime=[now] * rows,
+            stime=[pd.NaT] * rows,
+            ftime=[pd.NaT] * rows,
+            env_path=["/home/user/anaconda3/envs/base/bin/python"] * rows,
+            working_dir=["/home/user"] * rows,
+            worker=[None] * rows,
+            heartbeat=[pd.NaT] * rows,
+            after=[None] * rows,
+            array_id=[ids[0]] * rows,
+            wtime=[pd.NaT] * rows,
+        )
+    )
+    return astype_jobs(df[JOB_COLUMNS])
+
+
+def submit(storage, commands: list, per_job: bool) -> float:
+    "Seconds to insert the tasks in an empty table"
+    storage.write(astype_jobs(pd.DataFrame(columns=JOB_COLUMNS)))
+
+    t = time.perf_counter()
+    batches = [[command] for command in commands] if per_job else [commands]
+    next_id = 0
+    for batch in batches:
+        tr = Transaction(storage.read)
+        tr.insert(new_tasks(range(next_id, next_id + len(batch)), batch))
+        storage.commit(tr)
+        next_id += len(batch)
+    return time.perf_counter() - t
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--tasks", type=int, default=10000, help="Tasks in the array")
+    parser.add_argument("--singles", type=int, default=500, help="Jobs inserted one by one")
+    args = parser.parse_args()
+
+    t = time.perf_counter()
+    commands = expand_array(
+        "python train.py --lr {lr} --seed {seed}",
+        parse_array([f"lr=0-{args.tasks // 100 - 1}", "seed=0-99"]),
+    )
+    print(f"expand {len(commands)} tasks: {(time.perf_counter() - t) * 1e3:8.1f} ms")
+
+    storages = dict(
+        sqlite=lambda tmp: SqliteStorage(Path(tmp) / "jobs_table.db"),
+        csv=lambda tmp: CsvStorage(Path(tmp) / "jobs_table.csv"),
+    )
+    for name, storage in storages.items():
+        with tempfile.TemporaryDirectory() as tmp:
+            array = submit(storage(tmp), commands, per_job=False)
+        with tempfile.TemporaryDirectory() as tmp:
+            singles = submit(storage(tmp), commands[: args.singles], per_job=True)
+        singles *= len(commands) / args.singles
+
+        print(
+            f"{name:>6}: array {array * 1e3:8.1f} ms | one by one ~{singles * 1e3:10.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""Read throughput of the jobs table under concurrent readers.
+
+Compares the single FileLock every reader and writer used to take (when
+`filelock` is installed), readers taking the RWLock exclusively and readers
+sharing it. A writer process updates the table during the whole run to check
+that it is not starved by the readers.
+
+Shared readers only read in parallel on several CPUs, the reads/s of the
+shared run need several CPUs to go up. On a single CPU the readers run one at
+a time anyway and only the writer waits differ (FileLock does not queue the
+writer behind the readers).
+
+    # From the repository root
+    PYTHONPATH=. python benchmarks/lock_contention.py --readers 12 --seconds 5 --rows 5000
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import time
+from multiprocessing import Event, Process, Queue
+from pathlib import Path
+
+import pandas as pd
+
+from jobs_queue.jobs import JOB_COLUMNS, Priority, State, astype_jobs
+from jobs_queue.locks import RWLock
+from jobs_queue.storage import CsvStorage
+
+try:
+    from filelock import FileLock
+except ImportError:
+    FileLock = None
+
+MODES = ["filelock", "exclusive", "shared"]
+
+
+def create_table(path: Path, rows: int) -> None:
+    now = datetime.datetime.now()
+    df = pd.DataFrame(
+        dict(
+            pid=[None] * rows,
+            id=range(rows),
+            user=[f"user{i % 12}" for i in range(rows)],
+            command=[f"python train.py --seed {i}" for i in range(rows)],
+            priority=[1 + i % len(Priority) for i in range(rows)],
+            gpu_mem=[1000.0] * rows,
+            state=[State.FINISHED.value] * rows,
+            ctime=[now] * rows,
+            stime=[now] * rows,
+            ftime=[now] * rows,
+            env_path=["/home/user/anaconda3/envs/base/bin/python"] * rows,
+            working_dir=["/home/user"] * rows,
+            worker=[None] * rows,
+            heartbeat=[pd.NaT] * rows,
+            after=[None] * rows,
+            array_id=[None] * rows,
+            wtime=[pd.NaT] * rows,
+        )
+    )
+    CsvStorage(path).write(astype_jobs(df[JOB_COLUMNS]))
+
+
+def get_lock(path: Path, mode: str):
+    "Context manager factories (read, write) of the lock of mode"
+    if mode == "filelock":
+        lock = FileLock(f"{path}.filelock")
+        return (lambda: lock), (lambda: lock)
+
+    lock = RWLock(f"{path}.lock")
+    return (lock.write if mode == "exclusive" else lock.read), lock.write
+
+
+def reader(path: Path, mode: str, start, stop, results: Queue) -> None:
+    acquire, _ = get_lock(path, mode)
+    storage = CsvStorage(path)
+
+    start.wait()
+    reads = 0
+    while not stop.is_set():
+        with acquire():
+            storage.read()
+        reads += 1
+
+    results.put(("reader", reads, 0.0))
+
+
+def writer(path: Path, mode: str, start, stop, results: Queue) -> None:
+    _, acquire = get_lock(path, mode)
+    storage = CsvStorage(path)
+
+    start.wait()
+    writes, max_wait = 0, 0.0
+    while not stop.is_set():
+        t = time.perf_counter()
+        with acquire():
+            max_wait = max(max_wait, time.perf_counter() - t)
+            storage.write(storage.read())
+        writes += 1
+        time.sleep(0.05)
+
+    results.put(("writer", writes, max_wait))
+
+
+def run(path: Path, readers: int, seconds: float, mode: str) -> None:
+    start, stop, results = Event(), Event(), Queue()
+
+    procs = [
+        Process(target=reader, args=(path, mode, start, stop, results))
+        for _ in range(readers)
+    ]
+    procs.append(Process(target=writer, args=(path, mode, start, stop, results)))
+
+    [p.start() for p in procs]
+    start.set()
+    time.sleep(seconds)
+    stop.set()
+
+    out = [results.get() for _ in procs]
+    [p.join() for p in procs]
+
+    reads = sum(n for kind, n, _ in out if kind == "reader")
+    _, writes, max_wait = next(o for o in out if o[0] == "writer")
+
+    print(
+        f"{mode:>9} readers: {reads / seconds:8.1f} reads/s | writer: {writes} writes, max wait {max_wait * 1e3:.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--readers", type=int, default=12, help="Reader processes")
+    parser.add_argument("--seconds", type=float, default=5, help="Duration of each run")
+    parser.add_argument("--rows", type=int, default=5000, help="Jobs in the table")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "jobs_table.csv"
+        create_table(path, args.rows)
+
+        print(
+            f"{args.readers} readers, {args.rows} jobs, {args.seconds}s per run, {os.cpu_count()} CPUs"
+        )
+        for mode in MODES:
+            if mode == "filelock" and FileLock is None:
+                print(f"{mode:>9} readers: skipped, filelock is not installed")
+                continue
+            run(path, args.readers, args.seconds, mode)
+
+
+if __name__ == "__main__":
+    main()
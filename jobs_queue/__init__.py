@@ -1,3 +1,4 @@
 from pathlib import Path
 
 JOBS_TABLE_FILENAME = Path("/var/tmp/jobs_queue/jobs_table.csv")
+JOBS_DB_FILENAME = JOBS_TABLE_FILENAME.with_suffix(".db")
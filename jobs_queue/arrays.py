@@ -0,0 +1,95 @@
+import itertools
+import re
+from typing import Dict, List
+
+__all__ = ["MAX_ARRAY_TASKS", "TASK_PARAM", "expand_array", "parse_array", "parse_values"]
+
+MAX_ARRAY_TASKS = 100_000
+TASK_PARAM = "task"  # Name of the parameter of a spec without name, e.g. '0-9'
+
+PLACEHOLDER = re.compile(r"\{(\w+)\}")  # {param} in the command
+RANGE = re.compile(r"^(-?\d+)-(-?\d+)(?::(\d+))?$")  # START-END[:STEP], END included
+
+
+def parse_values(spec: str) -> List[str]:
+    "Comma separated values and integer ranges, e.g. '0-4:2,7,1e-3' -> 0 2 4 7 1e-3"
+    values = []
+    for value in spec.split(","):
+        value = value.strip()
+        match = RANGE.match(value)
+        if match is None:
+            if not value:
+                raise ValueError(f"Empty value in '{spec}'")
+            values.append(value)
+            continue
+
+        start, end, step = int(match[1]), int(match[2]), int(match[3] or 1)
+        if step == 0 or end < start:
+            raise ValueError(
+                f"Invalid range '{value}'. Expected START-END[:STEP] with START <= END"
+            )
+        # Checked before expanding the range and the whole grid
+        if len(values) + len(range(start, end + 1, step)) > MAX_ARRAY_TASKS:
+            raise ValueError(f"'{spec}' exceeds the maximum array size ({MAX_ARRAY_TASKS})")
+        values.extend(str(i) for i in range(start, end + 1, step))
+
+    return values
+
+
+def parse_array(specs: List[str]) -> Dict[str, List[str]]:
+    """Parameters of `--array [NAME=]VALUES` specs. The tasks are the grid of
+    all the parameters. A spec without NAME is the `task` parameter
+
+    Example:
+        parse_array(['lr=0.1,0.01', 'seed=0-2'])
+        {'lr': ['0.1', '0.01'], 'seed': ['0', '1', '2']}  # 6 tasks
+    """
+    params: Dict[str, List[str]] = dict()
+    for spec in specs:
+        name, _, values = spec.rpartition("=")
+        name = name.strip() or TASK_PARAM
+        if not name.isidentifier():
+            raise ValueError(f"Invalid parameter name '{name}'")
+        if name in params:
+            raise ValueError(f"Parameter '{name}' given twice")
+        params[name] = parse_values(values)
+
+    tasks = 1
+    for values in params.values():
+        tasks *= len(values)
+    if tasks > MAX_ARRAY_TASKS:
+        raise ValueError(f"{tasks} tasks exceed the maximum array size ({MAX_ARRAY_TASKS})")
+
+    return params
+
+
+def expand_array(command: str, params: Dict[str, List[str]]) -> List[str]:
+    """Command of every task of the grid of params, the last parameter varying
+    the fastest. {param} placeholders are replaced by the task values, other
+    braces (e.g. ${HOME}) are kept. Raises ValueError if a parameter is unused"""
+    # Literal parts at even positions, placeholder names at odd positions
+    parts = PLACEHOLDER.split(command)
+
+    unused = params.keys() - set(parts[1::2])
+    if unused:
+        name = sorted(unused)[0]
+        raise ValueError(f"Parameter '{name}' is not used in the command. Add {{{name}}} to it")
+
+    names = list(params.keys())
+    slots = [
+        (i, names.index(part)) for i, part in enumerate(parts) if i % 2 and part in params
+    ]
+    for i, part in enumerate(parts):  # Unknown placeholders are kept as they are
+        if i % 2 and part not in params:
+            parts[i] = f"{{{part}}}"
+
+    commands = []
+    for values in itertools.product(*params.values()):
+        for i, param in slots:
+            parts[i] = values[param]
+        commands.append("".join(parts))
+
+    return commands
+
+
+# ENDFILE
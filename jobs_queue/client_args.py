@@ -32,6 +32,13 @@ class VerboseAction(argparse.Action):
         setattr(args, self.dest, max(self.option_dict.values()))
 
 
+def gpu_mem_type(value: str):
+    "GPU memory in MB or 'auto'"
+    if value.lower() == "auto":
+        return "auto"
+    return float(value)
+
+
 def get_client_parser():
     parser = argparse.ArgumentParser(
         "Client Jobs Queue",
@@ -109,9 +116,25 @@ def get_client_parser():
             "--needed_mem",
             "--needed_gpu_mem",
             dest="gpu_mem",
-            type=float,
+            type=gpu_mem_type,
             default=0,
-            help="GPU memory in MB. If cmd does not require the usage of graphical memory set --gpu_mem to 0.",
+            help="GPU memory in MB. If cmd does not require the usage of graphical memory set --gpu_mem to 0. 'auto' predicts it from the peak gpu memory of the past runs of the same command",
+        )
+        parser_add.add_argument(
+            "--after",
+            "--dependency",
+            type=str,
+            default=None,
+            dest="after",
+            help="Run after the jobs [afterok:|afterany:]ID[,ID]. afterok (default) runs once they all finish and is cancelled if one fails, afterany runs once they all end",
+        )
+        parser_add.add_argument(
+            "--array",
+            type=str,
+            action="append",
+            default=None,
+            dest="array",
+            help="Add a job array with a task for every [NAME=]VALUES, e.g. --array 0-9 or --array lr=0.1,0.01 --array seed=0-4:2 for a grid. {NAME} in the command is replaced by the task values ({task} without NAME)",
         )
         parser_add.set_defaults(operation=operations.add)
         parse_verbose(parser=parser_add)
@@ -125,12 +148,59 @@ def get_client_parser():
             "ids",
             type=int,
             action="store",
-            nargs="+",
+            nargs="*",
             help="Job ids to remove from the queue",
         )
+        parser_remove.add_argument(
+            "--array",
+            type=int,
+            nargs="+",
+            default=[],
+            dest="array_ids",
+            help="Remove all the tasks of the job arrays",
+        )
         parser_remove.set_defaults(operation=operations.remove)
         parse_verbose(parser=parser_remove)
 
+    # Cancel
+    def add_subparser_queue_cancel(subparser):
+        parser_cancel = subparser.add_parser(
+            "cancel",
+            help="Cancel waiting, blocked or paused tasks and the tasks that depend on them",
+        )
+        parser_cancel.add_argument(
+            "ids",
+            type=int,
+            action="store",
+            nargs="*",
+            help="Job ids to cancel",
+        )
+        parser_cancel.add_argument(
+            "--array",
+            type=int,
+            nargs="+",
+            default=[],
+            dest="array_ids",
+            help="Cancel the tasks of the job arrays",
+        )
+        parser_cancel.set_defaults(operation=operations.cancel)
+        parse_verbose(parser=parser_cancel)
+
+    # Array
+    def add_subparser_queue_array(subparser):
+        parser_array = subparser.add_parser(
+            "array", help="Show the number of tasks by state of the job arrays"
+        )
+        parser_array.add_argument(
+            "ids",
+            type=int,
+            action="store",
+            nargs="*",
+            help="Job array ids. List their tasks with -vv",
+        )
+        parser_array.set_defaults(operation=operations.array)
+        parse_verbose(parser=parser_array)
+
     # Update
     def add_subparser_queue_update(subparser):
         parser_update = subparser.add_parser(
@@ -158,7 +228,7 @@ def get_client_parser():
         subparser_pause = parser.add_subparsers(
             dest="op",
             required=True,
-            description=f"{op.capitalize()} jobs with ids, priority or all waiting jobs",
+            description=f"{op.capitalize()} jobs with ids, priority, job arrays or all waiting jobs",
         )
 
         parser_pause_id = subparser_pause.add_parser(
@@ -182,6 +252,18 @@ def get_client_parser():
             type=str,
             help="Jobs priority ",
         )
+        parser_pause_array = subparser_pause.add_parser(
+            "array",
+            description=f"{op.capitalize()} the tasks of job arrays in the queue",
+        )
+
+        parser_pause_array.add_argument(
+            "array_ids",
+            type=int,
+            action="store",
+            nargs="+",
+            help="Job array ids ",
+        )
 
         subparser_pause.add_parser(
             "all", description=f"{op.capitalize()} all waiting tasks in the queue"
@@ -245,13 +327,68 @@ def get_client_parser():
             "retry", help="Retries runing a process by its id"
         )
         parser_retry.add_argument("id", type=int, help="Job id")
+        parser_retry.add_argument(
+            "--mem",
+            "--gpu_mem",
+            dest="gpu_mem",
+            type=gpu_mem_type,
+            default=None,
+            help="GPU memory in MB or 'auto' to predict it from the past runs. Same as the retried job by default",
+        )
 
         parser_retry.set_defaults(operation=operations.retry)
 
+    # History
+    def add_subparser_queue_history(subparser):
+        parser_history = subparser.add_parser(
+            "history",
+            help="Show finished, errored and cancelled jobs moved to the history",
+        )
+        parser_history.add_argument(
+            "--user", type=str, default=None, help="Show jobs from user"
+        )
+        parser_history.add_argument(
+            "--state", type=str, default=None, help="Show jobs with state"
+        )
+        parser_history.add_argument(
+            "--since", type=str, default=None, help="First month to show (YYYY-MM)"
+        )
+        parser_history.add_argument(
+            "--until", type=str, default=None, help="Last month to show (YYYY-MM)"
+        )
+        parser_history.add_argument(
+            "-n",
+            "--limit",
+            type=int,
+            default=None,
+            help="Show only the n most recently finished jobs",
+        )
+        parser_history.set_defaults(operation=operations.history)
+        parse_verbose(parser=parser_history)
+
+    # Stats
+    def add_subparser_queue_stats(subparser):
+        parser_stats = subparser.add_parser(
+            "stats",
+            help="Show lock wait/hold and table read/write times per operation",
+        )
+        parser_stats.add_argument(
+            "--on", action="store_true", help="Start recording the stats"
+        )
+        parser_stats.add_argument(
+            "--off", action="store_true", help="Stop recording the stats"
+        )
+        parser_stats.add_argument(
+            "--reset", action="store_true", help="Drop the recorded stats"
+        )
+        parser_stats.set_defaults(operation=operations.stats)
+
     add_subparser_queue_show(subparser)
     add_subparser_queue_show_state(subparser)
     add_subparser_queue_add(subparser)
     add_subparser_queue_remove(subparser)
+    add_subparser_queue_cancel(subparser)
+    add_subparser_queue_array(subparser)
     add_subparser_queue_update(subparser)
     add_subparser_queue_pause(subparser)
     add_subparser_queue_resume(subparser)
@@ -260,6 +397,8 @@ def get_client_parser():
     add_subparser_queue_info(subparser)
     add_subparser_queue_kill_pid(subparser)
     add_subparser_queue_retry_job(subparser)
+    add_subparser_queue_history(subparser)
+    add_subparser_queue_stats(subparser)
 
     return parser
 
@@ -16,6 +16,8 @@ operations = EDict(
     show="show",
     add="add",
     remove="remove",
+    cancel="cancel",
+    array="array",
     update="update",
     pause="pause",
     resume="resume",
@@ -24,16 +26,21 @@ operations = EDict(
     kill="kill",
     retry="retry",
     info="info",
+    history="history",
+    stats="stats",
 )
 
 
 try:
     from .jobs_table import JobsTable, kills, not_implemented, show_info
+    from .stats import show_stats
 
     callable_operations = dict(
         show=JobsTable.show,
         add=JobsTable.add,
         remove=JobsTable.remove,
+        cancel=JobsTable.cancel,
+        array=JobsTable.array,
         update=JobsTable.update,
         pause=JobsTable.pause,
         resume=JobsTable.resume,
@@ -43,6 +50,8 @@ try:
         retry=JobsTable.retry,
         # retry=not_implemented,
         info=show_info,
+        history=JobsTable.history,
+        stats=show_stats,
     )
     assert callable_operations.keys() == operations.keys()
 
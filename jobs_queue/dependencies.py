@@ -0,0 +1,100 @@
+from typing import Dict, Iterable, List, Set, Tuple, Union
+
+import pandas as pd
+
+from .jobs import ENDED_STATES, State
+
+__all__ = [
+    "DEPENDENCY_TYPES",
+    "DependencyIndex",
+    "dependency_state",
+    "parse_after",
+    "split_after",
+]
+
+# afterok: run once every parent finished, cancelled if one errors or is cancelled
+# afterany: run once every parent ended, whatever its final state
+DEPENDENCY_TYPES = ["afterok", "afterany"]
+
+def parse_after(spec: str) -> str:
+    """Canonical dependencies of `--after [afterok:|afterany:]ID[,ID]`, e.g.
+    '3,4' -> 'afterok:3,4'. Raises ValueError"""
+    type_, _, ids = spec.rpartition(":")
+    type_ = type_ or "afterok"
+    if type_ not in DEPENDENCY_TYPES:
+        raise ValueError(f"Expected one of {DEPENDENCY_TYPES}. Got: '{type_}'")
+
+    ids = [int(id) for id in ids.replace(":", ",").split(",") if id.strip()]
+    if not ids:
+        raise ValueError(f"Expected at least one job id. Got: '{spec}'")
+
+    return f"{type_}:{','.join(str(id) for id in dict.fromkeys(ids))}"
+
+
+def split_after(after: str) -> Tuple[str, List[int]]:
+    "Dependency type and parent ids of a canonical `after` value"
+    type_, _, ids = after.partition(":")
+    return type_, [int(id) for id in ids.split(",")]
+
+
+def dependency_state(type_: str, parent_states: List[Union[int, None]]) -> State:
+    """State of a job given the states of its parents (None if the parent does
+    not exist anymore): WAITING, CANCELLED or still BLOCKED"""
+    if type_ == "afterany":
+        ended = all(s is None or s in ENDED_STATES for s in parent_states)
+        return State.WAITING if ended else State.BLOCKED
+
+    if any(s is None or s in (State.ERROR.value, State.CANCELLED.value) for s in parent_states):
+        return State.CANCELLED
+    if all(s == State.FINISHED.value for s in parent_states):
+        return State.WAITING
+    return State.BLOCKED
+
+
+class DependencyIndex:
+    """Children of every job among the blocked jobs (parent id: {child ids}),
+    so a job that ends only looks up its direct children"""
+
+    def __init__(self) -> None:
+        self.children_of: Dict[int, Set[int]] = dict()
+        self.parents_of: Dict[int, List[int]] = dict()  # Blocked job id: parent ids
+        self.signature = None  # Table signature the index is in sync with
+
+    def __len__(self) -> int:
+        return len(self.parents_of)
+
+    def rebuild(self, blocked: pd.DataFrame) -> None:
+        "Index the dependencies of the blocked jobs"
+        self.children_of, self.parents_of = dict(), dict()
+        self.update(blocked)
+
+    def update(self, df: pd.DataFrame) -> None:
+        "Add the blocked jobs with dependencies and discard the others"
+        for id, state, after in zip(df.id, df.state, df.after):
+            if state == State.BLOCKED.value and isinstance(after, str):
+                self.add(id, split_after(after)[1])
+            else:
+                self.discard(id)
+
+    def add(self, id: int, parents: Iterable[int]) -> None:
+        self.discard(id)
+        self.parents_of[int(id)] = [int(parent) for parent in parents]
+        for parent in self.parents_of[int(id)]:
+            self.children_of.setdefault(parent, set()).add(int(id))
+
+    def discard(self, id: int) -> None:
+        for parent in self.parents_of.pop(int(id), []):
+            children = self.children_of.get(parent, set())
+            children.discard(int(id))
+            if not children:
+                self.children_of.pop(parent, None)
+
+    def children(self, ids: Iterable[int]) -> List[int]:
+        "Blocked jobs that depend on any of ids"
+        children = set()
+        for id in ids:
+            children.update(self.children_of.get(int(id), set()))
+        return sorted(children)
+
+
+# ENDFILE
@@ -0,0 +1,147 @@
+import heapq
+import math
+from typing import Dict, Iterator, List, Tuple, Union
+
+import pandas as pd
+
+from .jobs import State
+
+__all__ = ["DispatchIndex", "effective_priority"]
+
+KEY = Tuple[float, int, int]  # (-aged priority, ctime in ns, id)
+
+NS_PER_HOUR = 3600 * 10**9
+
+
+class DispatchIndex:
+    """Heap of the waiting jobs keyed on effective priority (highest first),
+    ctime (oldest first) and id. Removed or updated jobs are dropped lazily
+    when they reach the top of the heap, so every operation is O(log n) and
+    walking the first k jobs is O(k log n)
+
+    The effective priority, priority + AGING * hours waiting, orders jobs the
+    same as priority - AGING * wtime at any time, so keys only change when a
+    job is set as waiting again"""
+
+    # Priority levels a waiting job gains per hour (see effective_priority).
+    # Set by the servers (--aging), 0 disables aging
+    AGING: float = 0
+
+    def __init__(self) -> None:
+        self.heap: List[KEY] = []
+        self.keys: Dict[int, KEY] = dict()  # id: current key of waiting jobs
+        self.signature = None  # Table signature the index is in sync with
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, id: int) -> bool:
+        return int(id) in self.keys
+
+    @staticmethod
+    def get_key(
+        id: int, priority: int, ctime: pd.Timestamp, wtime: pd.Timestamp
+    ) -> KEY:
+        ctime = pd.Timestamp(ctime).value
+        # Jobs stored before wtime existed wait since they were created
+        wtime = ctime if pd.isna(wtime) else pd.Timestamp(wtime).value
+        aged = -int(priority) + DispatchIndex.AGING * wtime / NS_PER_HOUR
+        return (aged, ctime, int(id))
+
+    def rebuild(self, df: pd.DataFrame) -> None:
+        "Index the waiting jobs of a jobs table"
+        waiting = df[df.state == State.WAITING.value]
+        self.heap = [
+            self.get_key(*row)
+            for row in zip(waiting.id, waiting.priority, waiting.ctime, waiting.wtime)
+        ]
+        heapq.heapify(self.heap)
+        self.keys = {key[2]: key for key in self.heap}
+
+    def update(self, df: pd.DataFrame) -> None:
+        "Push the jobs that are waiting and discard the others"
+        for id, priority, state, ctime, wtime in zip(
+            df.id, df.priority, df.state, df.ctime, df.wtime
+        ):
+            if state == State.WAITING.value:
+                self.push(id, priority, ctime, wtime)
+            else:
+                self.discard(id)
+
+    def push(
+        self, id: int, priority: int, ctime: pd.Timestamp, wtime: pd.Timestamp
+    ) -> None:
+        key = self.get_key(id, priority, ctime, wtime)
+        if self.keys.get(key[2]) == key:
+            return
+
+        self.keys[key[2]] = key
+        heapq.heappush(self.heap, key)
+
+    def discard(self, id: int) -> None:
+        self.keys.pop(int(id), None)
+
+    @staticmethod
+    def band(key: KEY, now: float) -> int:
+        "Integer part of the effective priority of a key at now (s)"
+        return math.floor(-key[0] + DispatchIndex.AGING * now * 10**9 / NS_PER_HOUR)
+
+    def _drop_stale(self) -> None:
+        while self.heap and self.keys.get(self.heap[0][2]) != self.heap[0]:
+            heapq.heappop(self.heap)
+
+    def walk(self) -> Iterator[KEY]:
+        """Keys of the waiting jobs in dispatch order. They are popped as the
+        walk goes and pushed back when it is closed. Jobs pushed meanwhile are
+        walked if they come later. Ends if the index is rebuilt meanwhile"""
+        heap, popped, walked = self.heap, [], set()
+        try:
+            while True:
+                self._drop_stale()
+                if self.heap is not heap or not heap:
+                    return
+
+                key = heapq.heappop(heap)
+                popped.append(key)
+                if key[2] not in walked:  # Pushed again with a new priority
+                    walked.add(key[2])
+                    yield key
+        finally:
+            if self.heap is heap:
+                for key in popped:
+                    heapq.heappush(heap, key)
+
+    def ordered(self) -> List[int]:
+        "Waiting job ids in dispatch order"
+        return [key[2] for key in sorted(self.keys.values())]
+
+    def check(self, df: pd.DataFrame) -> None:
+        "Raise AssertionError if the index does not match the waiting jobs of df"
+        expected = DispatchIndex()
+        expected.rebuild(df)
+
+        assert (
+            self.ordered() == expected.ordered()
+        ), f"Dispatch index out of sync. Expected: {expected.ordered()}. Got: {self.ordered()}"
+
+
+def effective_priority(
+    df: pd.DataFrame, now: Union[pd.Timestamp, None] = None
+) -> pd.Series:
+    """Priority of the jobs plus AGING levels per hour since the waiting jobs
+    were last set as waiting (wtime), so the time paused or blocked does not
+    count. The stored priority never changes. Ordering by it is the same as
+    ordering by priority - AGING * wtime, which does not depend on now (see
+    DispatchIndex.get_key)"""
+    priority = df.priority.astype(int).astype(float)
+    if not DispatchIndex.AGING:
+        return priority
+
+    now = pd.Timestamp.now() if now is None else now
+    # Jobs stored before wtime existed wait since they were created
+    waited = (now - df.wtime.fillna(df.ctime)).dt.total_seconds() / 3600
+    aged = waited.where(df.state == State.WAITING.value, 0.0)
+    return priority + DispatchIndex.AGING * aged
+
+
+# ENDFILE
@@ -0,0 +1,88 @@
+import json
+import time
+from typing import Dict, List, Union
+
+import numpy as np
+import pandas as pd
+
+from . import JOBS_TABLE_FILENAME
+from .dispatch import effective_priority
+from .locks import RWLock
+from .storage import replace_file
+
+__all__ = ["FAIR_SHARE_FILENAME", "FairShare"]
+
+# user: [decayed gpu memory-seconds (MB s), time.time() it was decayed to]
+FAIR_SHARE_FILENAME = JOBS_TABLE_FILENAME.parent / "fair_share.json"
+
+
+class FairShare:
+    """Decayed gpu memory-seconds used by each user
+
+    The servers charge the gpu_mem of their running jobs for the time they
+    ran since the last charge, so finished jobs are charged until they
+    finish. Usage halves every HALF_LIFE hours. Only the charged users are
+    updated: the decay is applied when a user is charged or read.
+
+    Within a priority, waiting jobs of users with less usage go first (see
+    order). Disabled while HALF_LIFE is 0
+    """
+
+    lock = RWLock(FAIR_SHARE_FILENAME.with_suffix(".json.lock"))
+    HALF_LIFE: float = 0  # Hours
+
+    @staticmethod
+    def decay(usage: float, seconds: float) -> float:
+        return usage * 0.5 ** (max(seconds, 0) / (FairShare.HALF_LIFE * 3600))
+
+    @staticmethod
+    def read() -> Dict[str, List[float]]:
+        try:
+            with open(FAIR_SHARE_FILENAME) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    @staticmethod
+    @lock.write()
+    def charge(charges: Dict[str, float], now: Union[float, None] = None) -> None:
+        "Add gpu memory-seconds (MB s) to each user"
+        if not FairShare.HALF_LIFE or not charges:
+            return
+
+        now = time.time() if now is None else now
+        table = FairShare.read()
+        for user, usage in charges.items():
+            previous, since = table.get(user, (0.0, now))
+            table[user] = [FairShare.decay(previous, now - since) + usage, now]
+
+        FAIR_SHARE_FILENAME.parent.mkdir(mode=0o775, parents=True, exist_ok=True)
+        replace_file(FAIR_SHARE_FILENAME, lambda f: json.dump(table, f))
+
+    @staticmethod
+    def usage(now: Union[float, None] = None) -> Dict[str, float]:
+        "Decayed usage of every user at now"
+        now = time.time() if now is None else now
+        return {
+            user: FairShare.decay(usage, now - since)
+            for user, (usage, since) in FairShare.read().items()
+        }
+
+    @staticmethod
+    def order(waiting: pd.DataFrame) -> pd.DataFrame:
+        """Waiting jobs in dispatch order reordered so the users with less usage
+        go first within each priority band (integer part of the effective
+        priority, see effective_priority). Ties keep their order"""
+        if not FairShare.HALF_LIFE or waiting.shape[0] < 2:
+            return waiting
+
+        usage = waiting.user.astype(object).map(FairShare.usage()).fillna(0.0)
+        # Priority bands of the aged priority, highest first
+        band = -np.floor(effective_priority(waiting).to_numpy())
+        order = np.lexsort(
+            (np.arange(waiting.shape[0]), usage.to_numpy(dtype=float), band)
+        )
+        return waiting.iloc[order].reset_index(drop=True)
+
+
+# ENDFILE
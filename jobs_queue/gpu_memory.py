@@ -1,18 +1,23 @@
 import argparse
 import json
 import pprint
-import subprocess
 import time
 from dataclasses import dataclass
 from datetime import timedelta
-from subprocess import check_output
-from typing import Any, Dict, List, Union
+from typing import Dict, List, Tuple, Union
 
+import numpy as np
+import psutil
 from easydict import EasyDict as EDict
 
+from .gpu_sampler import query_compute_apps, query_gpus, read_snapshot
+
 __all__ = [
     "GpuMemoryOutOfRange",
+    "GpuLedger",
     "GpuManager",
+    "GpuProcess",
+    "GpuUsageHistory",
     "wait_for_free_space",
 ]
 
@@ -21,6 +26,132 @@ class GpuMemoryOutOfRange(Exception):
     ...
 
 
+class GpuLedger:
+    """Gpu memory reserved for the started jobs
+
+    Jobs take a while to allocate their gpu_mem, meanwhile nvidia-smi reports
+    it as free. The part of each reservation that the job processes (the job
+    pid and its children) do not use yet is subtracted from the free memory of
+    its gpus until the job is released
+    """
+
+    def __init__(self) -> None:
+        # job id: (job pid, {gpu id: reserved MB})
+        self.reservations: Dict[int, Tuple[Union[int, None], Dict[int, float]]] = dict()
+
+    def __len__(self) -> int:
+        return len(self.reservations)
+
+    def reserve(
+        self, id: int, devices: Dict[int, float], pid: Union[int, None] = None
+    ) -> None:
+        self.reservations[int(id)] = (pid, dict(devices))
+
+    def set_pid(self, id: int, pid: int) -> None:
+        if int(id) in self.reservations:
+            self.reservations[int(id)] = (pid, self.reservations[int(id)][1])
+
+    def release(self, id: int) -> None:
+        self.reservations.pop(int(id), None)
+
+    def pids(self) -> Dict[int, int]:
+        "{job pid: job id} of the started jobs"
+        return {pid: id for id, (pid, _) in self.reservations.items() if pid is not None}
+
+    def outstanding(self, used_by_job: Dict[int, Dict[int, int]]) -> Dict[int, float]:
+        "Reserved memory not in use yet by gpu id. used_by_job is {job id: {gpu id: MB}}"
+        outstanding = dict()
+        for id, (_, devices) in self.reservations.items():
+            usage = used_by_job.get(id, {})
+            for gpu_id, reserved in devices.items():
+                outstanding[gpu_id] = outstanding.get(gpu_id, 0) + max(
+                    reserved - usage.get(gpu_id, 0), 0
+                )
+
+        return outstanding
+
+
+class GpuUsageHistory:
+    """Ring buffer of the last `size` samples of the free memory (MB) of every
+    gpu with vectorized queries over the samples of the last `seconds`
+
+    Usage:
+        history = GpuUsageHistory(size=1024)
+        history.add(time.time(), {0: 20000, 1: 12000})
+        history.min(seconds=30)  # {0: 20000.0, 1: 12000.0}
+    """
+
+    def __init__(self, size: int = 1024) -> None:
+        self.size = size
+        self.gpu_ids: List[int] = []
+        self.times = np.full(size, np.nan)
+        self.free = np.full((size, 0), np.nan)
+        self.count = 0  # All samples ever added
+
+    def __len__(self) -> int:
+        return min(self.count, self.size)
+
+    def add(self, time_: float, free_single: Dict[int, float]) -> None:
+        "Sample taken at time_ (s). Samples that are not newer than the last one are ignored"
+        gpu_ids = sorted(free_single)
+        if gpu_ids != self.gpu_ids:  # Different gpus, start over
+            self.gpu_ids = gpu_ids
+            self.times = np.full(self.size, np.nan)
+            self.free = np.full((self.size, len(gpu_ids)), np.nan)
+            self.count = 0
+
+        if self.count and time_ <= self.times[(self.count - 1) % self.size]:
+            return
+
+        i = self.count % self.size
+        self.times[i] = time_
+        self.free[i] = [free_single[gpu_id] for gpu_id in gpu_ids]
+        self.count += 1
+
+    def window(self, seconds: float) -> Tuple[np.ndarray, np.ndarray]:
+        "Times (n,) and free memory (n, gpus) of the samples of the last `seconds`"
+        if not self.count:
+            return self.times[:0], self.free[:0]
+
+        last = self.times[(self.count - 1) % self.size]
+        mask = self.times >= last - seconds  # nan (empty slots) is never selected
+        return self.times[mask], self.free[mask]
+
+    def by_gpu(self, values: np.ndarray) -> Dict[int, float]:
+        return dict(zip(self.gpu_ids, values.tolist()))
+
+    def min(self, seconds: float) -> Dict[int, float]:
+        _, free = self.window(seconds)
+        return self.by_gpu(free.min(axis=0)) if len(free) else dict()
+
+    def percentile(self, q: float, seconds: float) -> Dict[int, float]:
+        _, free = self.window(seconds)
+        return self.by_gpu(np.percentile(free, q, axis=0)) if len(free) else dict()
+
+    def trend(self, seconds: float) -> Dict[int, float]:
+        "Least squares slope of the free memory (MB/s). Negative while it fills up"
+        times, free = self.window(seconds)
+        if len(times) < 2:
+            return self.by_gpu(np.zeros(len(self.gpu_ids)))
+
+        t = times - times.mean()
+        slope = (t @ (free - free.mean(axis=0))) / (t @ t)
+        return self.by_gpu(slope)
+
+    def summary(self, seconds: float) -> Dict[int, Dict[str, float]]:
+        "Free memory statistics by gpu id for dashboards"
+        stats = dict(
+            min=self.min(seconds),
+            p5=self.percentile(5, seconds),
+            p50=self.percentile(50, seconds),
+            trend=self.trend(seconds),
+        )
+        return {
+            gpu_id: {name: values[gpu_id] for name, values in stats.items()}
+            for gpu_id in stats["min"]
+        }
+
+
 class ReprClss(type):
     def __str__(cls) -> str:
         cls.update()
@@ -34,65 +165,131 @@ class ReprClss(type):
 
 
 class GpuManager(metaclass=ReprClss):
-    "Uses nvidia-smi to get the graphical memory statistics"
+    "Graphical memory statistics of the gpus (see gpu_sampler)"
     USED_single: Dict[int, int] = dict()
     USED: int = None
     TOTAL_single: Dict[int, int] = dict()
     TOTAL: int = None
     FREE_single: Dict[int, int] = dict()
     FREE: int = None
-
-    def update():
-        "Update Manager variables and return output of nvidia-smi"
-        res = subprocess.run(
-            "nvidia-smi -q -d MEMORY",
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-
-        lines = res.stdout.decode().split("\n")
-
-        gpu_line_idxs = [i for i, line in enumerate(lines) if line.startswith("GPU")]
-
-        gpu_lines = [lines[i + 2 : i + 5] for i in gpu_line_idxs]
-
-        def get_line_values(line: str, key: str):
-            return (
-                line.replace(" ", "")
-                .replace(f"{key.capitalize()}:", "")
-                .replace("MiB", "")
-            )
-
-        singles_dict = dict()
-        for i, lines in enumerate(gpu_lines):
-            singles_dict["USED_single"] = dict()
-            singles_dict["TOTAL_single"] = dict()
-            singles_dict["FREE_single"] = dict()
-            for line, key in zip(lines, ["Total", "Used", "Free"]):
-                singles_dict[key.upper() + "_single"][i] = int(
-                    get_line_values(line, key)
-                )
-
-        GpuManager.USED_single = singles_dict["USED_single"]
-        GpuManager.FREE_single = singles_dict["FREE_single"]
-        GpuManager.TOTAL_single = singles_dict["TOTAL_single"]
+    USED_by_pid: Dict[int, Dict[int, int]] = dict()  # pid: {gpu id: MB}
+    USED_by_job: Dict[int, Dict[int, int]] = dict()  # job id of the ledger: {gpu id: MB}
+    UUIDS: Dict[str, int] = dict()  # gpu uuid: gpu id
+    ledger: GpuLedger = GpuLedger()
+    history: GpuUsageHistory = GpuUsageHistory()
+    # Seconds of history used for the free memory (windowed minimum). 0 uses
+    # the last sample only
+    FREE_WINDOW: float = 0
+
+    def update(processes: bool = False):
+        """Update Manager variables from the snapshot of the running GpuSampler,
+        or from one nvidia-smi query if no sampler is publishing. USED_by_pid
+        is only queried without a sampler if processes or there are reservations"""
+        snapshot = read_snapshot()
+        if snapshot is None:
+            snapshot = dict(time=time.time(), gpus=query_gpus(), apps=None)
+            if processes or GpuManager.ledger:
+                snapshot["apps"] = query_compute_apps()
+
+        GpuManager.load(snapshot)
+
+    def load(snapshot: Dict) -> None:
+        "Update Manager variables from a snapshot {time, gpus, apps} (see gpu_sampler.read_snapshot)"
+        gpus = snapshot["gpus"]
+        GpuManager.USED_single = {gpu["index"]: gpu["used"] for gpu in gpus}
+        GpuManager.FREE_single = {gpu["index"]: gpu["free"] for gpu in gpus}
+        GpuManager.TOTAL_single = {gpu["index"]: gpu["total"] for gpu in gpus}
+        GpuManager.UUIDS = {gpu["uuid"]: gpu["index"] for gpu in gpus}
 
         GpuManager.USED = sum(GpuManager.USED_single.values())
         GpuManager.TOTAL = sum(GpuManager.TOTAL_single.values())
         GpuManager.FREE = sum(GpuManager.FREE_single.values())
+        GpuManager.history.add(snapshot["time"], GpuManager.FREE_single)
+
+        if snapshot.get("apps") is not None:
+            GpuManager.update_processes(snapshot["apps"])
+            GpuManager.update_jobs_usage()
+
+    def update_processes(apps: List[Dict]):
+        "Update USED_by_pid with the gpu memory used by each process. apps is [{uuid, pid, used}]"
+        used_by_pid = dict()
+        for app in apps:
+            if app["uuid"] not in GpuManager.UUIDS:
+                continue
+
+            gpu_id = GpuManager.UUIDS[app["uuid"]]
+            usage = used_by_pid.setdefault(app["pid"], dict())
+            usage[gpu_id] = usage.get(gpu_id, 0) + app["used"]
+
+        GpuManager.USED_by_pid = used_by_pid
+
+    def update_jobs_usage():
+        "Update USED_by_job with the gpu memory used by the processes of the started jobs of the ledger"
+        used_by_job = dict()
+        for pid, id in GpuManager.get_owners(GpuManager.ledger.pids()).items():
+            if id is None:
+                continue
+
+            usage = used_by_job.setdefault(id, dict())
+            for gpu_id, used in GpuManager.USED_by_pid[pid].items():
+                usage[gpu_id] = usage.get(gpu_id, 0) + used
+
+        GpuManager.USED_by_job = used_by_job
+
+    def get_owners(jobs_pids: Dict[int, int]) -> Dict[int, Union[int, None]]:
+        """Job id that owns each process of USED_by_pid, None if it belongs to
+        no job. jobs_pids is {job pid: job id}
+
+        A process belongs to a job if the job pid is one of its ancestors. The
+        ancestors are walked on one read of the process table"""
+        if not GpuManager.USED_by_pid or not jobs_pids:
+            return dict.fromkeys(GpuManager.USED_by_pid)
+
+        ppids = {p.pid: p.info["ppid"] for p in psutil.process_iter(["ppid"])}
+
+        owners = dict()  # pid: job id
+
+        def get_owner(pid: int) -> Union[int, None]:
+            path = []
+            while pid not in owners and pid not in jobs_pids and pid in ppids:
+                path.append(pid)
+                pid = ppids[pid]
+            owner = owners.get(pid, jobs_pids.get(pid))
+            owners.update(dict.fromkeys(path, owner))
+            return owner
+
+        return {pid: get_owner(pid) for pid in GpuManager.USED_by_pid}
+
+    def available_single() -> Dict[int, float]:
+        """Free memory by gpu id minus the reserved memory not in use yet (see
+        GpuLedger). With FREE_WINDOW the free memory is the minimum of the
+        last FREE_WINDOW seconds, so memory freed briefly is not handed out"""
+        free_single = GpuManager.FREE_single
+        if GpuManager.FREE_WINDOW > 0:
+            windowed = GpuManager.history.min(GpuManager.FREE_WINDOW)
+            free_single = {
+                gpu_id: min(free, windowed.get(gpu_id, free))
+                for gpu_id, free in free_single.items()
+            }
+
+        outstanding = GpuManager.ledger.outstanding(GpuManager.USED_by_job)
+        return {
+            gpu_id: free - outstanding.get(gpu_id, 0)
+            for gpu_id, free in free_single.items()
+        }
 
     def single_gpu_available(gpu_mem: int) -> Union[int, bool]:
         "Return the gpu id that is being less used if free amount matches needed gpu_mem otherwise return False"
         GpuManager.update()
+        available = GpuManager.available_single()
 
         free_dict = {
-            gpu_id: gpu_mem < free for gpu_id, free in GpuManager.FREE_single.items()
+            gpu_id: gpu_mem < free for gpu_id, free in available.items()
         }  # gpu_id: is free or not
 
         free_dict = dict(filter(lambda v: v[1], free_dict.items()))  # Filter free ids
         sorted_free = sorted(
-            free_dict, key=lambda x: GpuManager.FREE_single[x], reverse=True
+            free_dict, key=lambda x: available[x], reverse=True
         )  # Sort by less amount being used
 
         if sorted_free:  # If not empty return first item
@@ -104,7 +301,7 @@ class GpuManager(metaclass=ReprClss):
         "Return True if the needed amount is available over all the gpus"
         GpuManager.update()
 
-        return gpu_mem < GpuManager.FREE
+        return gpu_mem < sum(GpuManager.available_single().values())
 
     def manage_gpus(gpu_mem):
         GpuManager.update()
@@ -113,59 +310,116 @@ class GpuManager(metaclass=ReprClss):
                 f"Total gpu memory={GpuManager.TOTAL}. Requested gpu memory={gpu_mem}"
             )
 
+        return GpuManager.select_device(gpu_mem, GpuManager.available_single())
+
+    def select_device_set(
+        gpu_mem: int, free_single: Dict[int, int]
+    ) -> Union[Tuple[int, ...], bool]:
+        """Smallest set of gpus that fits gpu_mem split evenly between them, or
+        False. Gpus with more free memory (less fragmented) are preferred"""
+        gpu_ids = sorted(free_single, key=lambda gpu_id: free_single[gpu_id], reverse=True)
+        for n in range(1, len(gpu_ids) + 1):
+            # The n-th gpu has the least free memory of the set
+            if gpu_mem / n < free_single[gpu_ids[n - 1]]:
+                return tuple(sorted(gpu_ids[:n]))
+
+        return False
+
+    def select_device(
+        gpu_mem: int, free_single: Dict[int, int]
+    ) -> Union[int, Tuple[int, ...], bool]:
+        """Same as manage_gpus but on a snapshot of the free memory by device
+        (gpu id: free MB) instead of querying nvidia-smi. Uses TOTAL_single of
+        the last update"""
+        total = sum(GpuManager.TOTAL_single.values())
+        if gpu_mem > total:
+            raise GpuMemoryOutOfRange(
+                f"Total gpu memory={total}. Requested gpu memory={gpu_mem}"
+            )
+
         if any(
             gpu_mem <= single_gpu for single_gpu in GpuManager.TOTAL_single.values()
         ):
-            # If needed gpu_mem requires only one gpu
-            return GpuManager.single_gpu_available(gpu_mem)
+            # Less used gpu with enough free memory
+            free_ids = [gpu_id for gpu_id, free in free_single.items() if gpu_mem < free]
+            if free_ids:
+                return max(free_ids, key=lambda gpu_id: free_single[gpu_id])
+            return False
         else:
-            return GpuManager.total_gpu_available(gpu_mem)
+            return GpuManager.select_device_set(gpu_mem, free_single)
 
-    def get_running_processes() -> List[Dict[str, Any]]:
-        raise NotImplementedError
+    def get_running_processes(
+        jobs_pids: Union[Dict[int, int], None] = None
+    ) -> List["GpuProcess"]:
+        """Processes using the gpus with the job that owns them (see
+        get_owners). jobs_pids is {job pid: job id}, the running jobs of the
+        jobs table by default. Processes that belong to no job have job_id=None"""
+        if jobs_pids is None:
+            from .jobs_table import JobsTable
 
-        def get_real_cmd(pid):
-            return check_output(f"ps -p {pid} -o cmd=".split()).strip().decode()
+            df = JobsTable.snapshot()
+            df = df[df.pid.notna()]
+            jobs_pids = dict(zip(df.pid.astype(int), df.id.astype(int)))
 
-        def get_running_time_secs(pid):
-            return int(check_output(f"ps -p {pid} -o etimes=".split()).strip())
-
-        @dataclass
-        class Process:
-            username: str
-            command: str
-            gpu_memory_usage: int
-            pid: int
-            gpu_id: int
-            time_secs: int
-            # Extras
-            full_command: float
-            cpu_memory_usage: float
-            cpu_percent: float
-
-            def __str__(self) -> str:
-                cmd_size = 40
-                cmd_extra = "[...]" if len(self.command) > cmd_size else ""
-                return f"{self.__class__.__name__}( username={self.username}, command={self.command[:cmd_size]}{cmd_extra}, gpu_memory_usage={self.gpu_memory_usage:,} MB, pid={self.pid}, gpu_id={self.gpu_id}, time_secs={timedelta(seconds=self.time_secs)} )"
-
-            __repr__ = __str__
-
-        out = GpuManager.update()
+        GpuManager.update(processes=True)
+        owners = GpuManager.get_owners(jobs_pids)
 
+        now = time.time()
         processes = []
-        for gpu in out.gpus:
-            for process in gpu.processes:
-                process.update(
-                    gpu_id=gpu.index,
-                    command=get_real_cmd(process.pid),
-                    time_secs=get_running_time_secs(process.pid),
+        for pid, usage in GpuManager.USED_by_pid.items():
+            try:
+                process = psutil.Process(pid)
+                with process.oneshot():
+                    username = process.username()
+                    command = process.name()
+                    full_command = " ".join(process.cmdline())
+                    running_secs = max(now - process.create_time(), 1e-6)
+                    cpu_memory_usage = process.memory_info().rss / 2**20
+                    cpu_times = process.cpu_times()
+            except psutil.Error:  # Finished since the query
+                continue
+
+            for gpu_id, used in usage.items():
+                processes.append(
+                    GpuProcess(
+                        username=username,
+                        command=command,
+                        gpu_memory_usage=used,
+                        pid=pid,
+                        gpu_id=gpu_id,
+                        time_secs=int(running_secs),
+                        job_id=owners[pid],
+                        full_command=full_command,
+                        cpu_memory_usage=cpu_memory_usage,
+                        cpu_percent=100 * (cpu_times.user + cpu_times.system) / running_secs,
+                    )
                 )
 
-            processes.extend([Process(**p) for p in gpu.processes])
-
         return processes
 
 
+@dataclass
+class GpuProcess:
+    username: str
+    command: str
+    gpu_memory_usage: int
+    pid: int
+    gpu_id: int
+    time_secs: int
+    job_id: Union[int, None]
+    # Extras
+    full_command: str
+    cpu_memory_usage: float  # MB
+    cpu_percent: float  # Average since the process started
+
+    def __str__(self) -> str:
+        cmd_size = 40
+        cmd_extra = "[...]" if len(self.full_command) > cmd_size else ""
+        return f"{self.__class__.__name__}( username={self.username}, command={self.full_command[:cmd_size]}{cmd_extra}, gpu_memory_usage={self.gpu_memory_usage:,} MB, pid={self.pid}, gpu_id={self.gpu_id}, time_secs={timedelta(seconds=self.time_secs)}, job_id={self.job_id} )"
+
+    __repr__ = __str__
+
+
 def wait_for_free_space(gpu_mem, sleep_time_secs: int = 1, verbose: bool = False):
     start = time.perf_counter_ns()
     while 1:
@@ -196,7 +450,7 @@ def get_parser():
 
 if __name__ == "__main__":
     print(GpuManager)
-    # pprint.pprint(GpuManager.get_running_processes())
+    pprint.pprint(GpuManager.get_running_processes())
 
     # args = get_parser().parse_args()
     # print(args)
@@ -0,0 +1,387 @@
+import argparse
+import fcntl
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import suppress
+from typing import Any, Dict, Iterator, List, Tuple, Union
+
+from . import JOBS_TABLE_FILENAME
+
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
+__all__ = [
+    "SNAPSHOT_FILENAME",
+    "GpuSampler",
+    "query_compute_apps",
+    "query_gpus",
+    "read_snapshot",
+]
+
+# Latest memory sample of every gpu, published by the running GpuSampler
+SNAPSHOT_FILENAME = JOBS_TABLE_FILENAME.parent / "gpus.json"
+# Held by the publishing sampler so there is only one per machine
+SAMPLER_LOCK_FILENAME = JOBS_TABLE_FILENAME.parent / "gpus.lock"
+
+# Fake devices for machines without gpus. Comma separated total[:used] MB,
+# e.g. JOBS_QUEUE_FAKE_GPUS=24000,24000:1000
+FAKE_GPUS = os.environ.get("JOBS_QUEUE_FAKE_GPUS", "")
+
+QUERY_GPU = "index,uuid,memory.total,memory.used,memory.free"
+QUERY_APPS = "timestamp,gpu_uuid,pid,used_memory"
+
+Gpus = List[Dict[str, Any]]  # [{index, uuid, total, used, free}] in MB
+Apps = List[Dict[str, Any]]  # [{uuid, pid, used}] in MB
+
+
+def parse_gpu_line(line: str) -> Union[Dict[str, Any], None]:
+    "Line of nvidia-smi --query-gpu=QUERY_GPU --format=csv,noheader,nounits"
+    try:
+        index, uuid, total, used, free = [value.strip() for value in line.split(",")]
+        return dict(
+            index=int(index), uuid=uuid, total=int(total), used=int(used), free=int(free)
+        )
+    except ValueError:  # [N/A] values or a partial line
+        return
+
+
+def parse_app_line(line: str) -> Union[Tuple[str, Dict[str, Any]], None]:
+    "Timestamp and app of a line of nvidia-smi --query-compute-apps=QUERY_APPS"
+    try:
+        timestamp, uuid, pid, used = [value.strip() for value in line.split(",")]
+        return timestamp, dict(uuid=uuid, pid=int(pid), used=int(used))
+    except ValueError:  # [N/A] values or a partial line
+        return
+
+
+def fake_gpus() -> Gpus:
+    gpus = []
+    for index, device in enumerate(FAKE_GPUS.split(",")):
+        total, _, used = device.partition(":")
+        total, used = int(total), int(used or 0)
+        gpus.append(
+            dict(index=index, uuid=f"GPU-fake-{index}", total=total, used=used, free=total - used)
+        )
+    return gpus
+
+
+def query_gpus() -> Gpus:
+    "One nvidia-smi query. Used when no sampler is publishing"
+    if FAKE_GPUS:
+        return fake_gpus()
+
+    try:
+        res = subprocess.run(
+            ["nvidia-smi", f"--query-gpu={QUERY_GPU}", "--format=csv,noheader,nounits"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except FileNotFoundError:  # No nvidia driver
+        return []
+
+    gpus = [parse_gpu_line(line) for line in res.stdout.decode().splitlines()]
+    return [gpu for gpu in gpus if gpu is not None]
+
+
+def query_compute_apps() -> Apps:
+    "One nvidia-smi query of the processes using the gpus. Used when no sampler is publishing"
+    if FAKE_GPUS:
+        return []
+
+    try:
+        res = subprocess.run(
+            [
+                "nvidia-smi",
+                f"--query-compute-apps={QUERY_APPS}",
+                "--format=csv,noheader,nounits",
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except FileNotFoundError:  # No nvidia driver
+        return []
+
+    apps = [parse_app_line(line) for line in res.stdout.decode().splitlines()]
+    return [app[1] for app in apps if app is not None]
+
+
+def read_snapshot() -> Union[Dict[str, Any], None]:
+    """Last published snapshot {time, interval, backend, gpus, apps, summary} or
+    None if there is none or its sampler stopped publishing (older than 3
+    intervals). summary is GpuUsageHistory.summary by gpu index (str keys)"""
+    try:
+        with open(SNAPSHOT_FILENAME) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return
+
+    if time.time() - snapshot["time"] > 3 * snapshot["interval"] + 1:
+        return
+
+    return snapshot
+
+
+def publish(
+    gpus: Gpus, apps: Apps, interval: float, backend: str, summary: Dict[int, Dict[str, float]]
+) -> None:
+    "Atomic replacement of the snapshot. Not fsync'd, it is rebuilt on restart"
+    snapshot = dict(
+        time=time.time(),
+        interval=interval,
+        backend=backend,
+        gpus=gpus,
+        apps=apps,
+        summary=summary,
+    )
+    fd, tmp = tempfile.mkstemp(
+        dir=SNAPSHOT_FILENAME.parent, prefix=f".{SNAPSHOT_FILENAME.name}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(snapshot, f)
+        # Read permissions so other users can read the snapshot
+        with suppress(PermissionError):
+            os.chmod(tmp, 0o664)
+        os.replace(tmp, SNAPSHOT_FILENAME)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+
+
+class GpuSampler:
+    """Long-lived sampler of the gpus memory
+
+    Samples the memory of every gpu and of every process using them (apps)
+    every interval seconds with NVML (pynvml) when it is available, otherwise
+    with two `nvidia-smi --query-gpu/--query-compute-apps -lms` streams, or from
+    the JOBS_QUEUE_FAKE_GPUS devices. Every sample is published to
+    SNAPSHOT_FILENAME so GpuManager.update reads a file instead of forking
+    nvidia-smi, with the free memory statistics of the last SUMMARY_WINDOW
+    seconds for dashboards. Only one sampler publishes at a time
+    (SAMPLER_LOCK_FILENAME)
+
+    Usage:
+        sampler = GpuSampler(0.5)
+        if sampler.start():  # False if another sampler is already publishing
+            ...
+            sampler.stop()
+    """
+
+    SUMMARY_WINDOW: float = 60  # Seconds of the published summary
+
+    def __init__(self, interval: float = 0.5, backend: Union[str, None] = None) -> None:
+        self.interval = interval
+        self.backend = backend or self.default_backend()
+        self.thread: Union[threading.Thread, None] = None
+        self.stopped = threading.Event()
+        self.process: Union[subprocess.Popen, None] = None
+        self.apps_process: Union[subprocess.Popen, None] = None
+        self.apps: Apps = []  # Last apps of the nvidia-smi stream
+        self.apps_time = 0.0  # When they were read
+        self.lock_fd: Union[int, None] = None
+        self.error: Union[Exception, None] = None
+        from .gpu_memory import GpuUsageHistory  # gpu_memory imports this module
+
+        self.history = GpuUsageHistory()
+
+    @staticmethod
+    def default_backend() -> str:
+        if FAKE_GPUS:
+            return "fake"
+        if pynvml is not None:
+            try:
+                pynvml.nvmlInit()
+            except pynvml.NVMLError:
+                ...
+            else:
+                pynvml.nvmlShutdown()  # Only a probe, nvml_samples inits again
+                return "nvml"
+        return "nvidia-smi"
+
+    def start(self) -> bool:
+        SNAPSHOT_FILENAME.parent.mkdir(mode=0o775, parents=True, exist_ok=True)
+        self.lock_fd = os.open(SAMPLER_LOCK_FILENAME, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+            return False
+
+        self.thread = threading.Thread(target=self.run, name="GpuSampler", daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self) -> None:
+        self.stopped.set()
+        for process in [self.process, self.apps_process]:
+            if process is not None:
+                process.terminate()
+        if self.thread is not None:
+            self.thread.join()
+        if self.lock_fd is not None:
+            with suppress(FileNotFoundError):
+                SNAPSHOT_FILENAME.unlink()
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+    def run(self) -> None:
+        samples = dict(fake=self.fake_samples, nvml=self.nvml_samples)
+        try:
+            for gpus, apps in samples.get(self.backend, self.smi_samples)():
+                if self.stopped.is_set():
+                    break
+                self.history.add(time.time(), {gpu["index"]: gpu["free"] for gpu in gpus})
+                summary = self.history.summary(self.SUMMARY_WINDOW)
+                publish(gpus, apps, self.interval, self.backend, summary)
+        except Exception as e:  # Readers fall back to querying nvidia-smi
+            self.error = e
+
+    def fake_samples(self) -> Iterator[Tuple[Gpus, Apps]]:
+        while not self.stopped.wait(self.interval):
+            yield fake_gpus(), []
+
+    def nvml_samples(self) -> Iterator[Tuple[Gpus, Apps]]:
+        pynvml.nvmlInit()
+        try:
+            handles = [
+                pynvml.nvmlDeviceGetHandleByIndex(i)
+                for i in range(pynvml.nvmlDeviceGetCount())
+            ]
+            uuids = [pynvml.nvmlDeviceGetUUID(handle) for handle in handles]
+            uuids = [uuid.decode() if isinstance(uuid, bytes) else uuid for uuid in uuids]
+            mb = lambda x: x // 2**20
+            while True:
+                gpus, apps = [], []
+                for index, (handle, uuid) in enumerate(zip(handles, uuids)):
+                    memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
+                    gpus.append(
+                        dict(
+                            index=index,
+                            uuid=uuid,
+                            total=mb(memory.total),
+                            used=mb(memory.used),
+                            free=mb(memory.free),
+                        )
+                    )
+                    for process in pynvml.nvmlDeviceGetComputeRunningProcesses(handle):
+                        if process.usedGpuMemory is not None:  # None without permissions
+                            apps.append(
+                                dict(uuid=uuid, pid=process.pid, used=mb(process.usedGpuMemory))
+                            )
+                yield gpus, apps
+
+                if self.stopped.wait(self.interval):
+                    break
+        finally:
+            pynvml.nvmlShutdown()
+
+    def smi_samples(self) -> Iterator[Tuple[Gpus, Apps]]:
+        n_gpus = len(query_gpus())
+        if not n_gpus:
+            return
+
+        threading.Thread(target=self.smi_apps, name="GpuSamplerApps", daemon=True).start()
+        self.process = subprocess.Popen(
+            [
+                "nvidia-smi",
+                f"--query-gpu={QUERY_GPU}",
+                "--format=csv,noheader,nounits",
+                f"-lms={max(int(self.interval * 1000), 1)}",
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        try:
+            # nvidia-smi prints one line per gpu on every interval
+            gpus = []
+            for line in self.process.stdout:
+                gpu = parse_gpu_line(line)
+                if gpu is None:
+                    continue
+                gpus.append(gpu)
+                if len(gpus) == n_gpus:
+                    yield gpus, self.current_apps()
+                    gpus = []
+        finally:
+            self.process.terminate()
+            self.process.wait()
+
+    def smi_apps(self) -> None:
+        """Read the `nvidia-smi --query-compute-apps -lms` stream into self.apps.
+        The stream prints one line per process and nothing while there is none,
+        so the lines are grouped by their timestamp"""
+        self.apps_process = subprocess.Popen(
+            [
+                "nvidia-smi",
+                f"--query-compute-apps={QUERY_APPS}",
+                "--format=csv,noheader,nounits",
+                f"-lms={max(int(self.interval * 1000), 1)}",
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        try:
+            last_timestamp = None
+            for line in self.apps_process.stdout:
+                parsed = parse_app_line(line)
+                if parsed is None:
+                    continue
+                timestamp, app = parsed
+                # New list instead of appending so readers never see a partial one
+                apps = [] if timestamp != last_timestamp else list(self.apps)
+                self.apps, self.apps_time = apps + [app], time.monotonic()
+                last_timestamp = timestamp
+        finally:
+            self.apps_process.terminate()
+            self.apps_process.wait()
+
+    def current_apps(self) -> Apps:
+        "Apps of the stream, none if it printed nothing for 2 intervals"
+        if time.monotonic() - self.apps_time > 2 * self.interval + 0.5:
+            return []
+        return self.apps
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "Gpu sampler", description="Publish the gpus memory for the jobs queue"
+    )
+    parser.add_argument(
+        "--interval", type=float, default=0.5, help="Seconds between samples"
+    )
+    parser.add_argument(
+        "--backend", type=str, choices=["nvml", "nvidia-smi", "fake"], default=None
+    )
+    args = parser.parse_args()
+
+    sampler = GpuSampler(args.interval, args.backend)
+    if not sampler.start():
+        print(f"A sampler is already publishing to {SNAPSHOT_FILENAME}")
+        return
+
+    print(f"Publishing the {sampler.backend} samples to {SNAPSHOT_FILENAME}")
+    try:
+        while sampler.thread.is_alive():
+            sampler.thread.join(1)
+    except KeyboardInterrupt:
+        ...
+    finally:
+        sampler.stop()
+        if sampler.error is not None:
+            print(f"Sampler stopped: {sampler.error!r}")
+
+
+if __name__ == "__main__":
+    main()
+
+# ENDFILE
@@ -0,0 +1,109 @@
+import datetime
+from pathlib import Path
+from typing import Iterable, List, Union
+
+import pandas as pd
+
+from . import JOBS_TABLE_FILENAME
+from .jobs import ENDED_STATES, JOB_COLUMNS, astype_jobs
+from .storage import CsvStorage
+
+__all__ = ["HISTORY_DIR", "JobsHistory"]
+
+HISTORY_DIR = JOBS_TABLE_FILENAME.parent / "history"
+
+
+class JobsHistory:
+    """Archive of finished, errored and cancelled jobs. Jobs are partitioned by the month
+    they finished in, one csv file per month (history/YYYY-MM.csv)"""
+
+    @staticmethod
+    def get_empty_table() -> pd.DataFrame:
+        return astype_jobs(pd.DataFrame(columns=JOB_COLUMNS))
+
+    @staticmethod
+    def finish_month(df: pd.DataFrame) -> pd.Series:
+        "Partition key of each job. Jobs without ftime use their ctime"
+        return df.ftime.fillna(df.ctime).dt.strftime("%Y-%m")
+
+    @staticmethod
+    def partitions(
+        since: Union[str, None] = None, until: Union[str, None] = None
+    ) -> List[Path]:
+        "Partition files between the months since and until (YYYY-MM), newest first"
+        paths = sorted(HISTORY_DIR.glob("[0-9][0-9][0-9][0-9]-[0-9][0-9].csv"))
+
+        return [
+            path
+            for path in reversed(paths)
+            if (since is None or path.stem >= since)
+            and (until is None or path.stem <= until)
+        ]
+
+    @staticmethod
+    def append(df: pd.DataFrame) -> None:
+        if df.empty:
+            return
+
+        HISTORY_DIR.mkdir(mode=0o775, parents=True, exist_ok=True)
+
+        for month, jobs in df.groupby(JobsHistory.finish_month(df)):
+            CsvStorage(HISTORY_DIR / f"{month}.csv").insert(jobs)
+
+    @staticmethod
+    def read(
+        since: Union[str, None] = None, until: Union[str, None] = None
+    ) -> pd.DataFrame:
+        "Archived jobs between the months since and until (YYYY-MM), newest first"
+        tables = [CsvStorage(path).read() for path in JobsHistory.partitions(since, until)]
+        if not tables:
+            return JobsHistory.get_empty_table()
+
+        df = astype_jobs(pd.concat(tables, ignore_index=True))
+
+        # A job is archived twice if the server stops between appending it to
+        # the history and removing it from the jobs table
+        df.drop_duplicates(subset="id", keep="last", inplace=True)
+
+        return df.sort_values(by="ftime", ascending=False)
+
+    @staticmethod
+    def get(ids: Iterable[int]) -> pd.DataFrame:
+        "Archived jobs with ids. Newer partitions are read first"
+        ids = set(int(id) for id in ids)
+
+        found = []
+        for path in JobsHistory.partitions():
+            df = CsvStorage(path).read()
+            df = df[df.id.isin(ids)]
+            if not df.empty:
+                found.append(df)
+                ids -= set(df.id.tolist())
+            if not ids:
+                break
+
+        if not found:
+            return JobsHistory.get_empty_table()
+
+        return astype_jobs(pd.concat(found, ignore_index=True)).drop_duplicates(
+            subset="id"
+        )
+
+    @staticmethod
+    def max_id() -> Union[int, None]:
+        "Largest archived job id. None without history"
+        ids = [CsvStorage(path).read().id.max() for path in JobsHistory.partitions()]
+        ids = [int(id) for id in ids if not pd.isna(id)]
+        return max(ids, default=None)
+
+    @staticmethod
+    def select(df: pd.DataFrame, older_than: datetime.timedelta) -> pd.DataFrame:
+        "Finished, errored and cancelled jobs that ended more than older_than ago"
+        ftime = df.ftime.fillna(df.ctime)
+        return df[
+            df.state.isin(ENDED_STATES)
+            & (ftime <= datetime.datetime.now() - older_than)
+        ]
+
+
+# ENDFILE
@@ -2,12 +2,38 @@ from abc import ABC, abstractmethod
 from enum import Enum
 from typing import Any, List, Union
 
+import pandas as pd
+
 __all__ = [
+    "JOB_COLUMNS",
+    "JOB_DTYPES",
+    "astype_jobs",
     "Priority",
     "State",
+    "ENDED_STATES",
     "get_job_repr",
 ]
 
+JOB_COLUMNS = [
+    "pid",  # None when created
+    "id",
+    "user",
+    "command",
+    "priority",
+    "gpu_mem",
+    "state",
+    "ctime",  # Created
+    "stime",  # Started
+    "ftime",  # Finished
+    "env_path",
+    "working_dir",
+    "worker",  # Scheduler running the job (host:pid)
+    "heartbeat",  # Last lease renewal of the worker
+    "after",  # Dependencies (afterok|afterany:ID,ID), None without them
+    "array_id",  # Id of the first task of the job array, None if not in an array
+    "wtime",  # Last set as waiting, NaT if it never waited
+]
+
 
 class Priority(ABC):
     "Job Priority abstract class"
@@ -57,10 +83,12 @@ class State(ABC):
 class State(Enum):
     "Job State"
     WAITING = 1
+    BLOCKED = 0  # Waiting for its dependencies
     PAUSED = -1
     RUNNING = PROCESSING = 2
     FINISHED = DONE = 3
     ERROR = -3
+    CANCELLED = -4
 
     def get_valid(state: Union[State, str, int, float]) -> State:
         try:
@@ -84,7 +112,53 @@ class State(Enum):
             )
 
 
-def get_job_repr(row_values: List[Any], lvl: int = 1) -> str:
+# Final states, the jobs in them are archived (see JobsHistory) and release their dependents
+ENDED_STATES = [State.FINISHED.value, State.ERROR.value, State.CANCELLED.value]
+
+
+JOB_DTYPES = dict(
+    pid="Int64",  # <NA> when not running
+    id="Int64",
+    user="category",
+    command=object,
+    priority=pd.CategoricalDtype(
+        sorted(Priority._value2member_map_.keys(), reverse=True), ordered=True
+    ),  # Highest priority first
+    gpu_mem="float64",
+    state=pd.CategoricalDtype(
+        [
+            State.RUNNING.value,
+            State.WAITING.value,
+            State.BLOCKED.value,
+            State.PAUSED.value,
+            State.FINISHED.value,
+            State.ERROR.value,
+            State.CANCELLED.value,
+        ],
+        ordered=True,
+    ),  # State: running, waiting, blocked, paused, finished, error, cancelled
+    ctime="datetime64[ns]",
+    stime="datetime64[ns]",  # NaT when not started
+    ftime="datetime64[ns]",  # NaT when not finished
+    env_path=object,
+    working_dir=object,
+    worker=object,  # None when not claimed by a scheduler
+    heartbeat="datetime64[ns]",  # NaT when not claimed by a scheduler
+    after=object,  # None without dependencies
+    array_id="Int64",  # <NA> when not in an array
+    wtime="datetime64[ns]",
+)
+assert list(JOB_DTYPES.keys()) == JOB_COLUMNS
+
+
+def astype_jobs(df: pd.DataFrame) -> pd.DataFrame:
+    "Cast a jobs table to the column types in JOB_DTYPES"
+    return df.astype({col: dtype for col, dtype in JOB_DTYPES.items() if col in df})
+
+
+def get_job_repr(
+    row_values: List[Any], lvl: int = 1, effective: Union[float, None] = None
+) -> str:
     (
         pid,
         id,
@@ -103,32 +177,40 @@ def get_job_repr(row_values: List[Any], lvl: int = 1) -> str:
 
     state = State.get_valid(state)
     priority = Priority.get_valid(priority)
+    priority_str = priority.name
+    if effective is not None and round(effective, 1) != priority.value:
+        priority_str += f"({effective:.1f})"  # Aged priority
 
     cmd_str = cmd[: lvl * 30]
 
     if len(cmd_str) != len(cmd):
         cmd_str += "[...]"
 
-    pid = pid if pid == "---" else pid
-    stime = stime if stime == "---" else f"{stime:%m/%d/%Y-%H:%M:%S}"
-    ftime = ftime if ftime == "---" else f"{ftime:%m/%d/%Y-%H:%M:%S}"
+    pid = "---" if pd.isna(pid) else int(pid)
+    stime = "---" if pd.isna(stime) else f"{stime:%m/%d/%Y-%H:%M:%S}"
+    ftime = "---" if pd.isna(ftime) else f"{ftime:%m/%d/%Y-%H:%M:%S}"
+    # Dependencies and job array, e.g. ", after=afterok:3,4, array=12"
+    after = extra[2] if len(extra) > 2 else None
+    array_id = extra[3] if len(extra) > 3 else None
+    links_str = f", after={after}" if isinstance(after, str) else ""
+    links_str += "" if pd.isna(array_id) else f", array={int(array_id)}"
 
     # FIXME: diferent ways to represent time
     # TODO: change all reprs
 
     if lvl < 0:
-        return f'Job(pid={pid}, id={int(id)}, user={user}, command="{cmd}", priority={priority.name}, gpu_mem={gpu_mem}, state={state.name}, ctime={ctime:%m/%d/%Y-%H:%M:%S}, stime={stime}, ftime={ftime})'
+        return f'Job(pid={pid}, id={int(id)}, user={user}, command="{cmd}", priority={priority_str}, gpu_mem={gpu_mem}, state={state.name}{links_str}, ctime={ctime:%m/%d/%Y-%H:%M:%S}, stime={stime}, ftime={ftime})'
 
     if lvl == 0:
         return f"Job(id={int(id)}, user={user}, priority={priority.value}, state={state.value}, ctime={ctime:%m/%d-%H:%M})"
 
     if lvl == 1:
-        return f'Job(id={int(id)}, user={user}, command="{cmd_str}", priority={priority.name}, gpu_mem={gpu_mem}, state={state.name}, ctime={ctime:%m/%d-%H:%M})'
+        return f'Job(id={int(id)}, user={user}, command="{cmd_str}", priority={priority_str}, gpu_mem={gpu_mem}, state={state.name}{links_str}, ctime={ctime:%m/%d-%H:%M})'
 
     if lvl == 2:
-        return f'Job(pid={pid}, id={int(id)}, user={user}, command="{cmd_str}", priority={priority.name}, gpu_mem={gpu_mem}, state={state.name}, ctime={ctime:%m/%d/%Y-%H:%M:%S}, stime={stime}, ftime={ftime})'
+        return f'Job(pid={pid}, id={int(id)}, user={user}, command="{cmd_str}", priority={priority_str}, gpu_mem={gpu_mem}, state={state.name}{links_str}, ctime={ctime:%m/%d/%Y-%H:%M:%S}, stime={stime}, ftime={ftime})'
 
-    return f'Job(pid={pid}, id={int(id)}, user={user}, command="{cmd_str}", priority={priority.name}, gpu_mem={gpu_mem}, state={state.name}, ctime={ctime:%m/%d/%Y-%H:%M:%S}, stime={stime}, ftime={ftime}, env_path={env_path}, working_dir={working_dir})'
+    return f'Job(pid={pid}, id={int(id)}, user={user}, command="{cmd_str}", priority={priority_str}, gpu_mem={gpu_mem}, state={state.name}{links_str}, ctime={ctime:%m/%d/%Y-%H:%M:%S}, stime={stime}, ftime={ftime}, env_path={env_path}, working_dir={working_dir})'
 
 
 # ENDFILE
@@ -1,38 +1,56 @@
 import argparse
 import datetime
 import os
+import time
+from contextlib import closing, contextmanager
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, List, Union
+from typing import Any, Dict, Iterable, Iterator, List, Union
 
+import numpy as np
 import pandas as pd
 import psutil
 
-try:
-    from filelock import FileLock
-except ImportError:
-    print(
-        f"FileLock import does not exist in current env. Watch out for users accessing the queue at the same time..."
-    )
-
 from . import JOBS_TABLE_FILENAME
+from .locks import RWLock
 
 JOBS_TABLE_FILENAME.parent.mkdir(mode=0o775, parents=True, exist_ok=True)
 
-lock = FileLock(f"{JOBS_TABLE_FILENAME}.lock")
+# Readers share the lock, writers get it exclusively
+lock = RWLock(f"{JOBS_TABLE_FILENAME}.lock")
 
+from .arrays import expand_array, parse_array
+from .dependencies import DependencyIndex, dependency_state, parse_after, split_after
+from .dispatch import DispatchIndex, effective_priority
+from .fairshare import FairShare
 from .gpu_memory import GpuManager
-from .jobs import Priority, State, get_job_repr
+from .history import JobsHistory
+from .jobs import (
+    ENDED_STATES,
+    JOB_COLUMNS,
+    JOB_DTYPES,
+    Priority,
+    State,
+    astype_jobs,
+    get_job_repr,
+)
+from .notify import notify
+from .profiles import GpuProfiles
+from .stats import stats
+from .storage import Storage, Transaction, get_storage
 from .user_settings import get_user_paths
 
 __all__ = ["JOBS_TABLE_FILENAME", "JobsTable"]
 
+# Columns the dispatch and dependency indexes are keyed on
+INDEXED_COLUMNS = {"state", "priority", "ctime", "wtime", "after"}
+
 
 def not_implemented(*args, **kwargs):
     return f"NotImplementedError: This feature is not yet implemented"
 
 
-@lock
+@lock.read()
 def kills(args):
     """Kill a job
 
@@ -45,14 +63,12 @@ def kills(args):
 
     df = JobsTable.read()
 
-    runing = (
-        df[(df.pid != "---") & (df.user == user_login)].id.values.astype(int).tolist()
-    )
+    runing = df[df.pid.notna() & (df.user == user_login)].id.astype(int).tolist()
 
     pid_list = df[df.id == id]
-    pid = "---" if len(pid_list.pid) == 0 else pid_list.pid.values[0]
+    pid = pd.NA if len(pid_list.pid) == 0 else pid_list.pid.values[0]
 
-    if (pid == "---") or (int(id) not in runing):
+    if pd.isna(pid) or (int(id) not in runing):
         return f"Invalid job id. Expected: {runing} . Got: {id}"
 
     if dry:
@@ -69,94 +85,333 @@ def kills(args):
 
 
 def show_info(*args, **kwargs):
+    filename = JobsTable.storage.path
+
     pholder = " --- "
-    if JOBS_TABLE_FILENAME.exists():
-        mtime = datetime.datetime.fromtimestamp(JOBS_TABLE_FILENAME.stat().st_mtime)
-        mode = JOBS_TABLE_FILENAME.stat().st_mode
-        size = JOBS_TABLE_FILENAME.stat().st_size
+    if filename.exists():
+        mtime = datetime.datetime.fromtimestamp(filename.stat().st_mtime)
+        mode = filename.stat().st_mode
+        size = filename.stat().st_size
     else:
         mtime = pholder
         mode = pholder
         size = pholder
 
+    generation = getattr(JobsTable.storage, "generation", None)
+
     msg = f"""Queue:
-  dir: {JOBS_TABLE_FILENAME.parent}
-  filename: {JOBS_TABLE_FILENAME}
-  exists: {JOBS_TABLE_FILENAME.exists()}
+  storage: {JobsTable.storage.__class__.__name__}
+  dir: {filename.parent}
+  filename: {filename}
+  exists: {filename.exists()}
   mode: {mode}
   modified: {mtime}
   size: {size} B
 """
+    if generation is not None:
+        msg += f"  generation: {generation()}\n"
     return msg
 
 
 class JobsTable:
+    # Storage backend chosen with the JOBS_QUEUE_STORAGE env variable (sqlite by default)
+    storage: Storage = get_storage()
+    # Parsed and sorted table of the last read and the table signature it was read at
+    _cache: Union[tuple, None] = None
+    # Waiting jobs heap used by waiting_jobs. Only kept up to date by the
+    # processes that dispatch jobs (see JobsTable.sync_index)
+    index: DispatchIndex = DispatchIndex()
+    # Children of the blocked jobs. Kept up to date by the processes that end
+    # or remove jobs (see JobsTable.resolve_dependencies)
+    deps: DependencyIndex = DependencyIndex()
+
     @staticmethod
     def get_empty_table() -> pd.DataFrame:
-        job_cols = [
-            "pid",  # None when created
-            "id",
-            "user",
-            "command",
-            "priority",
-            "gpu_mem",
-            "state",
-            "ctime",  # Created
-            "stime",  # Started
-            "ftime",  # Finished
-            "env_path",
-            "working_dir",
-        ]
-        return pd.DataFrame({col: [] for col in job_cols})
+        "Empty table with the strict column types in JOB_DTYPES"
+        return pd.DataFrame(
+            {col: pd.Series(dtype=dtype) for col, dtype in JOB_DTYPES.items()}
+        )
 
     @staticmethod
-    @lock
+    @lock.read()
     def read() -> pd.DataFrame:
-        "Read jobs table sorted by state, priority and timestamp"
+        """Read jobs table sorted by state, priority and timestamp
+
+        The parsed table is cached in the process and reused while the table
+        signature (file inode, mtime_ns and size) does not change. Callers get a
+        copy so they are free to change it
+        """
+        return JobsTable.snapshot()
+
+    @staticmethod
+    def snapshot() -> pd.DataFrame:
+        """Same as read but without taking the lock. Writes replace the table
+        atomically (csv) or in a transaction (sqlite) so the result is always a
+        consistent table, though it may be outdated as soon as it is returned.
+        Only for read-only operations"""
+        signature = JobsTable.storage.signature()
+        if JobsTable._cache is not None and JobsTable._cache[0] == signature:
+            return JobsTable._cache[1].copy()
+
         try:
-            df = pd.read_csv(JOBS_TABLE_FILENAME, sep=";")
-            states_order = [
-                State.RUNNING.value,
-                State.WAITING.value,
-                State.PAUSED.value,
-                State.FINISHED.value,
-                State.ERROR.value,
-            ]
+            with stats.timer("read"):
+                df = JobsTable.storage.read()
 
-            df["s"] = pd.Categorical(
-                df["state"], states_order
-            )  # State: running, waiting, finished, error
-            df["p"] = pd.Categorical(
-                df["priority"], sorted(Priority._value2member_map_.keys(), reverse=True)
-            )  # Highest priority first
-            df["ctime"] = df.ctime.apply(pd.Timestamp)  # Oldest ctime first
-            df["stime"] = df.stime.apply(lambda x: x if x == "---" else pd.Timestamp(x))
-            df["ftime"] = df.ftime.apply(lambda x: x if x == "---" else pd.Timestamp(x))
-
-            # Sort by priority and Timestamp
-            df.sort_values(by=["s", "p", "ctime"], inplace=True)
-            df.drop(["s", "p"], axis=1, inplace=True)  # Drop state and priority helper
-
-            return df
+            # Sort by state, priority and Timestamp (oldest ctime first). State
+            # and priority are ordered categoricals (see JOB_DTYPES)
+            df.sort_values(by=["state", "priority", "ctime"], inplace=True)
+
+            if signature is not None:
+                JobsTable._cache = (signature, df)
+
+            return df.copy()
         except FileNotFoundError:
             return JobsTable.get_empty_table()
 
     @staticmethod
-    @lock
+    @lock.write()
     def write(df: pd.DataFrame) -> None:
-        df.to_csv(JOBS_TABLE_FILENAME, sep=";", index=None)
-        # Read, Write, Execute permissions so other users can change the files
-        try:
-            JOBS_TABLE_FILENAME.chmod(0o775)
-        except PermissionError:
-            ...
+        JobsTable._cache = None
+        JobsTable.index.signature = None  # Rebuild on next sync
+        JobsTable.deps.signature = None
+        with stats.timer("write"):
+            JobsTable.storage.write(df)
+
+    @staticmethod
+    @contextmanager
+    def transaction() -> Iterator[Transaction]:
+        """Load the table at most once under the lock and commit all the
+        mutations in a single write when leaving the context
+
+        Example:
+            with JobsTable.transaction() as tr:
+                ids = tr.df[tr.df.state == State.WAITING.value].id.tolist()
+                tr.set_state(ids, State.PAUSED)
+        """
+        with lock.write():
+            tr = Transaction(JobsTable.read)
+            yield tr
+
+            JobsTable.resolve_dependencies(tr)
+
+            signature = JobsTable.storage.signature()
+            index_in_sync = signature is not None and JobsTable.index.signature == signature
+            deps_in_sync = signature is not None and JobsTable.deps.signature == signature
+
+            with stats.timer("write"):
+                JobsTable.storage.commit(tr)
+
+            if index_in_sync or deps_in_sync:
+                JobsTable.update_index(tr, dispatch=index_in_sync, deps=deps_in_sync)
+                signature = JobsTable.storage.signature()
+                if index_in_sync:
+                    JobsTable.index.signature = signature
+                if deps_in_sync:
+                    JobsTable.deps.signature = signature
+
+        # Wake up the schedulers once the lock is released if jobs were added,
+        # changed state (e.g. resumed or finished) or priority
+        if any(
+            op == "insert" or (op == "update" and {"state", "priority"} & values.keys())
+            for op, _, values in tr.ops
+        ):
+            notify()
+
+    @staticmethod
+    def update_index(tr: Transaction, dispatch: bool = True, deps: bool = False) -> None:
+        """Apply the mutations of a committed transaction to the dispatch and/or
+        the dependency index"""
+        indexes = [JobsTable.index] if dispatch else []
+        indexes += [JobsTable.deps] if deps else []
+
+        inserted, touched, deleted = [], set(), set()
+        for op, arg, values in tr.ops:
+            if op == "insert":
+                inserted.append(arg)
+            elif op == "update" and INDEXED_COLUMNS & values.keys():
+                touched.update(arg)
+            elif op == "delete":
+                deleted.update(arg)
+
+        for index in indexes:
+            for id in deleted - touched:
+                index.discard(id)
+            # Inserted rows are indexed as they are unless changed afterwards
+            for df in inserted:
+                index.update(df[~df.id.isin(touched | deleted)])
+
+        if touched:
+            jobs = JobsTable.storage.get(touched)
+            for index in indexes:
+                index.update(jobs)
+                for id in touched - set(jobs.id.tolist()):
+                    index.discard(id)
+
+    @staticmethod
+    @lock.read()
+    def sync_index() -> None:
+        """Rebuild the dispatch index from the waiting jobs if the table was
+        changed by another process since the index was last updated"""
+        signature = JobsTable.storage.signature()
+        if signature is None or signature != JobsTable.index.signature:
+            with stats.timer("read"):
+                JobsTable.index.rebuild(JobsTable.storage.waiting())
+            JobsTable.index.signature = signature
+
+    @staticmethod
+    @lock.read()
+    def sync_dependencies() -> None:
+        """Rebuild the dependency index from the blocked jobs if the table was
+        changed by another process since the index was last updated"""
+        signature = JobsTable.storage.signature()
+        if signature is None or signature != JobsTable.deps.signature:
+            with stats.timer("read"):
+                JobsTable.deps.rebuild(JobsTable.storage.blocked())
+            JobsTable.deps.signature = signature
+
+    @staticmethod
+    def get_states(
+        ids: Iterable[int], df: Union[pd.DataFrame, None] = None
+    ) -> Dict[int, Union[int, None]]:
+        """State of the jobs in df (the stored jobs by default) or in the
+        history. None for the jobs that do not exist"""
+        states = dict.fromkeys(int(id) for id in ids)
+        if not states:
+            return states
+
+        df = JobsTable.storage.get(states.keys()) if df is None else df
+        df = df[df.id.isin(states.keys())]
+        states.update(zip(df.id.astype(int), df.state.astype(int)))
+
+        missing = [id for id, state in states.items() if state is None]
+        if missing:
+            archived = JobsHistory.get(missing)
+            states.update(zip(archived.id.astype(int), archived.state.astype(int)))
+
+        return states
+
+    @staticmethod
+    def resolve_dependencies(tr: Transaction) -> None:
+        """Set the blocked children of the jobs that ended or were removed in
+        the transaction as waiting or cancelled (see dependency_state) in the
+        same transaction. Cancelled children end their own children in turn.
+        Only the direct children are looked up, in the dependency index"""
+        pending: Dict[int, Union[int, None]] = dict()  # State after tr. None if deleted
+        for op, arg, values in tr.ops:
+            if op == "insert":
+                pending.update(zip(arg.id.astype(int), arg.state.astype(int)))
+            elif op == "update" and "state" in values:
+                pending.update(dict.fromkeys(arg, int(values["state"])))
+            elif op == "delete":
+                pending.update(dict.fromkeys(arg))
+
+        ended = [id for id, state in pending.items() if state in [None, *ENDED_STATES]]
+        if not ended:
+            return
+
+        JobsTable.sync_dependencies()
+
+        now = datetime.datetime.now()
+        while ended:
+            children = [
+                id
+                for id in JobsTable.deps.children(ended)
+                if pending.get(id, State.BLOCKED.value) == State.BLOCKED.value
+            ]
+            if not children:
+                break
+
+            jobs = JobsTable.storage.get(children)
+            afters = [split_after(after) for after in jobs.after]
+            parents = set(id for _, ids in afters for id in ids)
+
+            states = {id: pending[id] for id in parents if pending.get(id) is not None}
+            states.update(JobsTable.get_states(parents - pending.keys()))
+            # Removed in this transaction: archived or gone
+            deleted = [id for id in parents if id in pending and pending[id] is None]
+            states.update(JobsTable.get_states(deleted, df=JobsTable.get_empty_table()))
+
+            waiting, cancelled = [], []
+            for id, (type_, ids) in zip(jobs.id.astype(int), afters):
+                state = dependency_state(type_, [states[parent] for parent in ids])
+                if state is State.WAITING:
+                    waiting.append(id)
+                elif state is State.CANCELLED:
+                    cancelled.append(id)
+
+            if waiting:
+                tr.set_state(waiting, State.WAITING)
+                pending.update(dict.fromkeys(waiting, State.WAITING.value))
+            if cancelled:
+                tr.update(cancelled, ftime=now)
+                tr.set_state(cancelled, State.CANCELLED)
+                pending.update(dict.fromkeys(cancelled, State.CANCELLED.value))
+
+            ended = cancelled
+
+    @staticmethod
+    @lock.read()
+    def check_index() -> None:
+        "Raise AssertionError if the dispatch index does not match the jobs table"
+        JobsTable.sync_index()
+        JobsTable.index.check(JobsTable.read())
+
+    @staticmethod
+    def new_job(
+        id: int,
+        user: str,
+        command: str,
+        priority: Union[Priority, str, int],
+        gpu_mem: float,
+        env_path: str,
+        working_dir: str,
+        after: Union[str, None] = None,
+    ) -> pd.DataFrame:
+        "Single row table with a new paused job"
+        return JobsTable.new_jobs(
+            [id], user, [command], priority, gpu_mem, env_path, working_dir, after
+        )
+
+    @staticmethod
+    def new_jobs(
+        ids: List[int],
+        user: str,
+        commands: List[str],
+        priority: Union[Priority, str, int],
+        gpu_mem: float,
+        env_path: str,
+        working_dir: str,
+        after: Union[str, None] = None,
+        array_id: Union[int, None] = None,
+    ) -> pd.DataFrame:
+        "Table with new paused jobs that only differ in their id and command"
+        data = dict(
+            pid=pd.NA,
+            id=ids,
+            user=user,
+            command=commands,
+            priority=Priority.get_valid(priority).value,
+            gpu_mem=int(gpu_mem),
+            state=State.PAUSED.value,
+            ctime=datetime.datetime.now(),
+            stime=pd.NaT,
+            ftime=pd.NaT,
+            env_path=env_path,
+            working_dir=working_dir,
+            worker=None,
+            heartbeat=pd.NaT,
+            after=after,
+            array_id=array_id,
+            wtime=pd.NaT,
+        )
+
+        return astype_jobs(pd.DataFrame(data, index=range(len(ids))))
 
     # ================================================================= #
     # ======================== USER INTERFACE ========================= #
     # ================================================================= #
 
     @staticmethod
-    @lock
     def add(args: argparse.Namespace):
         command: str = args.command
         priority: Union[Priority, str] = args.priority
@@ -164,48 +419,85 @@ class JobsTable:
         verbose: int = args.verbose
         envname: str = args.envname
         working_dir: str = args.working_dir
+        after: Union[str, None] = getattr(args, "after", None)
+        array: Union[List[str], None] = getattr(args, "array", None)
         # extra kwargs from smtpserver.libclient
         user_login: str = args.extra_kwargs["user_login"]
 
         msg = ""
 
-        upaths = get_user_paths(user_login, envname)
+        if after is not None:
+            try:
+                after = parse_after(after)
+            except ValueError as e:
+                return f"Invalid --after: {e}"
 
-        data = dict(
-            pid="---",
-            id=JobsTable.get_new_valid_id(),
-            user=user_login,
-            command=" ".join(command),
-            priority=Priority.get_valid(priority).value,
-            gpu_mem=int(gpu_mem),
-            state=State.PAUSED.value,
-            ctime=datetime.datetime.now(),
-            stime="---",
-            ftime="---",
-            env_path=upaths["env_path"],
-            working_dir=str(Path(working_dir).resolve())
+            with lock.read():
+                states = JobsTable.get_states(split_after(after)[1])
+            missing = [id for id, state in states.items() if state is None]
+            if missing:
+                return f"Invalid --after. Jobs {missing} do not exist"
+
+        upaths = get_user_paths(user_login, envname)
+        working_dir = (
+            str(Path(working_dir).resolve())
             if working_dir is not None
-            else upaths["working_dir"],
+            else upaths["working_dir"]
         )
-
-        GpuManager.update()
+        command = " ".join(command)
+
+        commands = [command]
+        if array:
+            try:
+                commands = expand_array(command, parse_array(array))
+            except ValueError as e:
+                return f"Invalid --array: {e}"
+            if gpu_mem == "auto":
+                return "--gpu_mem auto is not supported with --array. Set --gpu_mem"
+
+        if gpu_mem == "auto":
+            gpu_mem, runs = GpuProfiles.predict(command, upaths["env_path"], working_dir)
+            if gpu_mem is None:
+                return "No past runs of this command to predict its gpu memory. Set --gpu_mem"
+            msg += f"Using gpu_mem={gpu_mem:,.0f} MB predicted from {runs} past runs\n"
+
+        with stats.timer("nvidia_smi"):
+            GpuManager.update()
         if not any(
             gpu_mem <= single_gpu for single_gpu in GpuManager.TOTAL_single.values()
         ):
             msg += "WARNING: 'gpu_mem' exceeds any single gpu memory. Using multiple gpus...\n"
 
-        new_row = pd.DataFrame(data, index=[0])
-
-        new_row["ctime"] = new_row.ctime.apply(pd.Timestamp)
-
-        msg += f"Adding {get_job_repr(new_row.values, lvl=verbose)} ..."
+        # All the tasks of an array in a single transaction. Only the ids and
+        # the insert hold the lock, not the user paths nor the gpus query
+        with JobsTable.transaction() as tr:
+            ids = JobsTable.get_new_valid_ids(len(commands))
+            new_rows = JobsTable.new_jobs(
+                ids=ids,
+                user=user_login,
+                commands=commands,
+                priority=priority,
+                gpu_mem=gpu_mem,
+                env_path=upaths["env_path"],
+                working_dir=working_dir,
+                after=after,
+                array_id=ids[0] if array else None,
+            )
+            tr.insert(new_rows)
 
-        JobsTable.write(JobsTable.read().append(new_row))
+        if not array:
+            msg += f"Adding {get_job_repr(new_rows.values, lvl=verbose)} ..."
+        else:
+            msg += f"Adding array {ids[0]} with {len(ids)} tasks (ids {ids[0]}-{ids[-1]}) ...\n"
+            msg += f"  {get_job_repr(new_rows.iloc[:1].values, lvl=verbose)}\n"
+            if len(ids) > 1:
+                msg += "  ...\n" if len(ids) > 2 else ""
+                msg += f"  {get_job_repr(new_rows.iloc[-1:].values, lvl=verbose)}\n"
 
         return msg
 
     @staticmethod
-    @lock
+    @lock.write()
     def update(args: argparse.Namespace):
         id: int = args.id
         attr: str = args.attr
@@ -214,12 +506,11 @@ class JobsTable:
         # extra kwargs from smtpserver.libclient
         user_login: str = args.extra_kwargs["user_login"]
 
-        df = JobsTable.read()
+        df = JobsTable.storage.get([id])
 
-        if id not in JobsTable.get_jobs_ids():
+        if df.empty:
             return f"The id={id} is not a valid job id. Expected: {JobsTable.get_jobs_ids()}"
 
-        df = JobsTable.read()
         if df[(df.id == id) & (df.user == user_login)].empty:
             return f"User {user_login} not allowed to update job. Job belongs to {df[(df.id == id)].user} "
 
@@ -234,238 +525,477 @@ class JobsTable:
 
         msg = f"Updating {get_job_repr(df.loc[df.id == id].values, lvl=verbose)} . {attr}={df.loc[df.id == id][attr].values[0]} -> {attr}={new_value} ..."
 
-        df.loc[df.id == id, attr] = new_value
-
-        JobsTable.write(df)
+        with JobsTable.transaction() as tr:
+            tr.update([id], **{attr: new_value})
 
         return msg
 
     @staticmethod
-    @lock
+    @lock.write()
     def pause(args: argparse.Namespace):
         op: str = args.op
         verbose: int = args.verbose
-        if op not in ["ids", "priority", "all"]:
-            return f"Expected args.op in ['ids', 'priority', 'all'] . Got: {op}"
-
-        df = JobsTable.read()
-        ids = df[df["state"] == State.WAITING.value].id.values  # op = 'all'
-
-        if op == "ids":
-            ids = list(filter(lambda id: id in ids, args.ids))
-        elif op == "priority":
-            ids = df[
-                (df["state"] == State.WAITING.value)
-                & (df["priority"] == Priority.get_valid(args.priority).value)
-            ].id.values
-
-        [JobsTable.set_job_state(id, state=State.PAUSED) for id in ids]
-
+        if op not in ["ids", "priority", "array", "all"]:
+            return f"Expected args.op in ['ids', 'priority', 'array', 'all'] . Got: {op}"
+
+        with JobsTable.transaction() as tr:
+            df = tr.df
+            # Blocked jobs are paused too. Resuming evaluates their dependencies
+            pausable = df[df["state"].isin([State.WAITING.value, State.BLOCKED.value])]
+            ids = pausable.id.tolist()  # op = 'all'
+
+            if op == "ids":
+                ids = list(filter(lambda id: id in ids, args.ids))
+            elif op == "priority":
+                ids = pausable[
+                    pausable["priority"] == Priority.get_valid(args.priority).value
+                ].id.tolist()
+            elif op == "array":
+                ids = pausable[pausable.array_id.isin(args.array_ids)].id.tolist()
+
+            tr.set_state(ids, state=State.PAUSED)
+
+        if op == "array":
+            return f"Pausing array {args.array_ids}: {len(ids)} tasks"
         return f"Pausing {op}: {ids}"
 
     @staticmethod
-    @lock
+    @lock.write()
     def resume(args: argparse.Namespace):
         op: str = args.op
         verbose: int = args.verbose
-        if op not in ["ids", "priority", "all"]:
-            return f"Expected args.op in ['ids', 'priority', 'all'] . Got: {op}"
-        df = JobsTable.read()
-        ids = df[df["state"] == State.PAUSED.value].id.values  # pause = 'all'
-
-        if op == "ids":
-            ids = list(filter(lambda id: id in ids, args.ids))
-        elif op == "priority":
-            ids = df[
-                (df["state"] == State.PAUSED.value)
-                & (df["priority"] == Priority.get_valid(args.priority).value)
-            ].id.values
-
-        [JobsTable.set_job_state(id, state=State.WAITING) for id in ids]
+        if op not in ["ids", "priority", "array", "all"]:
+            return f"Expected args.op in ['ids', 'priority', 'array', 'all'] . Got: {op}"
+        with JobsTable.transaction() as tr:
+            df = tr.df
+            ids = df[df["state"] == State.PAUSED.value].id.tolist()  # pause = 'all'
+
+            if op == "ids":
+                ids = list(filter(lambda id: id in ids, args.ids))
+            elif op == "priority":
+                ids = df[
+                    (df["state"] == State.PAUSED.value)
+                    & (df["priority"] == Priority.get_valid(args.priority).value)
+                ].id.tolist()
+            elif op == "array":
+                ids = df[
+                    (df["state"] == State.PAUSED.value) & df.array_id.isin(args.array_ids)
+                ].id.tolist()
+
+            # Jobs with dependencies wait for them (see dependency_state)
+            jobs = df[df.id.isin(ids) & df.after.notna()]
+            afters = [split_after(after) for after in jobs.after]
+            states = JobsTable.get_states(
+                set(parent for _, parents in afters for parent in parents), df=df
+            )
 
-        return f"Resuming {op}: {ids}"
+            dependent = set(jobs.id.tolist())
+            resumed = {
+                State.WAITING: [id for id in ids if id not in dependent],
+                State.BLOCKED: [],
+                State.CANCELLED: [],
+            }
+            for id, (type_, parents) in zip(jobs.id.astype(int), afters):
+                state = dependency_state(type_, [states[parent] for parent in parents])
+                resumed[state].append(id)
+
+            tr.set_state(resumed[State.WAITING], state=State.WAITING)
+            tr.set_state(resumed[State.BLOCKED], state=State.BLOCKED)
+            if resumed[State.CANCELLED]:
+                tr.update(resumed[State.CANCELLED], ftime=datetime.datetime.now())
+                tr.set_state(resumed[State.CANCELLED], state=State.CANCELLED)
+
+        msg = f"Resuming {op}: {ids}"
+        if op == "array":
+            msg = f"Resuming array {args.array_ids}: {len(ids)} tasks"
+        if resumed[State.BLOCKED]:
+            msg += f"\nBlocked by their dependencies: {resumed[State.BLOCKED]}"
+        if resumed[State.CANCELLED]:
+            msg += f"\nCancelled, their dependencies failed: {resumed[State.CANCELLED]}"
+        return msg
 
     @staticmethod
-    @lock
+    @lock.write()
     def remove(args: argparse.Namespace):
         ids: List[int] = args.ids
+        array_ids: List[int] = getattr(args, "array_ids", None) or []
         verbose: int = args.verbose
         # extra kwargs from smtpserver.libclient
         user_login: str = args.extra_kwargs["user_login"]
 
-        df = JobsTable.read()
+        with JobsTable.transaction() as tr:
+            df = tr.df
+            selected = df.id.isin(ids) | df.array_id.isin(array_ids)
+            user_ids = df[selected & (df.user == user_login)].id.tolist()
+
+            msg = f"Removing {len(user_ids)} jobs ..."
+
+            tr.delete(user_ids)
+
+        return msg
+
+    @staticmethod
+    @lock.write()
+    def cancel(args: argparse.Namespace):
+        "Cancel waiting, blocked or paused jobs, and the jobs that depend on them"
+        ids: List[int] = args.ids
+        array_ids: List[int] = getattr(args, "array_ids", None) or []
+        verbose: int = args.verbose
+        # extra kwargs from smtpserver.libclient
+        user_login: str = args.extra_kwargs["user_login"]
 
-        new_df = df[~((df.id.isin(ids)) & (df.user == user_login))]
+        cancellable = [State.WAITING.value, State.BLOCKED.value, State.PAUSED.value]
+        with JobsTable.transaction() as tr:
+            df = tr.df
+            selected = df.id.isin(ids) | df.array_id.isin(array_ids)
+            user_ids = df[
+                selected & (df.user == user_login) & df.state.isin(cancellable)
+            ].id.tolist()
 
-        msg = f"Removing {df.shape[0] - new_df.shape[0]} jobs ..."
+            tr.update(user_ids, ftime=datetime.datetime.now())
+            tr.set_state(user_ids, State.CANCELLED)
 
-        JobsTable.write(new_df)
+        if array_ids:
+            msg = f"Cancelling {len(user_ids)} jobs of the arrays {array_ids}"
+        else:
+            msg = f"Cancelling {len(user_ids)} jobs: {user_ids}"
+
+        # Children cancelled by resolve_dependencies
+        cancelled = set(user_ids)
+        cascaded = [
+            id
+            for op, arg, values in tr.ops
+            if op == "update" and values.get("state") == State.CANCELLED.value
+            for id in arg
+            if id not in cancelled
+        ]
+        if cascaded:
+            msg += f"\nCancelling the jobs that depend on them: {cascaded}"
 
         return msg
 
+    @staticmethod
+    def array(args: argparse.Namespace):
+        """Number of tasks by state of the job arrays, newest first. The tasks
+        of the arrays with ids are listed with -vv"""
+        array_ids: List[int] = args.ids
+        verbose: int = args.verbose
+        df = JobsTable.snapshot()
+
+        tasks = df[df.array_id.notna()]
+        if array_ids:
+            tasks = tasks[tasks.array_id.isin(array_ids)]
+            archived = JobsHistory.read()
+            tasks = pd.concat([tasks, archived[archived.array_id.isin(array_ids)]])
+
+        if tasks.empty:
+            return f"Job arrays {array_ids} do not exist" if array_ids else "No job arrays"
+
+        tasks = astype_jobs(tasks).sort_values(by="id")
+        str_ = "Arrays:\n"
+        for array_id, group in reversed(list(tasks.groupby("array_id", sort=True))):
+            # Counts in the state order of JOB_DTYPES
+            counts = group.state.value_counts(sort=False)
+            states = ", ".join(
+                f"{State(int(state)).name.lower()}={count}"
+                for state, count in counts.items()
+                if count
+            )
+            str_ += f"  Array(id={int(array_id)}, user={group.user.iloc[0]}, tasks={group.shape[0]}, {states}, ctime={group.ctime.min():%m/%d-%H:%M})\n"
+
+            if array_ids and verbose > 1:
+                for row in group.values:
+                    str_ += f"    {get_job_repr([row], lvl=verbose)}\n"
+
+        return str_
+
     @staticmethod
     def show(args: argparse.Namespace):
         verbose: int = args.verbose
-        df = JobsTable.read()
+        df = JobsTable.snapshot()
 
         if "id" in args and args.id is not None:
-            if args.id in JobsTable.get_jobs_ids():
-                return get_job_repr(df.loc[df.id == args.id].values, lvl=verbose)
+            if args.id in df.id.tolist():
+                job = df.loc[df.id == args.id]
+                return get_job_repr(
+                    job.values, lvl=verbose, effective=effective_priority(job).iloc[0]
+                )
+
+            archived = JobsHistory.get([args.id])
+            if not archived.empty:
+                return get_job_repr(archived.values, lvl=verbose)
 
-            return f"Job with id={args.id} does not exist. Expected: {JobsTable.get_jobs_ids()}"
+            return f"Job with id={args.id} does not exist. Expected: {df.id.tolist()}"
 
         elif "state" in args and args.state is not None:
-            jobs = df[df.state == State.get_valid(args.state).value]
+            state = State.get_valid(args.state).value
+            jobs = df[df.state == state]
+            if state in ENDED_STATES:
+                archived = JobsHistory.read()
+                jobs = pd.concat([jobs, archived[archived.state == state]])
+
+            priority = effective_priority(jobs)
+            if DispatchIndex.AGING and state == State.WAITING.value:
+                order = np.lexsort((jobs.ctime.to_numpy(), -priority.to_numpy()))
+                jobs, priority = jobs.iloc[order], priority.iloc[order]
+
             str_ = "Jobs:\n"
-            for job in jobs.iterrows():
-                str_ += f"  {get_job_repr([job[1].values], lvl=verbose)}\n"
+            for row, effective in zip(jobs.values, priority):
+                str_ += f"  {get_job_repr([row], lvl=verbose, effective=effective)}\n"
             return str_
 
         else:
+            priority = effective_priority(df)
+            if DispatchIndex.AGING:  # Waiting jobs in the aged priority order
+                order = np.lexsort(
+                    (df.ctime.to_numpy(), -priority.to_numpy(), df.state.cat.codes)
+                )
+                df, priority = df.iloc[order], priority.iloc[order]
+
             str_ = "Jobs:\n"
-            for job in df.iterrows():
-                str_ += f"  {get_job_repr([job[1].values], lvl=verbose)}\n"
+            for row, effective in zip(df.values, priority):
+                str_ += f"  {get_job_repr([row], lvl=verbose, effective=effective)}\n"
             return str_
 
     @staticmethod
-    @lock
+    @lock.write()
     def clear(args: argparse.Namespace):
         yes: bool = args.yes
 
         if not yes:
             return "Aborting clear command ! If you are sure you want to clear all jobs run the same command with the flag -y or --yes"
 
-        JobsTable.write(JobsTable.get_empty_table())
+        # Deleted in a transaction so the dispatch and dependency indexes follow
+        with JobsTable.transaction() as tr:
+            tr.delete(tr.df.id.tolist())
         return "Clearing all jobs..."
 
     @staticmethod
-    @lock
+    @lock.write()
     def clear_state(args: argparse.Namespace):
         state: str = args.state
 
-        df = JobsTable.read()
-
-        msg = f"Clearing {df[df.state == State.get_valid(state).value ].shape[0]} jobs ..."
+        # The jobs that depend on the cleared ones are resolved in the same
+        # transaction (see resolve_dependencies)
+        with JobsTable.transaction() as tr:
+            df = tr.df
+            ids = df[df.state == State.get_valid(state).value].id.tolist()
+            tr.delete(ids)
 
-        df_wo_state = df[df.state != State.get_valid(state).value]
-
-        JobsTable.write(df_wo_state)
-
-        return msg
+        return f"Clearing {len(ids)} jobs ..."
 
     @staticmethod
-    @lock
+    @lock.write()
     def retry(args: argparse.Namespace):
         # return args
         id: int = args.id
+        gpu_mem: Union[float, str, None] = getattr(args, "gpu_mem", None)
         user_login: str = args.extra_kwargs["user_login"]
 
-        if id not in JobsTable.get_jobs_ids():
-            return f"The id={id} is not a valid job id. Expected: {JobsTable.get_jobs_ids()}"
-
-        df = JobsTable.read()
-
-        job = JobsTable.get_job(id)
+        msg = ""
+        with JobsTable.transaction() as tr:
+            df = tr.df
+
+            job = df[df.id == id]
+            if job.empty:
+                job = JobsHistory.get([id])
+
+            if job.empty:
+                return f"The id={id} is not a valid job id. Expected: {df.id.tolist()}"
+
+            if not job.state.isin(ENDED_STATES).values[0]:
+                return f"Job {id} is not yet finished..."
+
+            if job.user.values[0] != user_login:
+                return f"Only {job.user.values[0]} can retry this job..."
+
+            if gpu_mem is None:
+                gpu_mem = job.gpu_mem.values[0]
+            elif gpu_mem == "auto":
+                gpu_mem, runs = GpuProfiles.predict(
+                    job.command.values[0],
+                    job.env_path.values[0],
+                    job.working_dir.values[0],
+                )
+                if gpu_mem is None:
+                    return f"No past runs of job {id} to predict its gpu memory. Set --gpu_mem"
+                msg = f"Using gpu_mem={gpu_mem:,.0f} MB predicted from {runs} past runs\n"
+
+            new_row = JobsTable.new_job(
+                id=JobsTable.get_new_valid_id(),
+                user=user_login,
+                command=job.command.values[0],
+                priority=int(job.priority.values[0]),
+                gpu_mem=gpu_mem,
+                env_path=job.env_path.values[0],
+                working_dir=job.working_dir.values[0],
+            )
+            tr.insert(new_row)
 
-        if not job.state.isin([State.FINISHED.value, State.ERROR.value]).values[0]:
-            return f"Job {id} is not yet finished..."
+        return f"{msg}Retrying {get_job_repr(job.values)}\nAdding {get_job_repr(new_row.values)} ..."
 
-        if job.user.values[0] != user_login:
-            return f"Only {job.user.values[0]} can retry this job..."
+    @staticmethod
+    def history(args: argparse.Namespace):
+        "Show archived jobs, newest first"
+        verbose: int = args.verbose
 
-        new_args = argparse.Namespace(
-            command=[job.command.values[0]],
-            priority=int(job.priority.values[0]),
-            gpu_mem=job.gpu_mem.values[0],
-            verbose=1,
-            envname=job.env_path.values[0],
-            working_dir=job.working_dir.values[0],
-            extra_kwargs=dict(user_login=user_login),
-        )
+        df = JobsHistory.read(since=args.since, until=args.until)
 
-        msg = JobsTable.add(new_args)
+        if args.user is not None:
+            df = df[df.user == args.user]
+        if args.state is not None:
+            df = df[df.state == State.get_valid(args.state).value]
+        if args.limit is not None:
+            df = df.head(args.limit)
 
-        return f"Retrying {get_job_repr(job.values)}\n{msg}"
+        str_ = "Archived jobs:\n"
+        for row in df.values:
+            str_ += f"  {get_job_repr([row], lvl=verbose)}\n"
+        return str_
 
     # ================================================================= #
     # ================================================================= #
     # ================================================================= #
 
     @staticmethod
-    @lock
-    def set_job_state(id: int, state: Union[State, str]):
+    @lock.write()
+    def archive(older_than: datetime.timedelta) -> int:
+        """Move finished, errored and cancelled jobs that ended more than
+        older_than ago to the history. Returns the number of archived jobs"""
+        with JobsTable.transaction() as tr:
+            jobs = JobsHistory.select(tr.df, older_than)
+            JobsHistory.append(jobs)
+            tr.delete(jobs.id.tolist())
 
-        if id not in JobsTable.get_jobs_ids():
+        return jobs.shape[0]
+
+    @staticmethod
+    @lock.write()
+    def set_job_state(id: int, state: Union[State, str]):
+        if JobsTable.storage.get([id]).empty:
             raise ValueError(
                 f"The id={id} is not a valid job id. Expected: {JobsTable.get_jobs_ids()}"
             )
 
-        df = JobsTable.read()
-        df.loc[df.id == id, "state"] = State.get_valid(state).value
-
-        JobsTable.write(df)
+        with JobsTable.transaction() as tr:
+            tr.set_state([id], state)
 
     @staticmethod
-    @lock
+    @lock.write()
     def update_job(id: int, col: str, value: Any):
-        df = JobsTable.read()
-        assert col in df.columns, f"Invalid column: {col}"
+        assert col in JOB_COLUMNS, f"Invalid column: {col}"
 
-        if id not in JobsTable.get_jobs_ids():
+        if JobsTable.storage.get([id]).empty:
             raise ValueError(
                 f"The id={id} is not a valid job id. Expected: {JobsTable.get_jobs_ids()}"
             )
 
-        df.loc[df.id == id, col] = value
-
-        JobsTable.write(df)
+        with JobsTable.transaction() as tr:
+            tr.update([id], **{col: value})
 
     # ================================================================= #
     @staticmethod
-    @lock
+    @lock.write()
     def get_next_job() -> Union[pd.DataFrame, None]:
-        df = JobsTable.read()
-
-        if df.empty:
-            # No jobs
-            return
-
-        waiting_jobs = df[df.state == State.WAITING.value]
-        if waiting_jobs.empty:
-            # No pending jobs
+        job = JobsTable.peek_next_job()
+        if job is None or not JobsTable.claim_job(job.id.values[0]):
             return
 
-        job = waiting_jobs.head(1)
-
         # Update job state
         job.at[job.index[0], "state"] = State.RUNNING.value
 
-        # Update table
-        df[df.id == job.id.values[0]] = job
-        JobsTable.write(df)
-
         return job
 
+    @staticmethod
+    @lock.read()
+    def peek_next_job() -> Union[pd.DataFrame, None]:
+        "Next job to run without changing its state. None if no job is waiting"
+        return next(JobsTable.waiting_jobs(), None)
+
+    @staticmethod
+    def waiting_jobs(batch: int = 16) -> Iterator[pd.DataFrame]:
+        """Waiting jobs in dispatch order (see FairShare.order), one row at a
+        time. Walks the dispatch index lazily and reads the jobs in batches
+        that double in size, so a dispatch that stops early only reads about
+        the jobs it looked at. With fair share the batches are whole priority
+        bands, reordered by the usage of their users
+
+        The lock is only held while reading a batch, so jobs can be claimed
+        during the walk. Jobs that are not waiting anymore are skipped"""
+        JobsTable.sync_index()
+
+        now = time.time()
+        with closing(JobsTable.index.walk()) as keys:
+            ids, band = [], None
+            for key in keys:
+                if FairShare.HALF_LIFE:
+                    new_band = DispatchIndex.band(key, now)
+                    full = new_band != band
+                    band = new_band
+                else:
+                    full = len(ids) >= batch
+                if ids and full:
+                    yield from JobsTable.read_waiting(ids)
+                    ids, batch = [], 2 * batch
+                ids.append(key[2])
+
+            yield from JobsTable.read_waiting(ids)
+
+    @staticmethod
+    def read_waiting(ids: List[int]) -> Iterator[pd.DataFrame]:
+        "Jobs of ids that are still waiting in that order (or fair share order)"
+        if not ids:
+            return
+
+        with lock.read(), stats.timer("read"):
+            df = JobsTable.storage.get(ids)
+        df = df[df.state == State.WAITING.value].set_index("id", drop=False)
+        df = df.loc[[id for id in ids if id in df.index]].reset_index(drop=True)
+
+        df = FairShare.order(df)
+        for i in range(df.shape[0]):
+            yield df.iloc[[i]]
+
+    @staticmethod
+    @lock.write()
+    def claim_job(id: int, worker: Union[str, None] = None) -> bool:
+        """Set a waiting job as running and leased to worker. False if it is
+        not waiting anymore"""
+        job = JobsTable.storage.get([id])
+        if job.empty or job.state.values[0] != State.WAITING.value:
+            return False
+
+        # Update table and index
+        with JobsTable.transaction() as tr:
+            if worker is not None:
+                tr.update([id], worker=worker, heartbeat=datetime.datetime.now())
+            tr.set_state([id], State.RUNNING)
+
+        return True
+
     @staticmethod
     def get_jobs_ids() -> List[int]:
-        df = JobsTable.read()
-        return df.id.values
+        df = JobsTable.snapshot()
+        return df.id.tolist()
 
     @staticmethod
+    @lock.write()
     def get_new_valid_id() -> int:
         """Get a new id that does not exist yet"""
-        valid_id = 0
-        while valid_id in JobsTable.get_jobs_ids():
-            valid_id += 1
-        return valid_id
+        return JobsTable.get_new_valid_ids(1)[0]
+
+    @staticmethod
+    @lock.write()
+    def get_new_valid_ids(n: int) -> List[int]:
+        """Get n new ids from the persisted id sequence without reading the table"""
+        return JobsTable.storage.next_ids(n)
 
     @staticmethod
     def get_job(id: int) -> Union[pd.DataFrame, None]:
-        if id not in JobsTable.get_jobs_ids():
+        job = JobsTable.storage.get([id])
+        if job.empty:
             return
 
-        df = JobsTable.read()
-        job = df[df.id == id]
         return job
 
 
@@ -3,6 +3,7 @@ from copy import deepcopy
 from easydict import EasyDict as EDict
 
 from .common import UTF8, MessageABC, callable_operations, operations
+from .stats import stats
 
 
 class ServerMessage(MessageABC):
@@ -41,7 +42,8 @@ class ServerMessage(MessageABC):
                 server_response_msg += f"{k}={v}, "
             server_response_msg += f")"
 
-            return_msg = callable_operations[operation](op_kwargs)
+            with stats.tag(operation):
+                return_msg = callable_operations[operation](op_kwargs)
 
             content = {"server_response": return_msg or ""}
             # content = {"server_response": server_response_msg}
@@ -0,0 +1,132 @@
+import fcntl
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Union
+
+from .stats import stats
+
+__all__ = ["RWLock"]
+
+
+class RWLock:
+    """Shared/exclusive lock between processes using fcntl.flock
+
+    Readers hold the lock file shared so they run in parallel and writers hold
+    it exclusively. Both first pass through a turnstile file that a writer keeps
+    while it waits for the readers to leave, so a steady stream of readers can
+    not starve the writers.
+
+    The lock is reentrant: reads and writes inside a write and reads inside a
+    read are free. Taking the write lock while only holding the read lock raises
+    a RuntimeError because flock upgrades are not atomic.
+
+    Usage:
+        lock = RWLock("/var/tmp/jobs_queue/jobs_table.csv.lock")
+
+        with lock.read():
+            ...
+
+        @lock.write()
+        def func():
+            ...
+    """
+
+    SHARED = "shared"
+    EXCLUSIVE = "exclusive"
+
+    def __init__(self, path: Union[Path, str]) -> None:
+        self.path = Path(path)
+        self.turnstile_path = self.path.with_name(self.path.name + ".turnstile")
+
+        self._thread_lock = threading.RLock()
+        self._pid = None
+        self._fd = None
+        self._turnstile_fd = None
+        self._mode = None
+        self._depth = 0
+        self._acquired = None  # perf_counter when the lock was taken, if stats enabled
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(path={self.path}, mode={self._mode})"
+
+    @staticmethod
+    def _open(path: Path) -> int:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        # Read, Write permissions so other users can take the lock
+        try:
+            os.chmod(path, 0o666)
+        except PermissionError:
+            ...
+        return fd
+
+    def _check_fds(self) -> None:
+        # Forked processes share the open file descriptions (and their locks)
+        # with the parent, so each process opens its own
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._fd = self._open(self.path)
+            self._turnstile_fd = self._open(self.turnstile_path)
+            self._mode = None
+            self._depth = 0
+
+    def _acquire(self, mode: str) -> None:
+        self._check_fds()
+
+        if self._depth > 0:
+            if mode == self.EXCLUSIVE and self._mode == self.SHARED:
+                raise RuntimeError("Can not take the write lock while holding the read lock")
+            self._depth += 1
+            return
+
+        start = time.perf_counter() if stats.enabled else None
+        fcntl.flock(self._turnstile_fd, fcntl.LOCK_EX)
+        try:
+            fcntl.flock(
+                self._fd, fcntl.LOCK_EX if mode == self.EXCLUSIVE else fcntl.LOCK_SH
+            )
+        finally:
+            fcntl.flock(self._turnstile_fd, fcntl.LOCK_UN)
+
+        self._mode = mode
+        self._depth = 1
+
+        if start is not None:
+            self._acquired = time.perf_counter()
+            stats.record("lock_wait", self._acquired - start)
+
+    def _release(self) -> None:
+        self._depth -= 1
+        if self._depth == 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._mode = None
+
+            if self._acquired is not None:
+                stats.record("lock_hold", time.perf_counter() - self._acquired)
+                self._acquired = None
+
+    @contextmanager
+    def _locked(self, mode: str):
+        with self._thread_lock:
+            self._acquire(mode)
+            try:
+                yield self
+            finally:
+                self._release()
+
+    def read(self):
+        "Shared lock. Context manager or decorator"
+        return self._locked(self.SHARED)
+
+    def write(self):
+        "Exclusive lock. Context manager or decorator"
+        return self._locked(self.EXCLUSIVE)
+
+    @property
+    def is_locked(self) -> bool:
+        return self._depth > 0 and self._pid == os.getpid()
+
+
+# ENDFILE
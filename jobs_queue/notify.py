@@ -0,0 +1,101 @@
+import os
+import select
+import socket
+import struct
+import time
+from contextlib import suppress
+from typing import Union
+
+from . import JOBS_TABLE_FILENAME
+
+__all__ = ["WAKEUP_DIR", "Waiter", "notify"]
+
+# One unix datagram socket per waiting scheduler process (<pid>.sock)
+WAKEUP_DIR = JOBS_TABLE_FILENAME.parent / "wakeup"
+
+MESSAGE = struct.Struct("!d")  # time.time() of the change
+
+
+def notify() -> None:
+    "Wake up every waiting scheduler. Never blocks"
+    paths = list(WAKEUP_DIR.glob("*.sock"))
+    if not paths:
+        return
+
+    message = MESSAGE.pack(time.time())
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        for path in paths:
+            try:
+                sock.sendto(message, str(path))
+            except ConnectionRefusedError:  # The scheduler is gone
+                with suppress(OSError):
+                    path.unlink()
+            except (BlockingIOError, FileNotFoundError, PermissionError):
+                # Queue full means that a wake up is already pending
+                ...
+
+
+class Waiter:
+    """Socket a scheduler sleeps on until the jobs queue changes
+
+    Usage:
+        with Waiter() as waiter:
+            while True:
+                waiter.wait(timeout=60)
+                ...
+    """
+
+    def __init__(self) -> None:
+        WAKEUP_DIR.mkdir(mode=0o775, parents=True, exist_ok=True)
+        self.path = WAKEUP_DIR / f"{os.getpid()}.sock"
+        with suppress(FileNotFoundError):
+            self.path.unlink()
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(str(self.path))
+        self.sock.setblocking(False)
+        # Read, Write permissions so other users can wake up the scheduler
+        try:
+            os.chmod(self.path, 0o666)
+        except PermissionError:
+            ...
+
+    def __enter__(self) -> "Waiter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def wait(self, timeout: float) -> Union[float, None]:
+        """Block until notified or for timeout seconds. Returns immediately if
+        notifications arrived since the last call
+
+        Returns the time of the oldest pending change or None on timeout"""
+        ready, _, _ = select.select([self.sock], [], [], timeout)
+        if not ready:
+            return
+
+        return self.drain()
+
+    def drain(self) -> Union[float, None]:
+        "Consume the pending notifications. Returns the time of the oldest one"
+        times = []
+        while True:
+            try:
+                times.append(MESSAGE.unpack(self.sock.recv(MESSAGE.size))[0])
+            except BlockingIOError:
+                break
+
+        return min(times, default=None)
+
+    def close(self) -> None:
+        self.sock.close()
+        with suppress(FileNotFoundError):
+            self.path.unlink()
+
+
+# ENDFILE
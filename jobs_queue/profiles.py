@@ -0,0 +1,68 @@
+import json
+import math
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+from . import JOBS_TABLE_FILENAME
+from .locks import RWLock
+from .storage import replace_file
+
+__all__ = ["PROFILES_FILENAME", "GpuProfiles"]
+
+# Observed peak gpu memory (MB) of the last runs of every command
+PROFILES_FILENAME = JOBS_TABLE_FILENAME.parent / "gpu_profiles.json"
+
+
+class GpuProfiles:
+    """Peak gpu memory of the jobs that finished successfully, keyed by their
+    normalized command, env_path and working_dir. Predicts the gpu_mem of
+    `jobsclient add --gpu_mem auto` as the p95 of the past peaks plus a margin"""
+
+    lock = RWLock(PROFILES_FILENAME.with_suffix(".json.lock"))
+    MAX_RUNS = 20  # Peaks kept by key
+    QUANTILE = 95
+    MARGIN = 0.1  # Fraction of the predicted peak
+    MIN_MARGIN = 256  # MB
+
+    @staticmethod
+    def key(command: str, env_path: str, working_dir: str) -> str:
+        return "\n".join([" ".join(str(command).split()), str(env_path), str(working_dir)])
+
+    @staticmethod
+    def read() -> Dict[str, List[float]]:
+        try:
+            with open(PROFILES_FILENAME) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    @staticmethod
+    @lock.write()
+    def record(command: str, env_path: str, working_dir: str, peak: float) -> None:
+        profiles = GpuProfiles.read()
+        peaks = profiles.setdefault(GpuProfiles.key(command, env_path, working_dir), [])
+        peaks.append(float(peak))
+        del peaks[: -GpuProfiles.MAX_RUNS]
+
+        PROFILES_FILENAME.parent.mkdir(mode=0o775, parents=True, exist_ok=True)
+        replace_file(PROFILES_FILENAME, lambda f: json.dump(profiles, f))
+
+    @staticmethod
+    def predict(
+        command: str, env_path: str, working_dir: str
+    ) -> Tuple[Union[float, None], int]:
+        "Predicted gpu_mem (MB) and the number of past runs. None without runs"
+        peaks = GpuProfiles.read().get(GpuProfiles.key(command, env_path, working_dir), [])
+        if not peaks:
+            return None, 0
+
+        peak = float(np.percentile(peaks, GpuProfiles.QUANTILE))
+        if peak == 0:  # Does not use the gpus
+            return 0.0, len(peaks)
+
+        margin = max(peak * GpuProfiles.MARGIN, GpuProfiles.MIN_MARGIN)
+        return float(math.ceil(peak + margin)), len(peaks)
+
+
+# ENDFILE
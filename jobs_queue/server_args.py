@@ -1,4 +1,5 @@
 import argparse
+import signal
 from typing import List
 
 __all__ = [
@@ -29,6 +30,17 @@ class VerboseAction(argparse.Action):
         setattr(args, self.dest, max(self.option_dict.values()))
 
 
+def get_signal(name: str) -> signal.Signals:
+    "Signal from its name (SIGTERM, TERM) or number"
+    if name.isdecimal():
+        return signal.Signals(int(name))
+    name = name.upper()
+    try:
+        return signal.Signals[name if name.startswith("SIG") else f"SIG{name}"]
+    except KeyError:
+        raise ValueError(f"Unknown signal: {name}")
+
+
 def get_server_parser():
     parser = argparse.ArgumentParser(
         "Server Jobs Queue",
@@ -39,13 +51,75 @@ def get_server_parser():
         type=int,
         nargs="?",
         default=60,
-        help="Idle time (s). NOTE: It is recommended to use at least 60 seconds of interval time when using this tool to train diferent experiments using gpus so they have enough time to load the model and data instead of throwing an error.",
+        help="Idle time (s). The server wakes up as soon as jobs are added, resumed or finish, this is only the longest wait between checks of the queue. The gpu_mem of started jobs stays reserved until they allocate it, so jobs can start back to back.",
     )
     parser.add_argument(
         "--threads",
         type=int,
         default=1,
-        help="Number of jobs allowed to run at the same time",
+        help="Maximum number of jobs running at the same time. Jobs are started while they fit in the free gpu memory",
+    )
+    parser.add_argument(
+        "--no_backfill",
+        action="store_true",
+        help="Start jobs strictly in queue order. By default jobs that fit start while the next job waits for gpu memory",
+    )
+    parser.add_argument(
+        "--lease",
+        type=float,
+        default=60,
+        help="Seconds without heartbeat after which the running jobs of a lost server are recovered",
+    )
+    parser.add_argument(
+        "--on_lost",
+        type=str,
+        choices=["requeue", "error"],
+        default="requeue",
+        help="What to do with the running jobs of a lost server whose process is gone",
+    )
+    parser.add_argument(
+        "--sample_interval",
+        type=float,
+        default=0.5,
+        help="Seconds between samples of the gpus memory. The server keeps one nvidia-smi (or NVML) sampler running and publishes its samples for every client",
+    )
+    parser.add_argument(
+        "--free_window",
+        type=float,
+        default=0,
+        help="Use the minimum free memory of each gpu over the last FREE_WINDOW seconds instead of the last sample, so memory that is freed only for a moment is not handed out. Memory freed by finished jobs is also reused only after the window. 0 (default) uses the last sample",
+    )
+    parser.add_argument(
+        "--fair_share",
+        type=float,
+        default=0,
+        help="Half-life (hours) of the gpu memory-seconds used by each user. Within a priority, the jobs of the users that used less go first. 0 (default) keeps the queue order",
+    )
+    parser.add_argument(
+        "--aging",
+        type=float,
+        default=0,
+        metavar="RATE",
+        help="Priority levels a waiting job gains per hour of waiting, so LOW jobs eventually run before new HIGH and URGENT ones. Give the same RATE to jobsserver-cmds so `show` displays the same order. 0 (default) disables aging",
+    )
+    parser.add_argument(
+        "--preempt",
+        type=get_signal,
+        default=None,
+        metavar="SIGNAL",
+        help="Preempt lower priority running jobs for URGENT jobs that do not fit. Their process group gets SIGNAL (e.g. SIGTERM or SIGUSR1 to checkpoint) and they wait again in the queue. Disabled by default",
+    )
+    parser.add_argument(
+        "--preempt_grace",
+        type=float,
+        default=60,
+        help="Seconds preempted jobs have to stop before they are killed",
+    )
+    parser.add_argument(
+        "--archive_after",
+        type=float,
+        default=24,
+        help="Move finished, errored and cancelled jobs to the history after this many hours",
     )
     return parser
 
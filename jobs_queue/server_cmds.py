@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 
+import argparse
 import datetime
 import selectors
 import socket
 import traceback
 
 from .common import HOST, PORT
+from .dispatch import DispatchIndex
 from .lib_smtp_server import ServerMessage
 
 
@@ -53,7 +55,24 @@ def start_connection(sel):
     sel.register(lsock, selectors.EVENT_READ, data=None)
 
 
+def get_parser():
+    parser = argparse.ArgumentParser(
+        "Server Jobs Commands", description="Run the commands of the jobs clients"
+    )
+    parser.add_argument(
+        "--aging",
+        type=float,
+        default=0,
+        metavar="RATE",
+        help="Aging RATE of the jobs server (see jobsserver-queue --aging), so `show` displays the effective priority and order of the waiting jobs",
+    )
+    return parser
+
+
 def main():
+    args = get_parser().parse_args()
+    DispatchIndex.AGING = args.aging
+
     sel = selectors.DefaultSelector()
 
     start_connection(sel)
@@ -1,20 +1,31 @@
 #!/usr/bin/env python
 
 
+import asyncio
 import datetime
 import os
 import pwd
-import subprocess
+import signal
+import socket
 import time
+from contextlib import suppress
 from enum import Enum
-from multiprocessing import Process
 from pathlib import Path
-from typing import Union
+from typing import Awaitable, Dict, Iterable, List, Set, Tuple, Union
 
-from .gpu_memory import GpuManager, GpuMemoryOutOfRange, wait_for_free_space
+import pandas as pd
+import psutil
+
+from .dispatch import DispatchIndex
+from .fairshare import FairShare
+from .gpu_memory import GpuManager, GpuMemoryOutOfRange
+from .gpu_sampler import GpuSampler, read_snapshot
+from .jobs import Priority
 from .jobs import State as JobState
 from .jobs import get_job_repr
 from .jobs_table import JOBS_TABLE_FILENAME, JobsTable
+from .notify import Waiter
+from .profiles import GpuProfiles
 from .server_args import get_args
 from .tools import ftext
 
@@ -40,7 +51,13 @@ class Log(Enum):
         print(str_)
 
 
-def get_process_as_user(cmd: str, username: str, working_dir: str):
+async def start_process_as_user(
+    cmd: str,
+    username: str,
+    working_dir: str,
+    env_vars: Dict[str, str] = dict(),
+    new_session: bool = False,
+) -> asyncio.subprocess.Process:
     def demote(user_uid: int, user_gid: int):
         def result():
             os.setgid(user_gid)
@@ -56,139 +73,692 @@ def get_process_as_user(cmd: str, username: str, working_dir: str):
     env["LOGNAME"] = pw_record.pw_name
     env["PWD"] = working_dir
     env["USER"] = pw_record.pw_name
+    env.update(env_vars)
 
-    process = subprocess.Popen(
+    # Shell to use cmd as a string and catch errors in the scheduler
+    process = await asyncio.create_subprocess_shell(
         cmd,
         preexec_fn=demote(pw_record.pw_uid, pw_record.pw_gid),
         cwd=working_dir,
         env=env,
-        shell=True,  # To use cmd as a string and catch errors in main func
+        start_new_session=new_session,
     )
 
     return process
 
 
-def run_server(sleep_time: int = 60):
-    # os.umask(0000)  # so everyone can read, write and execute
+def finish_job(id: int, state: JobState) -> None:
+    "Clear the job pid and set its finished time and state in a single write"
+    with JobsTable.transaction() as tr:
+        tr.update([id], pid=None, ftime=datetime.datetime.now())
+        tr.set_state([id], state)
+
+
+def is_job_process(pid: int, stime: pd.Timestamp) -> bool:
+    "True if the job process is still alive in this host"
+    if pd.isna(pid):
+        return False
+
+    try:
+        process = psutil.Process(int(pid))
+        if process.status() == psutil.STATUS_ZOMBIE:
+            return False
+        create_time = process.create_time()
+    except psutil.Error:
+        return False
 
-    log_path = JOBS_TABLE_FILENAME.with_suffix(".log")
-    # Read, Write, Execute permissions so other users can change the files
-    log_path.touch(0o775)
+    # Pids are reused. The job process was created before its start time was stored
+    return pd.isna(stime) or create_time <= stime.to_pydatetime().timestamp() + 1
 
-    server_state = State.IDLE
 
+async def wait_process_group(pgid: int, poll_time: float = 0.2) -> None:
+    "Wait until every process of a process group is gone"
     while True:
         try:
-            time.sleep(sleep_time)
-            job = JobsTable.get_next_job()
+            os.killpg(pgid, 0)
+        except ProcessLookupError:
+            return
+        await asyncio.sleep(poll_time)
+
+
+async def wait_process(pid: int, poll_time: float = 1) -> None:
+    "Wait for a process that is not a child of the scheduler. Its return code is unknown"
+    while is_job_process(pid, pd.NaT):
+        await asyncio.sleep(poll_time)
+
+
+def get_device_arg(gpu_mem: float, device: Union[int, Tuple[int, ...], None]) -> str:
+    # TODO: Add other options to use the device. Also maybe customizable
+    # by user in settings
+    if gpu_mem == 0.0:
+        return ""  # FIXME : Use 'cpu' or ''
+    elif isinstance(device, tuple):
+        return ""  # --data_parallel over the CUDA_VISIBLE_DEVICES
+    else:
+        return f"cuda:{device}"  # --device cuda:{device}
+
+
+def get_device_env(device: Union[int, Tuple[int, ...], None]) -> Dict[str, str]:
+    "Limit multi gpu jobs to their gpus. Single gpu jobs get the device as argument"
+    if not isinstance(device, tuple):
+        return dict()
+
+    return dict(
+        # Same gpu ids as nvidia-smi
+        CUDA_DEVICE_ORDER="PCI_BUS_ID",
+        CUDA_VISIBLE_DEVICES=",".join(str(gpu_id) for gpu_id in device),
+    )
 
-            if job is None and server_state is not State.IDLE:
-                # No jobs to run
-                server_state = State.IDLE
 
-                # Log
-                Log.INFO(f"Idle ...\n", log_path)
+class Scheduler:
+    """Runs up to max_jobs jobs of the queue at the same time from a single
+    process. Jobs are started as asyncio subprocesses and awaited together
+
+    The scheduler sleeps until the jobs queue changes (see notify.Waiter) or a
+    job finishes, and sleep_time seconds at most. Each dispatch round starts
+    jobs in queue order while they fit in one shared nvidia-smi snapshot. The
+    gpu_mem of the started jobs stays reserved in GpuManager.ledger until they
+    finish, so jobs that did not allocate it yet are not given the same memory
+
+    Running jobs are leased to the scheduler that started them (worker column,
+    host:pid) which renews their heartbeat every lease / 4 seconds. Running jobs
+    of other workers are recovered once their heartbeat is older than lease or
+    their worker process is gone: jobs whose process is still alive are adopted
+    and the others are requeued (or set as errored with on_lost="error")
+    """
+
+    def __init__(
+        self,
+        sleep_time: int = 60,
+        archive_after: float = 24,
+        max_jobs: int = 1,
+        lease: float = 60,
+        on_lost: str = "requeue",
+        backfill: bool = True,
+        sample_interval: float = 0.5,
+        free_window: float = 0,
+        fair_share: float = 0,
+        preempt: Union[signal.Signals, None] = None,
+        preempt_grace: float = 60,
+        aging: float = 0,
+    ) -> None:
+        self.sleep_time = sleep_time
+        self.archive_after = archive_after
+        self.max_jobs = max_jobs
+        self.lease = lease
+        self.on_lost = on_lost
+        self.backfill = backfill
+        self.sampler = GpuSampler(sample_interval)
+        self.free_window = free_window
+        GpuManager.FREE_WINDOW = free_window
+        FairShare.HALF_LIFE = fair_share
+        DispatchIndex.AGING = aging
+        self.preempt = preempt
+        self.preempt_grace = preempt_grace
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+
+        self.log_path = JOBS_TABLE_FILENAME.with_suffix(".log")
+        # Read, Write, Execute permissions so other users can change the files
+        self.log_path.touch(0o775)
+
+        self.state = State.IDLE
+        self.running: Dict[int, asyncio.Task] = dict()  # job id: supervisor task
+        self.wakeup: Union[asyncio.Event, None] = None
+        self.peaks: Dict[int, float] = dict()  # job id: peak gpu memory (MB)
+        # job id: (user, gpu_mem, time.time() of the last fair share charge)
+        self.charged: Dict[int, Tuple[str, float, float]] = dict()
+        self.changed: Union[float, None] = None  # Time of the oldest queue change
+        # Jobs started by this scheduler. job id: (job, pid, time.time() started)
+        self.jobs: Dict[int, Tuple[pd.DataFrame, int, float]] = dict()
+        self.preempting: Dict[int, int] = dict()  # victim job id: urgent job id
+        self.killers: Set[asyncio.Task] = set()  # Kill victims after the grace period
+        self.archived_at = 0.0  # time.monotonic() of the last archive
+
+    def log(self, log: Log, log_str: str) -> None:
+        log(log_str, self.log_path)
+
+    def on_notify(self, waiter: Waiter) -> None:
+        changed = waiter.drain()
+        if changed is not None:
+            self.changed = changed if self.changed is None else min(self.changed, changed)
+        self.wakeup.set()
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.wakeup.set()  # Look for waiting jobs right away
+
+        leases = asyncio.create_task(self.keep_leases())
+        sampling = asyncio.create_task(self.keep_sampling())
+        # Otherwise another server is already publishing the gpus snapshot
+        if self.sampler.start():
+            self.log(Log.INFO, f"Sampling the gpus with {self.sampler.backend}\n")
+
+        with Waiter() as waiter:
+            loop.add_reader(waiter.fileno(), self.on_notify, waiter)
+            try:
+                while True:
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), self.sleep_time)
+                    except asyncio.TimeoutError:
+                        ...
+
+                    self.wakeup.clear()
+                    await self.dispatch()
+                    self.changed = None
+
+                    # On its own clock since job events can keep waking the loop
+                    # up before sleep_time. After the dispatch to keep it out of
+                    # the dispatch latency
+                    if time.monotonic() - self.archived_at >= self.sleep_time:
+                        self.archive()
+
+            finally:
+                loop.remove_reader(waiter.fileno())
+                self.sampler.stop()
+                leases.cancel()
+                sampling.cancel()
+                for task in [*self.running.values(), *self.killers]:
+                    task.cancel()
+                await asyncio.gather(
+                    leases, sampling, *self.running.values(), return_exceptions=True
+                )
+
+    def archive(self) -> None:
+        "Keep only the waiting, blocked, paused and running jobs in the jobs table"
+        self.archived_at = time.monotonic()
+        try:
+            archived = JobsTable.archive(datetime.timedelta(hours=self.archive_after))
+        except Exception as e:  # Try again on the next archive
+            self.log(Log.ERROR, f"Archive: {e!r}\n")
+            return
+
+        if archived:
+            self.log(Log.INFO, f"Moved {archived} jobs to the history\n")
+
+    async def keep_leases(self) -> None:
+        while True:
+            try:
+                self.renew_leases()
+                self.reap()
+                self.charge_usage()
+            except Exception as e:  # Try again on the next heartbeat
+                self.log(Log.ERROR, f"Leases: {e!r}\n")
+
+            await asyncio.sleep(self.lease / 4)
+
+    async def keep_sampling(self) -> None:
+        """Load the samples of the gpus between dispatches, for the windowed free
+        memory and for the peak gpu memory of the running jobs. Only reads the
+        published snapshot (see GpuSampler), nothing is sampled without it"""
+        while True:
+            if self.free_window > 0 or GpuManager.ledger:
+                try:
+                    snapshot = read_snapshot()
+                    if snapshot is not None:
+                        GpuManager.load(snapshot)
+                        self.update_peaks()
+                except Exception as e:
+                    self.log(Log.ERROR, f"Gpus sampling: {e!r}\n")
+
+            await asyncio.sleep(self.sampler.interval)
+
+    def update_peaks(self) -> None:
+        "Peak gpu memory used by each started job (its pid and children)"
+        for id, usage in GpuManager.USED_by_job.items():
+            self.peaks[id] = max(self.peaks.get(id, 0), sum(usage.values()))
+
+    def record_peak(self, job: pd.DataFrame) -> None:
+        "Store the peak of a successful job for `--gpu_mem auto`"
+        peak = self.peaks.get(int(job.id.values[0]))
+        if peak is None or not GpuManager.TOTAL_single:  # Never sampled or no gpus
+            return
 
+        try:
+            GpuProfiles.record(
+                job.command.values[0],
+                job.env_path.values[0],
+                job.working_dir.values[0],
+                peak,
+            )
+        except Exception as e:
+            self.log(Log.ERROR, f"Recording the gpu memory peak: {e!r}\n")
+
+    def charge_usage(self, ids: Union[Iterable[int], None] = None) -> None:
+        "Charge the usage of the running jobs (or ids) since their last charge"
+        if not FairShare.HALF_LIFE:
+            return
+
+        now = time.time()
+        charges = dict()
+        for id in list(self.charged if ids is None else ids):
+            if id not in self.charged:
+                continue
+            user, gpu_mem, since = self.charged[id]
+            charges[user] = charges.get(user, 0.0) + gpu_mem * (now - since)
+            self.charged[id] = (user, gpu_mem, now)
+
+        FairShare.charge(charges, now)
+
+    def track_usage(self, job: pd.DataFrame, since: float) -> None:
+        self.charged[int(job.id.values[0])] = (
+            str(job.user.values[0]),
+            float(job.gpu_mem.values[0]),
+            since,
+        )
+
+    def renew_leases(self) -> None:
+        if not self.running:
+            return
+
+        with JobsTable.transaction() as tr:
+            jobs = JobsTable.storage.get(self.running.keys())
+            ids = jobs[jobs.worker == self.worker].id.tolist()
+            if ids:
+                tr.update(ids, heartbeat=datetime.datetime.now())
+
+    def is_lost(self, worker: Union[str, None], heartbeat: pd.Timestamp) -> bool:
+        "True if the worker holding a lease stopped renewing it or is gone"
+        if pd.isna(worker) or pd.isna(heartbeat):
+            return True
+
+        if datetime.datetime.now() - heartbeat > datetime.timedelta(seconds=self.lease):
+            return True
+
+        # The heartbeat may be recent but the server already gone
+        host, _, pid = worker.rpartition(":")
+        return host == socket.gethostname() and not psutil.pid_exists(int(pid))
+
+    def lost_jobs(self, df: pd.DataFrame) -> pd.DataFrame:
+        running = df[
+            (df.state == JobState.RUNNING.value) & ~df.id.isin(self.running.keys())
+        ]
+        return running[
+            [self.is_lost(w, h) for w, h in zip(running.worker, running.heartbeat)]
+        ]
+
+    def reap(self) -> None:
+        "Recover the running jobs of lost workers"
+        if self.lost_jobs(JobsTable.snapshot()).empty:  # Without the lock
+            return
+
+        now = datetime.datetime.now()
+        adopted, requeued, errored = [], [], []
+        with JobsTable.transaction() as tr:
+            lost = self.lost_jobs(tr.df)
+            for id, pid, stime in zip(lost.id, lost.pid, lost.stime):
+                if is_job_process(pid, stime):
+                    adopted.append(int(id))
+                elif self.on_lost == "requeue":
+                    requeued.append(int(id))
+                else:
+                    errored.append(int(id))
+
+            if adopted:
+                tr.update(adopted, worker=self.worker, heartbeat=now)
+            if requeued:
+                # Same ctime so they keep their place in the queue
+                tr.update(requeued, pid=None, stime=None, worker=None, heartbeat=None)
+                tr.set_state(requeued, JobState.WAITING)
+            if errored:
+                tr.update(errored, pid=None, ftime=now)
+                tr.set_state(errored, JobState.ERROR)
+
+        for id in adopted:
+            job = lost[lost.id == id]
+            pid = int(job.pid.values[0])
+            self.track_usage(job, time.time())
+            self.running[id] = asyncio.create_task(
+                self.supervise(job, wait_process(pid), adopted=True)
+            )
+            self.log(Log.INFO, f"Adopted job of a lost server: {get_job_repr(job.values, 1)}\n")
+        for ids, action in [(requeued, "Requeued"), (errored, "Set as errored")]:
+            if ids:
+                self.log(Log.INFO, f"{action} running jobs of a lost server: {ids}\n")
+
+    @staticmethod
+    def get_devices(gpu_mem: float, device: Union[int, Tuple[int, ...]]) -> Dict[int, float]:
+        "Memory the job takes from each gpu. {gpu id: MB}"
+        if isinstance(device, tuple):  # Split evenly over the gpus
+            return {gpu_id: gpu_mem / len(device) for gpu_id in device}
+        return {device: gpu_mem}
+
+    @staticmethod
+    def head_devices(gpu_mem: float, free: Dict[int, float]) -> Set[int]:
+        """Gpus kept for a job that does not fit yet: the gpus closest to fit
+        it, as few as its gpu_mem split evenly needs"""
+        gpu_ids = sorted(free, key=lambda gpu_id: free[gpu_id], reverse=True)
+        for n in range(1, len(gpu_ids) + 1):
+            fit = [g for g in gpu_ids if gpu_mem / n <= GpuManager.TOTAL_single[g]]
+            if len(fit) >= n:
+                return set(fit[:n])
+
+        return set(gpu_ids)
+
+    def can_preempt(self, job: pd.DataFrame) -> bool:
+        return (
+            self.preempt is not None
+            and int(job.priority.values[0]) == Priority.URGENT.value
+        )
+
+    def preemption_victims(self, job: pd.DataFrame, free: Dict[int, float]) -> List[int]:
+        """Cheapest set of lower priority running jobs that job fits in once
+        stopped, or [] if there is none. The cost of a victim is the work it
+        loses (gpu_mem * seconds running), lower priorities are taken first.
+        The set is never empty, so it also frees a slot on a full server"""
+        gpu_mem = float(job.gpu_mem.values[0])
+        fits = lambda free: gpu_mem <= 0 or GpuManager.select_device(gpu_mem, free) is not False
+
+        now = time.time()
+        candidates = []
+        for id, (victim, _, started) in self.jobs.items():
+            priority = int(victim.priority.values[0])
+            if id in self.preempting or priority >= Priority.URGENT.value:
+                continue
+            devices = GpuManager.ledger.reservations.get(id, (None, dict()))[1]
+            cost = float(victim.gpu_mem.values[0]) * (now - started)
+            candidates.append((priority, cost, id, devices))
+
+        def freed(victims: List[Tuple[int, Dict[int, float]]]) -> Dict[int, float]:
+            free_ = dict(free)
+            for _, devices in victims:
+                for gpu_id, reserved in devices.items():
+                    free_[gpu_id] = free_.get(gpu_id, 0) + reserved
+            return free_
+
+        # Take the cheapest victims until the job fits
+        victims = []
+        for _, _, id, devices in sorted(candidates):
+            if victims and fits(freed(victims)):
+                break
+            victims.append((id, devices))
+
+        if not victims or not fits(freed(victims)):
+            return []
+
+        # Spare the victims that are not needed, most expensive first
+        for victim in reversed(list(victims)):
+            rest = [v for v in victims if v is not victim]
+            if rest and fits(freed(rest)):
+                victims = rest
+
+        return [id for id, _ in victims]
+
+    def preempt_jobs(self, job: pd.DataFrame, victims: List[int]) -> None:
+        "Signal the process group of the victims. They are killed after the grace period"
+        id = int(job.id.values[0])
+        for victim in victims:
+            pid = self.jobs[victim][1]
+            self.preempting[victim] = id
+            with suppress(ProcessLookupError):
+                os.killpg(pid, self.preempt)
+
+            task = asyncio.create_task(self.kill_after_grace(victim, pid))
+            self.killers.add(task)
+            task.add_done_callback(self.killers.discard)
+
+        self.log(
+            Log.INFO,
+            f"Preempting jobs {victims} ({self.preempt.name}, {self.preempt_grace} s grace) for {get_job_repr(job.values, 1)}\n",
+        )
+
+    async def kill_after_grace(self, id: int, pid: int) -> None:
+        await asyncio.sleep(self.preempt_grace)
+        if id in self.preempting:  # Its processes may outlive the job shell
+            with suppress(ProcessLookupError):
+                os.killpg(pid, signal.SIGKILL)
+                self.log(Log.INFO, f"Killed preempted job {id} after the grace period\n")
+
+    async def dispatch(self) -> None:
+        """Start waiting jobs in queue order while there are free slots and
+        they fit in the gpus
+
+        With backfill, the first job that does not fit (head) keeps a slot and
+        its gpus (see head_devices) and the jobs behind it are started if they
+        fit in the other gpus. Nothing new starts on the head gpus, so it
+        starts as soon as the jobs already running there free enough memory"""
+        free = None  # Gpus snapshot. Only taken if a job needs gpu memory
+        head = set()  # Gpus kept for the blocked head job
+        blocked = False
+
+        waiting = JobsTable.waiting_jobs()
+        for job in waiting:
+            id = int(job.id.values[0])
+            gpu_mem = float(job.gpu_mem.values[0])
+            urgent = self.can_preempt(job)
+
+            full = len(self.running) >= self.max_jobs - blocked
+            if full and not urgent:
+                if self.preempt is None:
+                    break
+                continue  # Urgent jobs behind may preempt
+
+            device, available = None, dict()
+            if gpu_mem > 0:
+                if free is None:
+                    GpuManager.update()
+                    free = GpuManager.available_single()
+
+                try:
+                    available = {g: f for g, f in free.items() if g not in head}
+                    device = GpuManager.select_device(gpu_mem, available)
+                except GpuMemoryOutOfRange:
+                    # Update job pid, finished time and state
+                    finish_job(id, state=JobState.ERROR)
+                    self.log(
+                        Log.ERROR,
+                        f"GpuMemoryOutOfRange(Requested={gpu_mem} MB, Available={GpuManager.TOTAL} MB) \n",
+                    )
+                    continue
+
+            if urgent and (full or device is False):
+                if id not in self.preempting.values():
+                    victims = self.preemption_victims(job, available)
+                    if victims:
+                        self.preempt_jobs(job, victims)
+
+                if id in self.preempting.values():
+                    # Keep a slot and the gpus of the victims until they stop
+                    blocked = True
+                    for victim, urgent_id in self.preempting.items():
+                        if urgent_id == id:
+                            head.update(GpuManager.ledger.reservations.get(victim, (None, {}))[1])
+                    continue
+
+                if full:
+                    continue
+
+            if device is False:
+                if not self.backfill:
+                    break  # Jobs keep the queue order
+
+                if not blocked:
+                    blocked = True
+                    head = self.head_devices(gpu_mem, free)
                 continue
 
-            elif job is None and server_state is State.IDLE:
-                # Idle
+            if not JobsTable.claim_job(id, self.worker):  # Paused or removed meanwhile
                 continue
+            job.at[job.index[0], "state"] = JobState.RUNNING.value
 
-            else:
-                # New jobs found
-                server_state = State.PROCESSING
+            if device is not None:
+                devices = self.get_devices(gpu_mem, device)
+                GpuManager.ledger.reserve(id, devices)
+                for gpu_id, reserved in devices.items():
+                    free[gpu_id] -= reserved
 
-            device = wait_for_free_space(
-                job.gpu_mem.values[0], sleep_time_secs=sleep_time
-            )
+            await self.start(job, device)
 
-            Log.INFO(
-                f"Starting job: {get_job_repr(job.values, lvl=-1)}\n",
-                log_path,
+        waiting.close()  # Puts the walked jobs back in the dispatch index
+        if self.running:
+            self.state = (
+                State.FULL if len(self.running) >= self.max_jobs else State.PROCESSING
             )
+        elif self.state is not State.IDLE:
+            # No jobs to run
+            self.state = State.IDLE
+            self.log(Log.INFO, f"Idle ...\n")
 
-            # TODO: Add other options to use the device. Also maybe customizable
-            # by user in settings
-            if job.gpu_mem.values[0] == 0.0:
-                device = ""  # FIXME : Use 'cpu' or ''
-            elif device is True:
-                device = ""  # --data_parallel
-            else:
-                device = f"cuda:{device}"  # --device cuda:{device}
+    async def start(
+        self, job: pd.DataFrame, device: Union[int, Tuple[int, ...], None]
+    ) -> None:
+        id = int(job.id.values[0])
 
-            cmd: str = job.command.values[0]
-            cmd = cmd.replace("python", job.env_path.values[0])
+        latency = ""
+        if self.changed is not None:
+            latency = f" ({(time.time() - self.changed) * 1e3:.1f} ms after the queue changed)"
 
-            proc = get_process_as_user(
-                f"{cmd} {device}",
+        on = "" if device is None else f" on gpu {device}"
+        self.log(Log.INFO, f"Starting job{latency}{on}: {get_job_repr(job.values, lvl=-1)}\n")
+
+        cmd: str = job.command.values[0]
+        cmd = cmd.replace("python", job.env_path.values[0])
+
+        try:
+            proc = await start_process_as_user(
+                f"{cmd} {get_device_arg(job.gpu_mem.values[0], device)}",
                 job.user.values[0],
                 job.working_dir.values[0],
+                get_device_env(device),
+                # Own process group to signal the whole job on preemption
+                new_session=self.preempt is not None,
             )
+        except Exception as e:  # Wrong user, working dir, ...
+            GpuManager.ledger.release(id)
+            finish_job(id, state=JobState.ERROR)
+            self.log(Log.ERROR, f"On {get_job_repr(job.values, 1)}\n{e!r}\n")
+            return
+
+        # Update job pid and start time
+        now = datetime.datetime.now()
+        with JobsTable.transaction() as tr:
+            tr.update([id], pid=int(proc.pid), stime=now)
+        job.at[job.index[0], "pid"] = int(proc.pid)
+        job.at[job.index[0], "stime"] = now
+
+        GpuManager.ledger.set_pid(id, proc.pid)
+        self.jobs[id] = (job, proc.pid, time.time())
+        self.track_usage(job, time.time())
+
+        self.running[id] = asyncio.create_task(self.supervise(job, proc.wait()))
+
+    async def supervise(
+        self, job: pd.DataFrame, wait: Awaitable[Union[int, None]], adopted: bool = False
+    ) -> None:
+        """Wait for the job process to finish and store its final state. The
+        return code of adopted processes is unknown: they end as finished (so
+        their afterok children run) and the unknown exit status is logged"""
+        id = int(job.id.values[0])
+        pid = self.jobs[id][1] if id in self.jobs else None
 
-            # Update job pid and start time
-            JobsTable.update_job(job.id.values[0], "pid", int(proc.pid))
-            JobsTable.update_job(job.id.values[0], "stime", datetime.datetime.now())
-
-            # Wait for process to finish
-            returncode = proc.wait()
-
-            # Update job finished time
-            JobsTable.update_job(job.id.values[0], "pid", "---")
-            JobsTable.update_job(job.id.values[0], "ftime", datetime.datetime.now())
-
-            JobsTable.set_job_state(
-                job.id.values[0],
-                state=JobState.DONE if returncode == 0 else JobState.ERROR,
+        try:
+            returncode = await wait
+        except asyncio.CancelledError:  # Server shutting down
+            if not adopted:  # Adopted processes keep running
+                if id in self.jobs and self.preempt is not None:
+                    # Not in the server process group, interrupt it as ctrl+C would
+                    with suppress(ProcessLookupError):
+                        os.killpg(self.jobs[id][1], signal.SIGINT)
+                finish_job(id, state=JobState.ERROR)
+            raise
+        finally:
+            self.running.pop(id, None)
+            self.jobs.pop(id, None)
+            if id not in self.preempting:
+                GpuManager.ledger.release(id)
+            try:
+                self.charge_usage([id])
+            except Exception as e:
+                self.log(Log.ERROR, f"Fair share: {e!r}\n")
+            self.charged.pop(id, None)
+
+        if id in self.preempting:
+            # Keep its gpus until all its processes are gone
+            await wait_process_group(pid)
+            GpuManager.ledger.release(id)
+            del self.preempting[id]
+
+            # Back to the queue with the same ctime to keep its place
+            with JobsTable.transaction() as tr:
+                tr.update([id], pid=None, stime=None, worker=None, heartbeat=None)
+                tr.set_state([id], JobState.WAITING)
+            self.peaks.pop(id, None)
+            self.log(Log.INFO, f"Preempted {get_job_repr(job.values, 1)} is waiting again\n")
+            self.wakeup.set()
+            return
+
+        # Update job pid, finished time and state
+        failed = returncode is not None and returncode != 0
+        finish_job(id, state=JobState.ERROR if failed else JobState.DONE)
+        if returncode == 0:  # Adopted jobs may have failed, their peak is not kept
+            self.record_peak(job)
+        self.peaks.pop(id, None)
+
+        if returncode is None:
+            self.log(
+                Log.INFO,
+                f"Adopted job ended, exit status unknown. Set as finished: {get_job_repr(job.values, 1)}\n",
             )
-
-            Log["SUCCESS" if returncode == 0 else "ERROR"](
-                f"On {get_job_repr(job.values, 1)}\n", log_path
+        else:
+            self.log(
+                Log["ERROR" if failed else "SUCCESS"], f"On {get_job_repr(job.values, 1)}\n"
             )
 
-            time.sleep(sleep_time)
-
-        except KeyboardInterrupt:
-            if job is not None:
-                # Update job finished time
-                JobsTable.update_job(job.id.values[0], "pid", "---")
-                JobsTable.update_job(job.id.values[0], "ftime", datetime.datetime.now())
-
-                JobsTable.set_job_state(job.id.values[0], state=JobState.ERROR)
-            print("\rShutting down server...")
-            break
-
-        except GpuMemoryOutOfRange:
-            # Update job finished time
-            JobsTable.update_job(job.id.values[0], "pid", "---")
-            JobsTable.update_job(job.id.values[0], "ftime", datetime.datetime.now())
-
-            JobsTable.set_job_state(job.id.values[0], state=JobState.ERROR)
-
-            Log.ERROR(
-                f"GpuMemoryOutOfRange(Requested={job.gpu_mem.values[0]} MB, Available={GpuManager.TOTAL} MB) \n",
-                log_path,
-            )
+        self.wakeup.set()
+
+
+def run_server(
+    sleep_time: int = 60,
+    archive_after: float = 24,
+    max_jobs: int = 1,
+    lease: float = 60,
+    on_lost: str = "requeue",
+    backfill: bool = True,
+    sample_interval: float = 0.5,
+    free_window: float = 0,
+    fair_share: float = 0,
+    preempt: Union[signal.Signals, None] = None,
+    preempt_grace: float = 60,
+    aging: float = 0,
+):
+    # os.umask(0000)  # so everyone can read, write and execute
+    try:
+        asyncio.run(
+            Scheduler(
+                sleep_time,
+                archive_after,
+                max_jobs,
+                lease,
+                on_lost,
+                backfill,
+                sample_interval,
+                free_window,
+                fair_share,
+                preempt,
+                preempt_grace,
+                aging,
+            ).run()
+        )
+    except KeyboardInterrupt:
+        print("\rShutting down server...")
 
 
 def main():
     args = get_args()
-    sleep_time = args.time
-    nthreads = args.threads
-
-    threads = [Process(target=run_server, args=(sleep_time,)) for _ in range(nthreads)]
-
-    try:
-        for thread in threads:
-            thread.start()
-            time.sleep(sleep_time)
-
-        for thread in threads:
-            thread.join()
-            time.sleep(sleep_time)
-
-    except KeyboardInterrupt:
-        pass
+    run_server(
+        args.time,
+        args.archive_after,
+        args.threads,
+        args.lease,
+        args.on_lost,
+        not args.no_backfill,
+        args.sample_interval,
+        args.free_window,
+        args.fair_share,
+        args.preempt,
+        args.preempt_grace,
+        args.aging,
+    )
 
 
 # ENDFILE
@@ -0,0 +1,106 @@
+import os
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from typing import Deque, Dict, Tuple
+
+__all__ = ["RollingHistogram", "Stats", "stats"]
+
+METRICS = ["lock_wait", "lock_hold", "read", "write", "nvidia_smi"]
+
+NULL_TIMER = nullcontext()
+
+
+class RollingHistogram:
+    "Durations (s) of the last `size` samples"
+
+    def __init__(self, size: int = 1000) -> None:
+        self.samples: Deque[float] = deque(maxlen=size)
+        self.count = 0  # All samples ever recorded
+
+    def add(self, value: float) -> None:
+        self.samples.append(value)
+        self.count += 1
+
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+    def __str__(self) -> str:
+        ms = lambda x: f"{x * 1e3:9.2f}"
+        return f"{self.count:7d} {ms(self.percentile(50))} {ms(self.percentile(95))} {ms(self.percentile(99))} {ms(max(self.samples, default=0.0))}"
+
+
+class Stats:
+    """Per operation timings of the lock and of the table I/O.
+
+    Disabled by default. Enable it with JOBS_QUEUE_STATS=1 or with
+    `jobsclient stats --on`. While disabled `timer` returns a shared no-op
+    context manager so the instrumented code pays a single attribute check.
+    """
+
+    def __init__(self, enabled: bool = False, size: int = 1000) -> None:
+        self.enabled = enabled
+        self.size = size
+        self.operation = "other"  # Operation being run by this process
+        self.histograms: Dict[Tuple[str, str], RollingHistogram] = dict()
+
+    def record(self, metric: str, seconds: float) -> None:
+        key = (self.operation, metric)
+        if key not in self.histograms:
+            self.histograms[key] = RollingHistogram(self.size)
+        self.histograms[key].add(seconds)
+
+    def timer(self, metric: str):
+        if not self.enabled:
+            return NULL_TIMER
+        return self._timer(metric)
+
+    @contextmanager
+    def _timer(self, metric: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(metric, time.perf_counter() - start)
+
+    @contextmanager
+    def tag(self, operation: str):
+        "Record the timings inside the context under operation"
+        previous, self.operation = self.operation, operation
+        try:
+            yield
+        finally:
+            self.operation = previous
+
+    def reset(self) -> None:
+        self.histograms.clear()
+
+    def __str__(self) -> str:
+        str_ = f"Stats (enabled={self.enabled}, last {self.size} samples, times in ms):\n"
+        str_ += f"  {'operation':<12} {'metric':<10} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}\n"
+        for (operation, metric), hist in sorted(
+            self.histograms.items(), key=lambda x: (x[0][0], METRICS.index(x[0][1]))
+        ):
+            str_ += f"  {operation:<12} {metric:<10} {hist}\n"
+        return str_
+
+
+stats = Stats(enabled=os.environ.get("JOBS_QUEUE_STATS", "0") == "1")
+
+
+def show_stats(args) -> str:
+    "Client operation to show, turn on/off and reset the stats of the commands server"
+    if getattr(args, "on", False):
+        stats.enabled = True
+    if getattr(args, "off", False):
+        stats.enabled = False
+    if getattr(args, "reset", False):
+        stats.reset()
+
+    return str(stats)
+
+
+# ENDFILE
@@ -0,0 +1,613 @@
+import datetime
+import os
+import sqlite3
+import tempfile
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, suppress
+from pathlib import Path
+from typing import IO, Any, Callable, Dict, Iterable, List, Tuple, Union
+
+import pandas as pd
+
+from . import JOBS_DB_FILENAME, JOBS_TABLE_FILENAME
+from .jobs import JOB_COLUMNS, State, astype_jobs
+
+__all__ = [
+    "Transaction",
+    "Storage",
+    "CsvStorage",
+    "SqliteStorage",
+    "storages",
+    "get_storage",
+    "replace_file",
+]
+
+NULL = "---"  # Stored placeholder for the nullable columns when not set
+TIME_COLUMNS = ["ctime", "stime", "ftime", "heartbeat", "wtime"]
+NULLABLE_COLUMNS = ["pid", "worker", "after", "array_id", *TIME_COLUMNS]
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"  # Fixed width so that text order is time order
+
+
+def replace_file(path: Path, write: Callable[[IO], None]) -> None:
+    """Crash-safe replacement of a file. `write` fills a temporary file in the
+    same directory that is fsync'd and renamed over path, so readers (with or
+    without the lock) see either the old or the new file, never a partial one"""
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", newline="") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # Read, Write, Execute permissions so other users can change the files
+        try:
+            os.chmod(tmp, 0o775)
+        except PermissionError:
+            ...
+
+        os.replace(tmp, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+
+    # Persist the rename itself
+    dir_fd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def parse_times(col: pd.Series) -> pd.Series:
+    "Vectorized timestamps parsing. Missing values become NaT"
+    times = pd.to_datetime(col, format=TIME_FORMAT, errors="coerce")
+
+    legacy = times.isna() & col.notna()
+    if legacy.any():  # Written without microseconds by older versions
+        times[legacy] = pd.to_datetime(col[legacy], format="%Y-%m-%d %H:%M:%S")
+
+    return times
+
+
+def from_stored_values(df: pd.DataFrame) -> pd.DataFrame:
+    """Parse the stored table values into the typed in memory table. Columns
+    added after the table was stored are filled with missing values"""
+    df = df.reindex(columns=JOB_COLUMNS)
+    for col in TIME_COLUMNS:
+        df[col] = parse_times(df[col])
+    return astype_jobs(df)
+
+
+class Transaction:
+    """Batch of mutations over the jobs table.
+
+    The table is loaded (at most once) the first time `df` is accessed and
+    every mutation is applied to it and recorded, so the storage backend can
+    commit the whole batch in a single write.
+    """
+
+    def __init__(self, load: Callable[[], pd.DataFrame]) -> None:
+        self._load = load
+        self._df = None
+        self.ops: List[Tuple[str, Any, Any]] = []  # (op, ids or rows, values)
+
+    @property
+    def df(self) -> pd.DataFrame:
+        if self._df is None:
+            self._df = self._load()
+            for op in self.ops:
+                self._apply(*op)
+        return self._df
+
+    def _apply(self, op: str, arg: Any, values: Any) -> None:
+        if op == "insert":
+            self._df = astype_jobs(pd.concat([self._df, arg], ignore_index=True))
+        elif op == "update":
+            mask = self._df.id.isin(arg)
+            for col, value in values.items():
+                self._df.loc[mask, col] = value
+        elif op == "delete":
+            self._df = self._df[~self._df.id.isin(arg)]
+
+    def _record(self, op: str, arg: Any, values: Any = None) -> None:
+        self.ops.append((op, arg, values))
+        if self._df is not None:
+            self._apply(op, arg, values)
+
+    def insert(self, df: pd.DataFrame) -> None:
+        self._record("insert", df)
+
+    def update(self, ids: Iterable[int], **values: Any) -> None:
+        for col in values.keys():
+            assert col in JOB_COLUMNS, f"Invalid column: {col}"
+        self._record("update", [int(id) for id in ids], values)
+
+    def delete(self, ids: Iterable[int]) -> None:
+        self._record("delete", [int(id) for id in ids])
+
+    def set_state(self, ids: Iterable[int], state: Union[State, str]) -> None:
+        "Jobs set as waiting wait (and age) from now on, see wtime"
+        state = State.get_valid(state)
+        if state is State.WAITING:
+            self.update(ids, state=state.value, wtime=datetime.datetime.now())
+        else:
+            self.update(ids, state=state.value)
+
+
+class Storage(ABC):
+    "Jobs table storage backend abstract class"
+
+    def __init__(self, path: Union[Path, str]) -> None:
+        self.path = Path(path)
+        self.changes = 0  # Writes done by this process
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(path={self.path})"
+
+    @abstractmethod
+    def read(self) -> pd.DataFrame:
+        "Read the whole jobs table. Raises FileNotFoundError if there is no table yet"
+        ...
+
+    @abstractmethod
+    def write(self, df: pd.DataFrame) -> None:
+        "Replace the whole jobs table"
+        ...
+
+    def signature(self) -> Union[Tuple, None]:
+        """Changes whenever the table changes. None if there is no table yet
+
+        (own writes, inode, mtime_ns, size) of the table file"""
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return
+
+        return (self.changes, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    # Row level operations. The defaults rewrite the whole table so backends
+    # that can do better should override them
+
+    def commit(self, tr: Transaction) -> None:
+        "Write all the mutations of a transaction at once"
+        if tr.ops:
+            self.write(tr.df)
+
+    def insert(self, df: pd.DataFrame) -> None:
+        try:
+            table = self.read()
+        except FileNotFoundError:
+            table = df.iloc[:0]
+        self.write(astype_jobs(pd.concat([table, df], ignore_index=True)))
+
+    def update(self, ids: Iterable[int], values: Dict[str, Any]) -> None:
+        df = self.read()
+        mask = df.id.isin(list(ids))
+        for col, value in values.items():
+            df.loc[mask, col] = value
+        self.write(df)
+
+    def delete(self, ids: Iterable[int]) -> None:
+        df = self.read()
+        self.write(df[~df.id.isin(list(ids))])
+
+    def get(self, ids: Iterable[int]) -> pd.DataFrame:
+        df = self.read()
+        return df[df.id.isin(list(ids))]
+
+    @property
+    def seq_path(self) -> Path:
+        return self.path.with_suffix(".seq")
+
+    def next_ids(self, n: int = 1) -> List[int]:
+        """Allocate n new job ids from the persisted monotonic sequence. Must be
+        called while holding the table lock. If the sequence file is missing or
+        corrupted it is rebuilt from max(id) + 1 of the table and the history"""
+        try:
+            next_id = int(self.seq_path.read_text())
+        except (FileNotFoundError, ValueError):
+            try:
+                ids = self.read().id
+                next_id = 0 if ids.empty else int(ids.max()) + 1
+            except FileNotFoundError:
+                next_id = 0
+            next_id = max(next_id, self.archived_next_id())
+
+        replace_file(self.seq_path, lambda f: f.write(str(next_id + n)))
+
+        return list(range(next_id, next_id + n))
+
+    @staticmethod
+    def archived_next_id() -> int:
+        "max(id) + 1 of the archived jobs (see JobsHistory), so their ids are not reused"
+        from .history import JobsHistory  # history imports storage
+
+        max_id = JobsHistory.max_id()
+        return 0 if max_id is None else max_id + 1
+
+    def waiting(self) -> pd.DataFrame:
+        "Jobs with state WAITING"
+        df = self.read()
+        return df[df.state == State.WAITING.value]
+
+    def blocked(self) -> pd.DataFrame:
+        "Jobs with state BLOCKED"
+        df = self.read()
+        return df[df.state == State.BLOCKED.value]
+
+
+class CsvStorage(Storage):
+    """Whole table in a single ';' separated file
+
+    Every write replaces the file atomically (see replace_file) and bumps the
+    generation number kept in a `.gen` sidecar file, so the table can be read
+    without the lock and a crash while writing leaves the previous table"""
+
+    @property
+    def gen_path(self) -> Path:
+        return self.path.with_suffix(".gen")
+
+    def generation(self) -> int:
+        "Number of writes done to the table. 0 if unknown"
+        try:
+            return int(self.gen_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def signature(self) -> Union[Tuple, None]:
+        """(generation, own writes, inode, mtime_ns, size) of the table file
+
+        Inodes are recycled once the replaced files are freed, the generation
+        tells apart tables written within the same mtime tick"""
+        signature = super().signature()
+        if signature is None:
+            return
+
+        return (self.generation(), *signature)
+
+    def _replace(self, write: Callable[[IO], None]) -> None:
+        self.changes += 1
+        generation = self.generation() + 1
+        replace_file(self.path, write)
+        replace_file(self.gen_path, lambda f: f.write(str(generation)))
+
+    def read(self) -> pd.DataFrame:
+        df = pd.read_csv(
+            self.path,
+            sep=";",
+            dtype=dict(
+                command=object,
+                env_path=object,
+                working_dir=object,
+                worker=object,
+                after=object,
+            ),
+            keep_default_na=False,
+            na_values={col: [NULL, ""] for col in NULLABLE_COLUMNS},
+        )
+        return from_stored_values(df)
+
+    def write(self, df: pd.DataFrame) -> None:
+        self._replace(
+            lambda f: df[JOB_COLUMNS].to_csv(
+                f, sep=";", index=None, na_rep=NULL, date_format=TIME_FORMAT
+            )
+        )
+
+    def insert(self, df: pd.DataFrame) -> None:
+        """Add the rows at the end of the file. The stored rows are copied as
+        they are instead of being parsed and written again"""
+        try:
+            with open(self.path, "r", newline="") as f:
+                stored = f.read()
+        except FileNotFoundError:
+            return self.write(df)
+
+        if stored.split("\n", 1)[0].split(";") != JOB_COLUMNS:
+            # Written with other columns. Rewrite it
+            return super().insert(df)
+
+        def write(f: IO) -> None:
+            f.write(stored if stored.endswith("\n") else stored + "\n")
+            df[JOB_COLUMNS].to_csv(
+                f, sep=";", index=None, header=False, na_rep=NULL, date_format=TIME_FORMAT
+            )
+
+        self._replace(write)
+
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS jobs (
+    pid INTEGER,
+    id INTEGER PRIMARY KEY,
+    user TEXT NOT NULL,
+    command TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    gpu_mem REAL NOT NULL,
+    state INTEGER NOT NULL,
+    ctime TEXT NOT NULL,
+    stime TEXT,
+    ftime TEXT,
+    env_path TEXT,
+    working_dir TEXT,
+    worker TEXT,
+    heartbeat TEXT,
+    after TEXT,
+    array_id INTEGER,
+    wtime TEXT
+);
+-- Waiting jobs lookups: WHERE state = ? ORDER BY priority DESC, ctime
+CREATE INDEX IF NOT EXISTS ix_jobs_state ON jobs (state, priority DESC, ctime);
+CREATE INDEX IF NOT EXISTS ix_jobs_priority ON jobs (priority);
+CREATE INDEX IF NOT EXISTS ix_jobs_ctime ON jobs (ctime);
+CREATE INDEX IF NOT EXISTS ix_jobs_user ON jobs (user);
+CREATE TABLE IF NOT EXISTS sequences (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# Columns added after the first version of the schema. Older databases are
+# upgraded with ALTER TABLE when opened
+ADDED_COLUMNS = dict(
+    worker="TEXT", heartbeat="TEXT", after="TEXT", array_id="INTEGER", wtime="TEXT"
+)
+
+# Indexes on the added columns, created once the columns exist
+ADDED_INDEXES = """
+-- Array tasks lookups: WHERE array_id IN (...)
+CREATE INDEX IF NOT EXISTS ix_jobs_array ON jobs (array_id) WHERE array_id IS NOT NULL;
+"""
+
+
+# Host parameters limit of a statement in older sqlite versions
+MAX_SQL_PARAMS = 999
+
+
+def to_sql_value(col: str, value: Any) -> Any:
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if col in TIME_COLUMNS:
+        return pd.Timestamp(value).strftime(TIME_FORMAT)
+    if col in ("pid", "id", "priority", "state", "array_id"):
+        return int(value)
+    if col == "gpu_mem":
+        return float(value)
+    return str(value)
+
+
+def to_sql_rows(df: pd.DataFrame) -> List[List[Any]]:
+    "Vectorized to_sql_value of every row of a typed jobs table"
+    columns = []
+    for col in JOB_COLUMNS:
+        values = df[col]
+        if col in TIME_COLUMNS:
+            values = values.dt.strftime(TIME_FORMAT)
+        elif col in ("pid", "id", "priority", "state", "array_id"):
+            values = values.astype("Int64")
+        elif col == "gpu_mem":
+            values = values.astype(float)
+        else:
+            values = values.astype(object).map(str, na_action="ignore")
+        # Python values (not numpy scalars) and None for the missing values
+        columns.append(values.astype(object).where(values.notna(), None).tolist())
+
+    return [list(row) for row in zip(*columns)]
+
+
+class SqliteStorage(Storage):
+    """SQLite database in WAL mode. Single rows are updated in place and the
+    next waiting job is found through the (state, priority, ctime) index.
+
+    The first time the database is created an existing csv table is migrated
+    into it and renamed to '<csv>.migrated'.
+    """
+
+    def __init__(
+        self, path: Union[Path, str], csv_path: Union[Path, str, None] = None
+    ) -> None:
+        super().__init__(path)
+        self.csv_path = None if csv_path is None else Path(csv_path)
+        self._conn = None
+        self._conn_pid = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # Connections can not be shared with forked processes
+        if self._conn is None or self._conn_pid != os.getpid():
+            is_new = not self.path.exists()
+
+            self._conn = sqlite3.connect(str(self.path), timeout=60, isolation_level=None)
+            self._conn_pid = os.getpid()
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+            self.upgrade()
+            self._conn.executescript(ADDED_INDEXES)
+
+            if is_new:
+                # Read, Write, Execute permissions so other users can change the files
+                try:
+                    self.path.chmod(0o775)
+                except PermissionError:
+                    ...
+                self.migrate()
+
+        return self._conn
+
+    @contextmanager
+    def _begin(self):
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self.changes += 1
+
+    def signature(self) -> Union[Tuple, None]:
+        """Commits land in the -wal file and only reach the database file on
+        checkpoints, so both files are checked. data_version changes whenever
+        another connection commits"""
+        signature = super().signature()
+        if signature is None:
+            return
+
+        try:
+            stat = self.path.with_name(self.path.name + "-wal").stat()
+            wal = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            wal = None
+
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+        return (*signature, wal, data_version)
+
+    def upgrade(self) -> None:
+        "Add the missing columns to a database created by an older version"
+        columns = lambda: {row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        if columns() >= set(ADDED_COLUMNS):
+            return
+
+        with self._begin() as conn:
+            # Checked again since another process may have upgraded it meanwhile
+            for col in ADDED_COLUMNS.keys() - columns():
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {col} {ADDED_COLUMNS[col]}")
+
+    def migrate(self) -> int:
+        "One-shot import of the csv table. Returns the number of imported jobs"
+        # Inside a write transaction so concurrent processes migrate only once
+        with self._begin() as conn:
+            if self.csv_path is None or not self.csv_path.exists():
+                return 0
+
+            df = CsvStorage(self.csv_path).read()
+            self._insert(conn, df)
+            self.csv_path.rename(
+                self.csv_path.with_name(self.csv_path.name + ".migrated")
+            )
+
+        return df.shape[0]
+
+    def _query(self, sql: str, params: Iterable[Any] = ()) -> pd.DataFrame:
+        cursor = self.conn.execute(sql, tuple(params))
+        df = pd.DataFrame(
+            cursor.fetchall(), columns=[d[0] for d in cursor.description]
+        )
+        return from_stored_values(df)
+
+    def read(self) -> pd.DataFrame:
+        return self._query("SELECT * FROM jobs")
+
+    def _insert(self, conn: sqlite3.Connection, df: pd.DataFrame) -> None:
+        rows = to_sql_rows(astype_jobs(df[JOB_COLUMNS]))
+        conn.executemany(
+            f"INSERT INTO jobs ({', '.join(JOB_COLUMNS)}) VALUES ({', '.join('?' * len(JOB_COLUMNS))})",
+            rows,
+        )
+
+    def _update(
+        self, conn: sqlite3.Connection, ids: Iterable[int], values: Dict[str, Any]
+    ) -> None:
+        cols = list(values.keys())
+        for col in cols:
+            assert col in JOB_COLUMNS, f"Invalid column: {col}"
+
+        params = [to_sql_value(col, values[col]) for col in cols]
+        conn.executemany(
+            f"UPDATE jobs SET {', '.join(f'{col} = ?' for col in cols)} WHERE id = ?",
+            [[*params, int(id)] for id in ids],
+        )
+
+    def _delete(self, conn: sqlite3.Connection, ids: Iterable[int]) -> None:
+        conn.executemany("DELETE FROM jobs WHERE id = ?", [[int(id)] for id in ids])
+
+    def write(self, df: pd.DataFrame) -> None:
+        with self._begin() as conn:
+            conn.execute("DELETE FROM jobs")
+            self._insert(conn, df)
+
+    def commit(self, tr: Transaction) -> None:
+        if not tr.ops:
+            return
+
+        with self._begin() as conn:
+            for op, arg, values in tr.ops:
+                if op == "insert":
+                    self._insert(conn, arg)
+                elif op == "update":
+                    self._update(conn, arg, values)
+                elif op == "delete":
+                    self._delete(conn, arg)
+
+    def insert(self, df: pd.DataFrame) -> None:
+        with self._begin() as conn:
+            self._insert(conn, df)
+
+    def update(self, ids: Iterable[int], values: Dict[str, Any]) -> None:
+        with self._begin() as conn:
+            self._update(conn, ids, values)
+
+    def delete(self, ids: Iterable[int]) -> None:
+        with self._begin() as conn:
+            self._delete(conn, ids)
+
+    def next_ids(self, n: int = 1) -> List[int]:
+        with self._begin() as conn:
+            row = conn.execute(
+                "SELECT value FROM sequences WHERE name = 'jobs'"
+            ).fetchone()
+            if row is None:
+                # Uses the primary key index
+                row = conn.execute("SELECT COALESCE(MAX(id) + 1, 0) FROM jobs").fetchone()
+                row = [max(int(row[0]), self.archived_next_id())]
+
+            next_id = int(row[0])
+            conn.execute(
+                "INSERT OR REPLACE INTO sequences (name, value) VALUES ('jobs', ?)",
+                [next_id + n],
+            )
+
+        return list(range(next_id, next_id + n))
+
+    def get(self, ids: Iterable[int]) -> pd.DataFrame:
+        ids = [int(id) for id in ids]
+        if len(ids) > MAX_SQL_PARAMS:  # e.g. the tasks of a job array
+            chunks = [
+                self.get(ids[i : i + MAX_SQL_PARAMS])
+                for i in range(0, len(ids), MAX_SQL_PARAMS)
+            ]
+            return astype_jobs(pd.concat(chunks, ignore_index=True))
+
+        return self._query(
+            f"SELECT * FROM jobs WHERE id IN ({', '.join('?' * len(ids))})", ids
+        )
+
+    def waiting(self) -> pd.DataFrame:
+        return self._query("SELECT * FROM jobs WHERE state = ?", [State.WAITING.value])
+
+    def blocked(self) -> pd.DataFrame:
+        return self._query("SELECT * FROM jobs WHERE state = ?", [State.BLOCKED.value])
+
+
+storages = dict(
+    csv=lambda: CsvStorage(JOBS_TABLE_FILENAME),
+    sqlite=lambda: SqliteStorage(JOBS_DB_FILENAME, csv_path=JOBS_TABLE_FILENAME),
+)
+
+
+def get_storage(name: str = None) -> Storage:
+    "Storage backend chosen by name or by the JOBS_QUEUE_STORAGE env variable"
+    name = name or os.environ.get("JOBS_QUEUE_STORAGE", "sqlite")
+    if name not in storages:
+        raise KeyError(f"Expected one of {list(storages.keys())}. Got: '{name}'")
+
+    return storages[name]()
+
+
+# ENDFILE
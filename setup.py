@@ -45,10 +45,10 @@ setup(
     packages=["jobs_queue"],
     install_requires=[
         "easydict",
-        "filelock",
         "pandas",
         "psutil"
     ],
+    extras_require={"nvml": ["nvidia-ml-py"]},
     cmdclass={
         "install": PostInstallCommand,
     },
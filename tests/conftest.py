@@ -0,0 +1,31 @@
+"""Fixtures shared by the tests. Run with `python -m pytest tests`"""
+from pathlib import Path
+
+import pytest
+
+import jobs_queue.history
+from jobs_queue.dependencies import DependencyIndex
+from jobs_queue.dispatch import DispatchIndex
+from jobs_queue.jobs_table import JobsTable
+from jobs_queue.storage import CsvStorage, SqliteStorage
+
+STORAGES = dict(
+    sqlite=lambda tmp: SqliteStorage(Path(tmp) / "jobs_table.db"),
+    csv=lambda tmp: CsvStorage(Path(tmp) / "jobs_table.csv"),
+)
+
+
+@pytest.fixture(params=list(STORAGES))
+def table(request, tmp_path, monkeypatch):
+    """Empty jobs table and history in tmp_path with fresh indexes. Returns the
+    storage name"""
+    monkeypatch.setattr(JobsTable, "storage", STORAGES[request.param](tmp_path))
+    monkeypatch.setattr(JobsTable, "index", DispatchIndex())
+    monkeypatch.setattr(JobsTable, "deps", DependencyIndex())
+    monkeypatch.setattr(JobsTable, "_cache", None)
+    monkeypatch.setattr(jobs_queue.history, "HISTORY_DIR", tmp_path / "history")
+    JobsTable.write(JobsTable.get_empty_table())
+    return request.param
+
+
+# ENDFILE
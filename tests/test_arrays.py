@@ -0,0 +1,141 @@
+"""Job arrays (`jobsclient add --array`, see expand_array) and the operations
+on all their tasks
+
+Every test on the jobs table runs on both storage backends, in a temporary
+table. Run with `python -m pytest tests`
+"""
+import argparse
+
+import pytest
+
+import jobs_queue.gpu_memory
+import jobs_queue.gpu_sampler
+import jobs_queue.jobs_table
+from jobs_queue.arrays import MAX_ARRAY_TASKS, expand_array, parse_array, parse_values
+from jobs_queue.jobs import State
+from jobs_queue.jobs_table import JobsTable
+
+NS = argparse.Namespace
+USER = "user"
+
+
+@pytest.fixture
+def gpus(monkeypatch):
+    "One fake gpu instead of nvidia-smi and no user settings needed"
+    monkeypatch.setattr(jobs_queue.gpu_sampler, "FAKE_GPUS", "24000")
+    monkeypatch.setattr(jobs_queue.gpu_memory, "read_snapshot", lambda: None)
+    monkeypatch.setattr(
+        jobs_queue.jobs_table,
+        "get_user_paths",
+        lambda user, envname: dict(env_path="python", working_dir="/tmp"),
+    )
+
+
+def add(command, array=None, after=None):
+    return JobsTable.add(
+        NS(
+            command=command.split(" "),
+            priority="low",
+            gpu_mem=0,
+            verbose=0,
+            envname="base",
+            working_dir=None,
+            after=after,
+            array=array,
+            extra_kwargs=dict(user_login=USER),
+        )
+    )
+
+
+def tasks(array_id):
+    df = JobsTable.read()
+    df = df[df.array_id == array_id].sort_values("id")
+    return df.id.tolist(), [State(int(state)) for state in df.state]
+
+
+def test_parse_values():
+    assert parse_values("0-4:2,7,1e-3") == ["0", "2", "4", "7", "1e-3"]
+    assert parse_values("-1-1") == ["-1", "0", "1"]
+    for spec in ["3-1", "0-4:0", "1,,2", f"0-{MAX_ARRAY_TASKS}"]:
+        with pytest.raises(ValueError):
+            parse_values(spec)
+
+
+def test_expand_array():
+    params = parse_array(["lr=0.1,0.01", "seed=0-2"])
+    assert params == dict(lr=["0.1", "0.01"], seed=["0", "1", "2"])
+
+    commands = expand_array("python train.py --lr {lr} --seed {seed} --out ${HOME}", params)
+    assert len(commands) == 6
+    assert commands[:2] == [
+        "python train.py --lr 0.1 --seed 0 --out ${HOME}",
+        "python train.py --lr 0.1 --seed 1 --out ${HOME}",
+    ]
+    assert commands[-1] == "python train.py --lr 0.01 --seed 2 --out ${HOME}"
+
+    assert expand_array("ls {task}", parse_array(["0-2"])) == ["ls 0", "ls 1", "ls 2"]
+
+
+def test_invalid_array():
+    with pytest.raises(ValueError, match="not used in the command"):
+        expand_array("ls", parse_array(["seed=0-2"]))
+    with pytest.raises(ValueError, match="given twice"):
+        parse_array(["seed=0-2", "seed=3"])
+    with pytest.raises(ValueError, match="maximum array size"):
+        parse_array(["a=0-999", "b=0-999"])
+
+
+def test_add_array(table, gpus):
+    msg = add("python train.py --seed {seed}", array=["seed=0-3"])
+    assert "Adding array 0 with 4 tasks (ids 0-3)" in msg
+
+    df = JobsTable.read().sort_values("id")
+    assert df.command.tolist() == [f"python train.py --seed {i}" for i in range(4)]
+    assert df.array_id.tolist() == [0] * 4
+    assert tasks(0) == ([0, 1, 2, 3], [State.PAUSED] * 4)
+
+    add("python train.py --seed {seed}", array=["seed=0-1"])
+    assert tasks(4) == ([4, 5], [State.PAUSED] * 2)
+
+    assert add("ls", array=["seed=0-1"]).startswith("Invalid --array")
+    assert JobsTable.read().shape[0] == 6
+
+
+def test_pause_resume_array(table, gpus):
+    add("ls {task}", array=["0-2"])
+    add("ls {task}", array=["0-1"])
+    add("ls")
+    JobsTable.resume(NS(op="all", verbose=0))
+
+    msg = JobsTable.pause(NS(op="array", array_ids=[0], verbose=0))
+    assert msg == "Pausing array [0]: 3 tasks"
+    assert tasks(0)[1] == [State.PAUSED] * 3
+    assert tasks(3)[1] == [State.WAITING] * 2
+    JobsTable.check_index()
+    assert [int(job.id.values[0]) for job in JobsTable.waiting_jobs()] == [3, 4, 5]
+
+    msg = JobsTable.resume(NS(op="array", array_ids=[0], verbose=0))
+    assert msg == "Resuming array [0]: 3 tasks"
+    assert tasks(0)[1] == [State.WAITING] * 3
+
+
+def test_cancel_remove_array(table, gpus):
+    add("ls {task}", array=["0-2"])
+    add("ls {task}", array=["0-1"])
+    add("ls", after="afterok:1")  # Depends on a task
+    JobsTable.resume(NS(op="all", verbose=0))
+    JobsTable.claim_job(2)  # Running tasks are not cancelled
+
+    msg = JobsTable.cancel(
+        NS(ids=[], array_ids=[0], verbose=0, extra_kwargs=dict(user_login=USER))
+    )
+    assert msg.startswith("Cancelling 2 jobs of the arrays [0]")
+    assert tasks(0)[1] == [State.CANCELLED, State.CANCELLED, State.RUNNING]
+    assert JobsTable.get_states([5]) == {5: State.CANCELLED.value}
+
+    JobsTable.remove(NS(ids=[], array_ids=[3], verbose=0, extra_kwargs=dict(user_login=USER)))
+    assert tasks(3) == ([], [])
+    assert sorted(JobsTable.read().id.tolist()) == [0, 1, 2, 5]
+
+
+# ENDFILE
@@ -0,0 +1,121 @@
+"""Job dependencies (`--after`, see JobsTable.resolve_dependencies)
+
+Every test runs on both storage backends, in a temporary table. Run with
+`python -m pytest tests`
+"""
+import argparse
+import datetime
+
+from jobs_queue.dependencies import dependency_state
+from jobs_queue.jobs import Priority, State
+from jobs_queue.jobs_table import JobsTable
+
+NS = argparse.Namespace
+USER = "user"
+
+
+def add(afters):
+    "Resumed jobs with ids 0..n-1 and dependencies (None for no dependency)"
+    with JobsTable.transaction() as tr:
+        for id, after in enumerate(afters):
+            tr.insert(
+                JobsTable.new_job(id, USER, f"ls {id}", Priority.LOW, 0, "python", "/tmp", after)
+            )
+    JobsTable.resume(NS(op="all", verbose=0))
+
+
+def end(id, state):
+    "Job ended by the server (see server_queue.finish_job)"
+    with JobsTable.transaction() as tr:
+        tr.update([id], pid=None, ftime=datetime.datetime.now())
+        tr.set_state([id], state)
+
+
+def states():
+    df = JobsTable.read().sort_values("id")
+    return [State(int(state)) for state in df.state]
+
+
+def test_dependency_state():
+    finished, error, cancelled = State.FINISHED.value, State.ERROR.value, State.CANCELLED.value
+    assert dependency_state("afterok", [finished, State.RUNNING.value]) is State.BLOCKED
+    assert dependency_state("afterok", [finished, finished]) is State.WAITING
+    assert dependency_state("afterok", [finished, error]) is State.CANCELLED
+    assert dependency_state("afterok", [None]) is State.CANCELLED  # Removed parent
+
+    assert dependency_state("afterany", [finished, State.WAITING.value]) is State.BLOCKED
+    assert dependency_state("afterany", [error, cancelled, None]) is State.WAITING
+
+
+def test_afterok(table):
+    add([None, None, "afterok:0,1"])
+    assert states() == [State.WAITING, State.WAITING, State.BLOCKED]
+
+    end(0, State.FINISHED)
+    assert states()[2] is State.BLOCKED
+
+    end(1, State.FINISHED)
+    assert states()[2] is State.WAITING
+    JobsTable.check_index()
+    assert int(JobsTable.peek_next_job().id.values[0]) == 2
+
+
+def test_afterany(table):
+    add([None, "afterany:0"])
+
+    end(0, State.ERROR)
+    assert states() == [State.ERROR, State.WAITING]
+
+
+def test_failed_parent_cancels_descendants(table):
+    # 0 <- 1 <- 2 and 3 runs whatever 1 ends in
+    add([None, "afterok:0", "afterok:1", "afterany:1"])
+    assert states() == [State.WAITING, *[State.BLOCKED] * 3]
+
+    end(0, State.ERROR)
+    assert states() == [State.ERROR, State.CANCELLED, State.CANCELLED, State.WAITING]
+
+    df = JobsTable.read().sort_values("id")
+    assert df.ftime.notna().tolist() == [True, True, True, False]
+
+
+def test_cancel_cascades(table):
+    add([None, "afterok:0", "afterok:1"])
+
+    msg = JobsTable.cancel(NS(ids=[0], verbose=0, extra_kwargs=dict(user_login=USER)))
+    assert states() == [State.CANCELLED] * 3
+    assert "Cancelling the jobs that depend on them: [1, 2]" in msg
+
+
+def test_removed_parent(table):
+    add([None, "afterok:0", "afterany:0"])
+
+    JobsTable.remove(NS(ids=[0], verbose=0, extra_kwargs=dict(user_login=USER)))
+    assert states() == [State.CANCELLED, State.WAITING]
+
+
+def test_resume_evaluates_dependencies(table):
+    add([None, None, "afterok:0", "afterok:1"])
+    JobsTable.pause(NS(op="ids", ids=[2, 3], verbose=0))
+    assert states()[2:] == [State.PAUSED, State.PAUSED]
+
+    # Parents ended while their children were paused
+    end(0, State.FINISHED)
+    end(1, State.ERROR)
+    assert states()[2:] == [State.PAUSED, State.PAUSED]
+
+    msg = JobsTable.resume(NS(op="ids", ids=[2, 3], verbose=0))
+    assert states()[2:] == [State.WAITING, State.CANCELLED]
+    assert "Cancelled, their dependencies failed: [3]" in msg
+
+
+def test_dependencies_index_rebuilt(table):
+    add([None, "afterok:0"])
+
+    # Lost, e.g. another process changed the table
+    JobsTable.deps.signature = None
+    end(0, State.FINISHED)
+    assert states() == [State.FINISHED, State.WAITING]
+
+
+# ENDFILE
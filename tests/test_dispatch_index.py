@@ -0,0 +1,148 @@
+"""Dispatch index (see DispatchIndex) kept in sync with the jobs table
+
+Every test runs on both storage backends, in a temporary table. Run with
+`python -m pytest tests`
+"""
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+from jobs_queue.jobs import Priority, State
+from jobs_queue.jobs_table import JobsTable
+
+NS = argparse.Namespace
+USER = "user"
+
+# Changes the table from another process. argv: storage name, table dir
+OTHER_PROCESS = f"""
+import argparse, sys
+from pathlib import Path
+from jobs_queue.jobs_table import JobsTable
+from jobs_queue.storage import CsvStorage, SqliteStorage
+
+storages = dict(
+    sqlite=lambda tmp: SqliteStorage(Path(tmp) / "jobs_table.db"),
+    csv=lambda tmp: CsvStorage(Path(tmp) / "jobs_table.csv"),
+)
+JobsTable.storage = storages[sys.argv[1]](sys.argv[2])
+JobsTable.resume(argparse.Namespace(op="all", verbose=0))
+JobsTable.update_job(5, "priority", {Priority.URGENT.value})
+"""
+
+
+def add(priorities, state=State.WAITING):
+    "Jobs with ids 0..n-1 and priorities"
+    with JobsTable.transaction() as tr:
+        for id, priority in enumerate(priorities):
+            tr.insert(JobsTable.new_job(id, USER, f"ls {id}", priority, 0, "python", "/tmp"))
+        tr.set_state(list(range(len(priorities))), state)
+
+
+def check_index(in_sync: bool = True):
+    """check_index and whether the index was updated in place by the last
+    transaction (in sync) instead of waiting to be rebuilt"""
+    assert (JobsTable.index.signature == JobsTable.storage.signature()) is in_sync
+    JobsTable.check_index()
+
+
+def order():
+    return [int(job.id.values[0]) for job in JobsTable.waiting_jobs()]
+
+
+def test_add(table):
+    add([Priority.LOW, Priority.HIGH, Priority.MEDIUM, Priority.HIGH])
+    JobsTable.check_index()  # First sync builds the index
+    assert order() == [1, 3, 2, 0]
+
+    with JobsTable.transaction() as tr:
+        tr.insert(JobsTable.new_job(4, USER, "ls 4", Priority.URGENT, 0, "python", "/tmp"))
+        tr.set_state([4], State.WAITING)
+    check_index()
+    assert order() == [4, 1, 3, 2, 0]
+
+
+def test_update_priority(table):
+    add([Priority.LOW, Priority.MEDIUM, Priority.HIGH])
+    JobsTable.check_index()
+
+    JobsTable.update(
+        NS(id=0, attr="priority", new_value="urgent", verbose=0, extra_kwargs=dict(user_login=USER))
+    )
+    check_index()
+    assert order() == [0, 2, 1]
+
+
+def test_pause_resume(table):
+    add([Priority.LOW, Priority.MEDIUM, Priority.HIGH, Priority.HIGH])
+    JobsTable.check_index()
+
+    JobsTable.pause(NS(op="ids", ids=[2, 0], verbose=0))
+    check_index()
+    assert order() == [3, 1]
+
+    JobsTable.pause(NS(op="priority", priority="high", verbose=0))
+    check_index()
+    assert order() == [1]
+
+    JobsTable.resume(NS(op="ids", ids=[2], verbose=0))
+    check_index()
+    assert order() == [2, 1]
+
+    JobsTable.resume(NS(op="all", verbose=0))
+    check_index()
+    assert order() == [2, 3, 1, 0]
+
+
+def test_remove(table):
+    add([Priority.LOW, Priority.MEDIUM, Priority.HIGH])
+    JobsTable.check_index()
+
+    JobsTable.remove(NS(ids=[2, 0], verbose=0, extra_kwargs=dict(user_login=USER)))
+    check_index()
+    assert order() == [1]
+
+
+def test_claim(table):
+    add([Priority.LOW, Priority.MEDIUM, Priority.HIGH])
+    JobsTable.check_index()
+
+    assert int(JobsTable.get_next_job().id.values[0]) == 2
+    check_index()
+    assert order() == [1, 0]
+
+
+def test_walk_puts_jobs_back(table):
+    add([Priority.LOW] * 40)
+    JobsTable.check_index()
+
+    waiting = JobsTable.waiting_jobs(batch=4)
+    assert [int(next(waiting).id.values[0]) for _ in range(10)] == list(range(10))
+    waiting.close()
+
+    check_index()
+    assert len(JobsTable.index.heap) == 40
+    assert order() == list(range(40))
+
+
+def test_rebuild_other_process(table):
+    add([Priority.LOW] * 4 + [Priority.MEDIUM] * 2, state=State.PAUSED)
+    JobsTable.resume(NS(op="ids", ids=[0, 4], verbose=0))
+    check_index(in_sync=False)  # Never synced, rebuilt by check_index
+    assert order() == [4, 0]
+
+    subprocess.run(
+        [sys.executable, "-c", OTHER_PROCESS, table, str(JobsTable.storage.path.parent)],
+        cwd=Path(__file__).parents[1],
+        check=True,
+    )
+    check_index(in_sync=False)
+    assert order() == [5, 4, 0, 1, 2, 3]
+
+    # Back in sync after the rebuild
+    JobsTable.pause(NS(op="ids", ids=[5], verbose=0))
+    check_index()
+    assert order() == [4, 0, 1, 2, 3]
+
+
+# ENDFILE
@@ -0,0 +1,91 @@
+"""Jobs tables written by older versions (see SqliteStorage.migrate)
+
+Older versions stored the table as a ';' separated csv with only the first
+columns, `---` for the missing values and times with or without microseconds.
+Run with `python -m pytest tests`
+"""
+import pandas as pd
+import pytest
+
+import jobs_queue.history
+from jobs_queue.jobs import JOB_COLUMNS, State
+from jobs_queue.storage import CsvStorage, SqliteStorage
+
+LEGACY_TABLE = """\
+pid;id;user;command;priority;gpu_mem;state;ctime;stime;ftime;env_path;working_dir
+---;0;alice;python a.py;1;0;-1;2024-01-02 10:11:12.123456;---;---;/envs/a/bin/python;/home/alice
+4242;1;bob;python b.py;3;1000;2;2024-01-02 10:11:13;2024-01-02 10:12:00.500000;---;/envs/b/bin/python;/home/bob
+---;7;bob;python c.py;2;0;3;2024-01-02 10:11:14;2024-01-02 10:12:01;2024-01-02 10:13:00;/envs/b/bin/python;/home/bob
+"""
+
+
+@pytest.fixture
+def legacy_csv(tmp_path):
+    path = tmp_path / "jobs_table.csv"
+    path.write_text(LEGACY_TABLE)
+    return path
+
+
+def check_legacy(df: pd.DataFrame):
+    "The legacy table parsed, with the columns added later missing"
+    df = df.sort_values("id").reset_index(drop=True)
+    assert list(df.columns) == JOB_COLUMNS
+    assert df.id.tolist() == [0, 1, 7]
+
+    assert df.pid.isna().tolist() == [True, False, True]
+    assert int(df.pid[1]) == 4242
+    assert df.state.astype(int).tolist() == [
+        State.PAUSED.value,
+        State.RUNNING.value,
+        State.FINISHED.value,
+    ]
+    assert df.gpu_mem.tolist() == [0.0, 1000.0, 0.0]
+
+    assert df.ctime.tolist() == [
+        pd.Timestamp("2024-01-02 10:11:12.123456"),
+        pd.Timestamp("2024-01-02 10:11:13"),
+        pd.Timestamp("2024-01-02 10:11:14"),
+    ]
+    assert df.stime.isna().tolist() == [True, False, False]
+    assert df.stime[1] == pd.Timestamp("2024-01-02 10:12:00.5")
+    assert df.ftime.isna().tolist() == [True, True, False]
+
+    for col in ["worker", "after", "array_id", "heartbeat", "wtime"]:
+        assert df[col].isna().all(), col
+
+
+def test_csv_reads_legacy_table(legacy_csv):
+    check_legacy(CsvStorage(legacy_csv).read())
+
+
+def test_migrate_to_sqlite(legacy_csv, tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs_queue.history, "HISTORY_DIR", tmp_path / "history")
+    storage = SqliteStorage(tmp_path / "jobs_table.db", csv_path=legacy_csv)
+    check_legacy(storage.read())
+
+    assert not legacy_csv.exists()
+    assert (tmp_path / "jobs_table.csv.migrated").exists()
+
+    # Missing values are stored as NULL, not as the `---` sentinel
+    def count(where: str) -> int:
+        sql = f"SELECT COUNT(*) FROM jobs WHERE {where}"
+        return storage.conn.execute(sql).fetchone()[0]
+
+    assert count("pid IS NULL AND stime IS NULL AND ftime IS NULL") == 1
+    assert count("pid = '---' OR stime = '---' OR ftime = '---'") == 0
+
+    # New ids continue after the migrated ones
+    assert storage.next_ids(2) == [8, 9]
+
+
+def test_migrate_once(legacy_csv, tmp_path):
+    SqliteStorage(tmp_path / "jobs_table.db", csv_path=legacy_csv).read()
+
+    # Another csv at the same place is not imported into the existing database
+    legacy_csv.write_text(LEGACY_TABLE)
+    storage = SqliteStorage(tmp_path / "jobs_table.db", csv_path=legacy_csv)
+    assert storage.read().id.tolist().count(0) == 1
+    assert legacy_csv.exists()
+
+
+# ENDFILE
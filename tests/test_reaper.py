@@ -0,0 +1,137 @@
+"""Recovery of the running jobs of a lost server (see Scheduler.reap)
+
+Every test runs on both storage backends, in a temporary table. Run with
+`python -m pytest tests`
+"""
+import asyncio
+import datetime
+import subprocess
+
+import pytest
+
+import jobs_queue.server_queue
+from jobs_queue.dispatch import DispatchIndex
+from jobs_queue.fairshare import FairShare
+from jobs_queue.gpu_memory import GpuManager
+from jobs_queue.jobs import Priority, State
+from jobs_queue.jobs_table import JobsTable
+from jobs_queue.server_queue import Scheduler
+
+USER = "user"
+LOST = "lost-host:1"  # Worker of another host, only lost when its lease expires
+
+
+@pytest.fixture
+def scheduler(table, tmp_path, monkeypatch):
+    "Scheduler factory. Its log and settings do not leak out of the test"
+    log_path = tmp_path / "jobs_table.csv"  # Scheduler logs to jobs_table.log
+    monkeypatch.setattr(jobs_queue.server_queue, "JOBS_TABLE_FILENAME", log_path)
+    # Class attributes set by Scheduler, restored after the test
+    monkeypatch.setattr(GpuManager, "FREE_WINDOW", GpuManager.FREE_WINDOW)
+    monkeypatch.setattr(FairShare, "HALF_LIFE", FairShare.HALF_LIFE)
+    monkeypatch.setattr(DispatchIndex, "AGING", DispatchIndex.AGING)
+
+    return lambda on_lost: Scheduler(lease=60, on_lost=on_lost)
+
+
+@pytest.fixture
+def process():
+    "Live process of a job of the lost server"
+    proc = subprocess.Popen(["sleep", "60"])
+    yield proc
+    proc.kill()
+    proc.wait()
+
+
+def add_running(pids, heartbeat_age=3600):
+    """Running jobs with ids 0..n-1 and pids leased to LOST, plus a job n that
+    runs after job 0 succeeds"""
+    now = datetime.datetime.now()
+    with JobsTable.transaction() as tr:
+        for id, pid in enumerate(pids):
+            tr.insert(JobsTable.new_job(id, USER, f"ls {id}", Priority.LOW, 0, "python", "/tmp"))
+            tr.update(
+                [id],
+                pid=pid,
+                stime=now,
+                worker=LOST,
+                heartbeat=now - datetime.timedelta(seconds=heartbeat_age),
+            )
+            tr.set_state([id], State.RUNNING)
+
+        child = len(pids)
+        tr.insert(
+            JobsTable.new_job(child, USER, "ls", Priority.LOW, 0, "python", "/tmp", "afterok:0")
+        )
+        tr.set_state([child], State.BLOCKED)
+
+
+def dead_pid():
+    proc = subprocess.Popen(["true"])
+    proc.wait()
+    return proc.pid
+
+
+def jobs():
+    return JobsTable.read().sort_values("id").set_index("id")
+
+
+def test_adopt_and_requeue(scheduler, process):
+    add_running([process.pid, dead_pid()])
+    ctime = jobs().ctime[1]
+
+    async def reap():
+        server = scheduler("requeue")
+        server.wakeup = asyncio.Event()  # Created by Scheduler.run
+        server.reap()
+
+        df = jobs()
+        assert df.state.astype(int).tolist() == [
+            State.RUNNING.value,
+            State.WAITING.value,
+            State.BLOCKED.value,
+        ]
+
+        # Adopted: leased to the new server and supervised until it ends
+        assert df.worker[0] == server.worker
+        assert int(df.pid[0]) == process.pid
+        assert list(server.running) == [0]
+
+        # Requeued at its place in the queue
+        assert df.pid.isna()[1] and df.stime.isna()[1] and df.worker.isna()[1]
+        assert df.ctime[1] == ctime
+        assert int(JobsTable.peek_next_job().id.values[0]) == 1
+
+        process.kill()
+        process.wait()
+        await asyncio.wait_for(server.running[0], timeout=10)
+
+    asyncio.run(reap())
+
+    # Exit status unknown, ends as finished so its afterok child runs
+    df = jobs()
+    assert State(int(df.state[0])) is State.FINISHED
+    assert df.pid.isna()[0] and df.ftime.notna()[0]
+    assert State(int(df.state[2])) is State.WAITING
+
+
+def test_lost_as_error(scheduler):
+    add_running([dead_pid()])
+
+    scheduler("error").reap()
+
+    df = jobs()
+    assert State(int(df.state[0])) is State.ERROR
+    assert df.ftime.notna()[0]
+    assert State(int(df.state[1])) is State.CANCELLED
+
+
+def test_lease_not_expired(scheduler):
+    add_running([dead_pid()], heartbeat_age=0)
+
+    scheduler("requeue").reap()
+
+    assert State(int(jobs().state[0])) is State.RUNNING
+
+
+# ENDFILE